@@ -315,7 +315,7 @@ class AutoEncoder:
                 "input_directory": self.input_directory,
                 "nb_training_images": self.learner.train_data.samples,
                 "nb_validation_images": self.learner.val_data.samples,
-                "validation_split": self.learner.train_data.image_data_generator._validation_split,
+                "validation_split": self.get_validation_split(),
             },
             "model": {"architecture": self.architecture, "loss": self.loss,},
             "preprocessing": {
@@ -336,6 +336,13 @@ class AutoEncoder:
         }
         return info
 
+    def get_validation_split(self):
+        train_data = self.learner.train_data
+        # keras' DirectoryIterator or ImageDataset of the tf.data backend
+        if hasattr(train_data, "image_data_generator"):
+            return train_data.image_data_generator._validation_split
+        return train_data.validation_split
+
     def get_best_epoch(self):
         """
         Returns the index of the epoch when the model had stopped training.
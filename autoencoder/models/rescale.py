@@ -0,0 +1,36 @@
+import tensorflow as tf
+from tensorflow import keras
+
+# Datatypes of the images fed to the models: float32 images rescaled by the
+# Preprocessor, or uint8 images rescaled by a Rescale layer of the model
+INPUT_DTYPES = ["float32", "uint8"]
+
+
+class Rescale(keras.layers.Layer):
+    """
+    Casts uint8 images to float32 and multiplies them by rescale, as
+    ImageDataGenerator does with its rescale argument (same float32 values),
+    so that images can stay uint8 until they enter the model.
+    """
+
+    def __init__(self, rescale, **kwargs):
+        super().__init__(**kwargs)
+        self.rescale = rescale
+
+    def call(self, inputs):
+        return tf.cast(inputs, tf.float32) * self.rescale
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"rescale": self.rescale})
+        return config
+
+
+def add_rescale_input(model, rescale):
+    """
+    Returns a model taking uint8 images, rescaled by a Rescale layer and
+    passed to model (weights are shared with model).
+    """
+    input_img = keras.layers.Input(shape=model.input_shape[1:], dtype="uint8")
+    x = Rescale(rescale)(input_img)
+    return keras.models.Model(input_img, model(x))
@@ -0,0 +1,575 @@
+"""
+Times the hot paths of the project on synthetic images (no dataset needed):
+calculate_resmaps, label_images, determine_threshold, predict_classes, the
+throughput of model.predict for every architecture and several batch sizes,
+and the cold start of test.py (loading a saved model and predicting a first
+image in a fresh process) with each model loader. Results are saved as JSON
+along with information on the environment, and can be compared with the
+results of a previous run to spot regressions.
+"""
+
+import os
+import io
+import json
+import time
+import platform
+import tempfile
+import datetime
+import argparse
+import subprocess
+import contextlib
+import sys
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import cv2
+import skimage
+from autoencoder.models import mvtec
+from autoencoder.models import mvtec_2
+from autoencoder.models import baselineCAE
+from autoencoder.models import inceptionCAE
+from autoencoder.models import resnetCAE
+from processing import resmaps
+from processing import utils
+from autoencoder import losses
+from finetune import determine_threshold
+from test import predict_classes
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ARCHITECTURES = {
+    "mvtec": mvtec,
+    "mvtec2": mvtec_2,
+    "baselineCAE": baselineCAE,
+    "inceptionCAE": inceptionCAE,
+    "resnetCAE": resnetCAE,
+}
+
+# fraction of synthetic images with a defect, and side of the defects
+DEFECT_FRACTION = 0.5
+DEFECT_SIZE = 24
+
+# minimum area of the benchmarks of determine_threshold and predict_classes
+MIN_AREA = 25
+
+# model loaders timed by the "load" suite
+LOADERS = {
+    "load_model_HDF5": "model, info, _ = utils.load_model_HDF5(model_path)",
+    "inference": "model, info = utils.load_model_inference(model_path)",
+    "inference_savedmodel": "model, info = utils.load_model_inference(model_path, 'savedmodel')",
+    "inference_weights": "model, info = utils.load_model_inference(model_path, 'weights')",
+}
+
+# script run in a fresh process to time the cold start of a loader
+COLD_START_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import numpy as np
+from processing import utils
+model_path = sys.argv[1]
+imported = time.perf_counter()
+{load}
+loaded = time.perf_counter()
+shape = info["preprocessing"]["shape"]
+channels = 3 if info["preprocessing"]["color_mode"] == "rgb" else 1
+model.predict(np.zeros((1, shape[0], shape[1], channels), dtype="float32"), verbose=0)
+predicted = time.perf_counter()
+print(json.dumps([imported - start, loaded - imported, predicted - loaded]))
+"""
+
+
+def generate_images(nb_images, shape, seed=0):
+    """
+    Returns synthetic grayscale input images (smooth textures, half of them
+    with a bright square defect) and their reconstructions (the textures
+    without defects, blurred and noisy), as float32 arrays in [0, 1].
+    """
+    rng = np.random.RandomState(seed)
+    imgs_input = np.empty((nb_images,) + shape, dtype="float32")
+    imgs_pred = np.empty((nb_images,) + shape, dtype="float32")
+    for i in range(nb_images):
+        texture = cv2.GaussianBlur(rng.rand(*shape).astype("float32"), (0, 0), 4)
+        texture = (texture - texture.min()) / (texture.max() - texture.min())
+        imgs_pred[i] = cv2.GaussianBlur(texture, (0, 0), 1) + rng.normal(0, 0.02, shape)
+        imgs_input[i] = texture
+        if i < DEFECT_FRACTION * nb_images:
+            y, x = rng.randint(0, min(shape) - DEFECT_SIZE, size=2)
+            imgs_input[i, y : y + DEFECT_SIZE, x : x + DEFECT_SIZE] = 1.0
+    return imgs_input, np.clip(imgs_pred, 0, 1)
+
+
+def time_function(function, repeat):
+    """
+    Returns the durations in seconds of repeat calls of function, after a
+    warm-up call. Output printed by function (progress bars) is discarded.
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def get_record(name, params, times, nb_images):
+    return {
+        "name": name,
+        "params": params,
+        "nb_images": nb_images,
+        "times": times,
+        "min": min(times),
+        "median": float(np.median(times)),
+        "mean": float(np.mean(times)),
+        "images_per_sec": nb_images / min(times),
+    }
+
+
+def benchmark_resmaps(imgs_input, imgs_pred, methods, dtypes, ssim_engines, repeat):
+    """
+    Times calculate_resmaps (with every SSIM engine for SSIM resmaps),
+    label_images, determine_threshold (with MIN_AREA) and predict_classes
+    (with the threshold found) for every method and dtype, and returns
+    their records.
+    """
+    records = []
+    nb_images = len(imgs_input)
+    y_true = np.arange(nb_images) < DEFECT_FRACTION * nb_images
+    for method in methods:
+        for dtype in dtypes:
+            params = {"method": method, "dtype": dtype}
+            # the SSIM engine only changes how SSIM resmaps are computed
+            engines = ssim_engines if method == "ssim" else [None]
+            for ssim_engine in engines:
+                params_engine = dict(params)
+                if ssim_engine is not None:
+                    params_engine["ssim_engine"] = ssim_engine
+                times = time_function(
+                    lambda: resmaps.calculate_resmaps(
+                        imgs_input,
+                        imgs_pred,
+                        method,
+                        dtype=dtype,
+                        ssim_engine=ssim_engine or "batch",
+                    ),
+                    repeat,
+                )
+                records.append(
+                    get_record("calculate_resmaps", params_engine, times, nb_images)
+                )
+
+            resmaps_bench = resmaps.calculate_resmaps(
+                imgs_input, imgs_pred, method, dtype=dtype
+            )
+            thresh_min, thresh_step = resmaps.get_thresh_parameters(method, dtype)
+            thresh_max = np.amax(resmaps_bench).item()
+            with contextlib.redirect_stdout(io.StringIO()):
+                threshold = determine_threshold(
+                    resmaps_bench, MIN_AREA, thresh_min, thresh_max, thresh_step
+                )
+
+            images_th = resmaps_bench > resmaps.cast_threshold(resmaps_bench, threshold)
+            for backend in resmaps.LABEL_BACKENDS:
+                if backend == "opencv" and resmaps.LABEL_BACKEND != "opencv":
+                    continue
+                times = time_function(
+                    lambda: resmaps.label_images(images_th, backend=backend), repeat
+                )
+                records.append(
+                    get_record(
+                        "label_images", dict(params, backend=backend), times, nb_images,
+                    )
+                )
+
+            times = time_function(
+                lambda: determine_threshold(
+                    resmaps_bench, MIN_AREA, thresh_min, thresh_max, thresh_step
+                ),
+                repeat,
+            )
+            records.append(
+                get_record(
+                    "determine_threshold",
+                    dict(params, min_area=MIN_AREA),
+                    times,
+                    nb_images,
+                )
+            )
+
+            times = time_function(
+                lambda: predict_classes(resmaps_bench, MIN_AREA, threshold), repeat
+            )
+            record = get_record(
+                "predict_classes", dict(params, min_area=MIN_AREA), times, nb_images
+            )
+            y_pred = predict_classes(resmaps_bench, MIN_AREA, threshold)
+            record["accuracy"] = float(np.mean(np.array(y_pred) == y_true))
+            records.append(record)
+    return records
+
+
+def benchmark_predict(architectures, batch_sizes, color_mode, nb_batches, repeat):
+    """Times model.predict of every architecture and batch size."""
+    records = []
+    channels = 3 if color_mode == "rgb" else 1
+    for architecture in architectures:
+        module = ARCHITECTURES[architecture]
+        model = module.build_model(color_mode)
+        for batch_size in batch_sizes:
+            nb_images = batch_size * nb_batches
+            imgs = (
+                np.random.RandomState(0)
+                .rand(nb_images, *module.SHAPE, channels)
+                .astype("float32")
+            )
+            times = time_function(
+                lambda: model.predict(imgs, batch_size=batch_size, verbose=0), repeat,
+            )
+            params = {
+                "architecture": architecture,
+                "color_mode": color_mode,
+                "batch_size": batch_size,
+            }
+            records.append(get_record("model.predict", params, times, nb_images))
+        tf.keras.backend.clear_session()
+    return records
+
+
+def save_synthetic_model(save_dir, color_mode):
+    """
+    Saves an mvtec2 model as train.py does (compiled with the SSIM loss,
+    with the Adam state of one training step, info.json and history.csv)
+    and returns its path.
+    """
+    model = mvtec_2.build_model(color_mode)
+    model.compile(loss=losses.ssim_loss(1.0), optimizer=tf.keras.optimizers.Adam(1e-3))
+    channels = 3 if color_mode == "rgb" else 1
+    imgs = np.random.RandomState(0).rand(2, *mvtec_2.SHAPE, channels)
+    model.fit(imgs.astype("float32"), imgs.astype("float32"), verbose=0)
+    model_path = os.path.join(save_dir, "CAE_mvtec2_b8_e1.hdf5")
+    model.save(model_path)
+    info = {
+        "data": {"input_directory": None, "nb_validation_images": 2},
+        "model": {"architecture": "mvtec2", "loss": "ssim"},
+        "preprocessing": {
+            "color_mode": color_mode,
+            "rescale": 1.0 / 255,
+            "shape": list(mvtec_2.SHAPE),
+            "vmin": 0.0,
+            "vmax": 1.0,
+            "dynamic_range": 1.0,
+            "preprocessing": None,
+        },
+    }
+    with open(os.path.join(save_dir, "info.json"), "w") as json_file:
+        json.dump(info, json_file, indent=4, sort_keys=False)
+    pd.DataFrame(
+        {"loss": np.linspace(1, 0, 50), "val_loss": np.linspace(1, 0, 50)}
+    ).to_csv(os.path.join(save_dir, "history.csv"))
+    tf.keras.backend.clear_session()
+    return model_path
+
+
+def benchmark_load(model_path, repeat):
+    """
+    Times the cold start of every loader in fresh processes: import of the
+    processing modules (and TensorFlow), loading of the model and first
+    prediction. Inference copies are saved by an untimed warm-up process.
+    """
+    records = []
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    for loader, load in LOADERS.items():
+        script = COLD_START_SCRIPT.format(load=load)
+        times = []
+        for _ in range(repeat + 1):
+            output = subprocess.check_output(
+                [sys.executable, "-c", script, os.path.abspath(model_path)],
+                cwd=cwd,
+                stderr=subprocess.DEVNULL,
+            )
+            times.append(json.loads(output.decode().strip().splitlines()[-1]))
+        times = np.array(times[1:])
+        for name, column in [("import", 0), ("load_model", 1), ("first_predict", 2)]:
+            records.append(
+                get_record(name, {"loader": loader}, times[:, column].tolist(), 1)
+            )
+    return records
+
+
+def get_git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_environment():
+    """Returns information on the machine and the versions of the libraries."""
+    return {
+        "date": datetime.datetime.now().isoformat(),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "gpus": [gpu.name for gpu in tf.config.list_physical_devices("GPU")],
+        "numpy": np.__version__,
+        "tensorflow": tf.__version__,
+        "opencv": cv2.__version__,
+        "skimage": skimage.__version__,
+        "label_backend": resmaps.LABEL_BACKEND,
+    }
+
+
+def get_key(record):
+    return (record["name"],) + tuple(sorted(record["params"].items()))
+
+
+def compare(records, baseline_path):
+    """Prints the speedup of records over the records of baseline_path."""
+    with open(baseline_path, "r") as read_file:
+        baseline = {
+            get_key(record): record for record in json.load(read_file)["results"]
+        }
+    print(
+        "\n{:<80}{:>12}{:>12}{:>10}".format(
+            "benchmark", "baseline", "current", "speedup"
+        )
+    )
+    for record in records:
+        key = get_key(record)
+        if key not in baseline:
+            continue
+        print(
+            "{:<80}{:>12.4f}{:>12.4f}{:>9.2f}x".format(
+                format_name(record),
+                baseline[key]["min"],
+                record["min"],
+                baseline[key]["min"] / record["min"],
+            )
+        )
+
+
+def format_name(record):
+    params = ", ".join(
+        "{}={}".format(key, value) for key, value in record["params"].items()
+    )
+    return "{} ({})".format(record["name"], params)
+
+
+def main(args):
+    shape = tuple(args.shape)
+    imgs_input, imgs_pred = generate_images(args.nb_images, shape)
+
+    records = []
+    if "resmaps" in args.suites:
+        logger.info("timing resmap, labelling and classification functions...")
+        records += benchmark_resmaps(
+            imgs_input,
+            imgs_pred,
+            args.methods,
+            args.dtypes,
+            args.ssim_engines,
+            args.repeat,
+        )
+    if "predict" in args.suites:
+        logger.info("timing model.predict...")
+        records += benchmark_predict(
+            args.architectures,
+            args.batch_sizes,
+            args.color,
+            args.nb_batches,
+            args.repeat,
+        )
+    if "load" in args.suites:
+        logger.info("timing the cold start of model loaders...")
+        if args.model is None:
+            with tempfile.TemporaryDirectory() as save_dir:
+                model_path = save_synthetic_model(save_dir, args.color)
+                records += benchmark_load(model_path, args.repeat)
+        else:
+            records += benchmark_load(args.model, args.repeat)
+
+    print("\n{:<80}{:>12}{:>14}".format("benchmark", "min (s)", "images/sec"))
+    for record in records:
+        print(
+            "{:<80}{:>12.4f}{:>14.1f}".format(
+                format_name(record), record["min"], record["images_per_sec"]
+            )
+        )
+    if args.compare is not None:
+        compare(records, args.compare)
+
+    # save results
+    output = args.output
+    if output is None:
+        now = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        output = os.path.join(
+            os.getcwd(), "results", "benchmarks", "benchmark_{}.json".format(now)
+        )
+    if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    config = vars(args).copy()
+    config["shape"] = list(shape)
+    with open(output, "w") as json_file:
+        json.dump(
+            {"environment": get_environment(), "config": config, "results": records},
+            json_file,
+            indent=4,
+            sort_keys=False,
+        )
+    logger.info("benchmark results saved at {}".format(output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the resmap, labelling, finetuning and inference hot paths on synthetic images.",
+        epilog="Example usage: python3 benchmark.py -n 64 -r 5 --compare results/benchmarks/benchmark_old.json",
+    )
+    parser.add_argument(
+        "-s",
+        "--suites",
+        type=str,
+        nargs="+",
+        required=False,
+        metavar="",
+        choices=["resmaps", "predict", "load"],
+        default=["resmaps", "predict", "load"],
+        help="benchmarks to run: 'resmaps' (resmaps, labelling, threshold, classes), 'predict' and 'load' (cold start of model loaders)",
+    )
+    parser.add_argument(
+        "-n",
+        "--nb-images",
+        type=int,
+        required=False,
+        metavar="",
+        default=64,
+        help="number of synthetic images of the resmaps benchmarks",
+    )
+    parser.add_argument(
+        "--shape",
+        type=int,
+        nargs=2,
+        required=False,
+        metavar="",
+        default=[256, 256],
+        help="shape of the synthetic images of the resmaps benchmarks",
+    )
+    parser.add_argument(
+        "-m",
+        "--methods",
+        type=str,
+        nargs="+",
+        required=False,
+        metavar="",
+        choices=["ssim", "l2"],
+        default=["l2", "ssim"],
+        help="methods for generating resmaps: 'ssim' and/or 'l2'",
+    )
+    parser.add_argument(
+        "-t",
+        "--dtypes",
+        type=str,
+        nargs="+",
+        required=False,
+        metavar="",
+        choices=resmaps.RESMAP_DTYPES,
+        default=["float64", "uint8"],
+        help="datatypes of the resmaps: 'float64', 'float32', 'float16' and/or 'uint8'",
+    )
+    parser.add_argument(
+        "--ssim-engines",
+        type=str,
+        nargs="+",
+        required=False,
+        metavar="",
+        choices=resmaps.SSIM_ENGINES,
+        default=resmaps.SSIM_ENGINES,
+        help="engines of the SSIM resmaps: 'batch' and/or 'skimage'",
+    )
+    parser.add_argument(
+        "-a",
+        "--architectures",
+        type=str,
+        nargs="+",
+        required=False,
+        metavar="",
+        choices=list(ARCHITECTURES),
+        default=list(ARCHITECTURES),
+        help="architectures of the model.predict benchmark",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-sizes",
+        type=int,
+        nargs="+",
+        required=False,
+        metavar="",
+        default=[1, 8, 32],
+        help="batch sizes of the model.predict benchmark",
+    )
+    parser.add_argument(
+        "--nb-batches",
+        type=int,
+        required=False,
+        metavar="",
+        default=4,
+        help="number of batches predicted per model.predict call",
+    )
+    parser.add_argument(
+        "-c",
+        "--color",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["rgb", "grayscale"],
+        default="grayscale",
+        help="color mode of the models: 'rgb' or 'grayscale'",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        required=False,
+        metavar="",
+        default=3,
+        help="number of timed runs of each benchmark (the minimum is reported)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=False,
+        metavar="",
+        default=None,
+        help="path of the JSON file of the results (default: results/benchmarks/benchmark_<date>.json)",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        required=False,
+        metavar="",
+        default=None,
+        help="path to a saved model for the 'load' suite (default: a synthetic mvtec2 model)",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        required=False,
+        metavar="",
+        default=None,
+        help="JSON file of a previous run to compare the results with",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,108 @@
+"""
+Measures the throughput (images/sec) of the training and validation
+pipelines of Preprocessor with the keras (ImageDataGenerator), tfdata and
+memmap backends, on the images of a dataset directory.
+"""
+
+import time
+import argparse
+from autoencoder.models import mvtec_2
+from processing.preprocessing import Preprocessor
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def iterate_batches(data, backend, nb_batches):
+    if backend == "tfdata":
+        dataset = data.to_tfdataset(shuffle=data.shuffle, repeat=True)
+        for batch in dataset.take(nb_batches):
+            yield batch[0]
+    else:
+        for index in range(nb_batches):
+            yield data[index % len(data)][0]
+
+
+def benchmark(data, backend, nb_batches):
+    """Returns the number of images per second, excluding the first batch."""
+    batches = iterate_batches(data, backend, nb_batches + 1)
+    next(batches)
+    nb_images = 0
+    start = time.perf_counter()
+    for batch in batches:
+        nb_images += len(batch)
+    return nb_images / (time.perf_counter() - start)
+
+
+def main(args):
+    results = {}
+    for backend in ["keras", "tfdata", "memmap"]:
+        for cache in [False, True] if backend == "tfdata" else [False]:
+            preprocessor = Preprocessor(
+                input_directory=args.input_dir,
+                rescale=mvtec_2.RESCALE,
+                shape=mvtec_2.SHAPE,
+                color_mode=args.color,
+                preprocessing_function=mvtec_2.PREPROCESSING_FUNCTION,
+                backend=backend,
+                cache=cache,
+            )
+            generators = {
+                "train": preprocessor.get_train_generator(batch_size=args.batch),
+                "validation": preprocessor.get_val_generator(
+                    batch_size=args.batch, shuffle=False
+                ),
+            }
+            for subset, data in generators.items():
+                name = backend + (" (cache)" if cache else "")
+                results[(subset, name)] = benchmark(data, backend, args.nb_batches)
+
+    print("\n{:<12}{:<18}{:>12}".format("subset", "backend", "images/sec"))
+    for (subset, name), images_per_sec in results.items():
+        print("{:<12}{:<18}{:>12.1f}".format(subset, name, images_per_sec))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the backends of Preprocessor.",
+        epilog="Example usage: python3 benchmark_preprocessing.py -d mvtec/capsule -b 8 -n 200",
+    )
+    parser.add_argument(
+        "-d",
+        "--input-dir",
+        type=str,
+        required=True,
+        metavar="",
+        help="directory containing training images",
+    )
+    parser.add_argument(
+        "-c",
+        "--color",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["rgb", "grayscale"],
+        default="grayscale",
+        help="color mode for preprocessing images: 'rgb' or 'grayscale'",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=int,
+        required=False,
+        metavar="",
+        default=8,
+        help="batch size",
+    )
+    parser.add_argument(
+        "-n",
+        "--nb-batches",
+        type=int,
+        required=False,
+        metavar="",
+        default=100,
+        help="number of batches to time per subset and backend",
+    )
+    args = parser.parse_args()
+    main(args)
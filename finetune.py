@@ -1,17 +1,24 @@
 import os
 import argparse
 from pathlib import Path
-import time
 import json
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import tensorflow as tf
 from processing import utils
 from processing import resmaps
+from processing import parallel
+from processing import timing
+from processing import memory_usage
 from processing.preprocessing import Preprocessor
 from processing.preprocessing import get_preprocessing_function
-from processing.resmaps import label_images
+from processing.resmaps import label_areas
+from processing.component_tree import ComponentTreeIndex
+from processing.areas_cache import AreasCache
+from processing import reconstructions
+from processing.reconstructions import ReconstructionStore
+from processing.tiling import TiledInference, TILE_OVERLAP
+from autoencoder.models.rescale import add_rescale_input
 from processing.utils import printProgressBar
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import confusion_matrix
@@ -25,7 +32,9 @@ FINETUNE_SPLIT = 0.2
 STEP_MIN_AREA = 5  # 5
 
 
-def determine_threshold(resmaps, min_area, thresh_min, thresh_max, thresh_step):
+def determine_threshold(
+    resmaps, min_area, thresh_min, thresh_max, thresh_step, cache=None
+):
     # set initial threshold, counter and max number of steps
     n_steps = (thresh_max - thresh_min) // thresh_step + 1
     thresholds = np.arange(
@@ -36,41 +45,338 @@ def determine_threshold(resmaps, min_area, thresh_min, thresh_max, thresh_step):
     printProgressBar(0, n_steps, prefix="Progress:", suffix="Complete", length=50)
 
     for index, threshold in enumerate(thresholds):
-        # segment (threshold) residual maps
-        resmaps_th = resmaps > threshold
-
-        # compute labeled connected components
-        _, areas_all = label_images(resmaps_th)
-
         # check if area of largest anomalous region is below the minimum area
-        areas_all_flat = [item for sublist in areas_all for item in sublist]
-        largest_area = np.amax(np.array(areas_all_flat))
+        largest_area = get_largest_area(resmaps, threshold, cache)
 
         if min_area > largest_area:
-            time.sleep(0.1)
             printProgressBar(
                 n_steps, n_steps, prefix="Progress:", suffix="Complete", length=50
             )
             break
 
         # print progress bar
-        time.sleep(0.1)
         printProgressBar(
             index, n_steps, prefix="Progress:", suffix="Complete", length=50
         )
     return threshold
 
 
+def determine_threshold_incremental(
+    resmaps,
+    min_area,
+    thresh_min,
+    thresh_max,
+    thresh_step,
+    largest_areas=None,
+    cache=None,
+):
+    """
+    Variant of determine_threshold over the same threshold grid, returning
+    the same threshold: the first one at which the largest anomalous region
+    is smaller than min_area, or the last one of the grid if there is none.
+
+    The largest area is not monotone in the threshold (a region touching
+    the border is cleared at low thresholds, while its fragments may count
+    at higher ones), so thresholds cannot be bisected; but the running
+    minimum of the largest areas is monotone. Largest areas are evaluated
+    in grid order into the list largest_areas: the threshold is looked up
+    in the running minimum of the areas evaluated so far, and the linear
+    scan is resumed after them only if none is below min_area. Passing the
+    same list for several min_area values (warm start) evaluates every
+    threshold of the grid at most once.
+
+    Returns the threshold, its index in the grid and the number of
+    evaluated thresholds (calls to label_areas when no cache is used).
+    """
+    thresholds = np.arange(
+        start=thresh_min, stop=thresh_max + thresh_step, step=thresh_step
+    )
+    if largest_areas is None:
+        largest_areas = []
+    n_calls = 0
+
+    # first evaluated threshold with largest area below min_area
+    running_min = np.minimum.accumulate(largest_areas) if largest_areas else []
+    index = np.searchsorted(-np.asarray(running_min), -min_area, side="right")
+    if index < len(largest_areas):
+        return thresholds[index], index, n_calls
+
+    # resume the scan after the evaluated thresholds
+    for index in range(len(largest_areas), len(thresholds)):
+        largest_areas.append(get_largest_area(resmaps, thresholds[index], cache))
+        n_calls += 1
+        if min_area > largest_areas[-1]:
+            return thresholds[index], index, n_calls
+    return thresholds[-1], len(thresholds) - 1, n_calls
+
+
+def determine_thresholds_incremental(
+    resmaps, min_areas, thresh_min, thresh_max, thresh_step, cache=None
+):
+    """
+    Returns the threshold of each min_area (see
+    determine_threshold_incremental) and the number of label_areas calls
+    made.
+    """
+    largest_areas = []
+    thresholds = []
+    n_calls_search = 0
+    for min_area in min_areas:
+        threshold, _, n_calls = determine_threshold_incremental(
+            resmaps=resmaps,
+            min_area=min_area,
+            thresh_min=thresh_min,
+            thresh_max=thresh_max,
+            thresh_step=thresh_step,
+            largest_areas=largest_areas,
+            cache=cache,
+        )
+        thresholds.append(threshold)
+        n_calls_search += n_calls
+    return thresholds, n_calls_search
+
+
+def get_n_calls_linear(thresholds, thresh_min, thresh_step):
+    """
+    Returns the number of label_areas calls of linear searches (see
+    determine_threshold) ending at each of the thresholds of the grid.
+    """
+    indices = np.rint((np.asarray(thresholds) - thresh_min) / thresh_step)
+    return int(np.sum(indices + 1))
+
+
+def determine_thresholds(
+    search, resmaps, min_areas, thresh_min, thresh_max, thresh_step
+):
+    """
+    Returns the threshold of each min_area on the validation resmaps for the
+    tree and incremental searches, or None for the linear search (thresholds
+    are then found during the min_area sweep), and a dictionary counting the
+    label_areas calls of the search and those of a linear search per
+    min_area (None for the linear search).
+    """
+    if search == "tree":
+        # index regions of validation resmaps once for all min_area values
+        with timing.timer("component_tree"):
+            tree_index = ComponentTreeIndex(
+                resmaps=resmaps,
+                thresh_min=thresh_min,
+                thresh_max=thresh_max,
+                thresh_step=thresh_step,
+            )
+            thresholds = [tree_index.determine_threshold(m) for m in min_areas]
+        # the tree labels each resmap once, without label_areas
+        n_calls_search = 0
+    elif search == "incremental":
+        with timing.timer("incremental_search"):
+            thresholds, n_calls_search = determine_thresholds_incremental(
+                resmaps=resmaps,
+                min_areas=min_areas,
+                thresh_min=thresh_min,
+                thresh_max=thresh_max,
+                thresh_step=thresh_step,
+            )
+    else:
+        return None, None
+    stats = {
+        "n_calls_linear": get_n_calls_linear(thresholds, thresh_min, thresh_step),
+        "n_calls_search": n_calls_search,
+    }
+    return thresholds, stats
+
+
+def get_largest_area(resmaps, threshold, cache=None):
+    if cache is not None:
+        return cache.get_areas(resmaps, threshold).largest_area()
+
+    # segment (threshold) residual maps and compute areas of their
+    # connected components, without materialising labeled images
+    region_areas = label_areas(resmaps, threshold)
+
+    # area of largest anomalous region
+    return region_areas.largest_area()
+
+
+def finetune_min_areas(
+    resmaps_val,
+    resmaps_ft,
+    y_ft_true,
+    min_areas,
+    thresh_min,
+    thresh_max,
+    thresh_step,
+    thresholds=None,
+    cache_mb=0,
+    steps=None,
+    nb_steps=None,
+):
+    """
+    Runs the finetuning sweep over min_areas: determines the threshold
+    corresponding to each min_area on the validation resmaps by a linear
+    search (unless precomputed thresholds are passed, e.g. by the tree or
+    incremental searches) and scores the (min_area, threshold) pair on the
+    finetuning resmaps.
+    Returns the finetuning dictionary and a dictionary of counters.
+    """
+    # initialize finetuning dictionary
+    dict_finetune = {
+        "min_area": [],
+        "threshold": [],
+        "TPR": [],
+        "TNR": [],
+        "FPR": [],
+        "FNR": [],
+        "score": [],
+    }
+    stats = {
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "cache_evictions": 0,
+    }
+
+    # cache region areas of labelled resmaps across min_area values
+    if cache_mb > 0:
+        areas_cache = AreasCache(max_bytes=cache_mb * 2 ** 20)
+    else:
+        areas_cache = None
+
+    # position of each min_area in the whole sweep, for printing progress
+    if steps is None:
+        steps = range(len(min_areas))
+    if nb_steps is None:
+        nb_steps = len(min_areas)
+
+    for i, min_area in enumerate(min_areas):
+        print(
+            "step {}/{} | current min_area = {}".format(steps[i] + 1, nb_steps, min_area)
+        )
+        # compute threshold corresponding to current min_area
+        if thresholds is not None:
+            threshold = thresholds[i]
+        else:
+            threshold = determine_threshold(
+                resmaps=resmaps_val,
+                min_area=min_area,
+                thresh_min=thresh_min,
+                thresh_max=thresh_max,
+                thresh_step=thresh_step,
+                cache=areas_cache,
+            )
+
+        # apply the min_area, threshold pair to finetuning images
+        y_ft_pred = predict_classes(
+            resmaps=resmaps_ft,
+            min_area=min_area,
+            threshold=threshold,
+            cache=areas_cache,
+        )
+
+        # confusion matrix
+        tnr, fpr, fnr, tpr = confusion_matrix(
+            y_ft_true, y_ft_pred, normalize="true"
+        ).ravel()
+
+        # record current results
+        dict_finetune["min_area"].append(min_area)
+        dict_finetune["threshold"].append(threshold)
+        dict_finetune["TPR"].append(tpr)
+        dict_finetune["TNR"].append(tnr)
+        dict_finetune["FPR"].append(fpr)
+        dict_finetune["FNR"].append(fnr)
+        dict_finetune["score"].append((tpr + tnr) / 2)
+
+    if areas_cache is not None:
+        stats["cache_hits"] = areas_cache.hits
+        stats["cache_misses"] = areas_cache.misses
+        stats["cache_evictions"] = areas_cache.evictions
+    return dict_finetune, stats
+
+
+def finetune_min_areas_parallel(workers, resmaps_val, resmaps_ft, **sweep_args):
+    """
+    Runs finetune_min_areas over a pool of worker processes. The validation
+    and finetuning resmaps are placed once in shared memory. Worker k takes
+    every workers-th min_area starting at k, and the results are merged back
+    in min_area order. Thresholds are either precomputed by the parent (tree
+    and incremental searches) or found by a linear search per min_area, so
+    the results are the same as those of the serial sweep.
+    """
+    min_areas = sweep_args.pop("min_areas")
+    thresholds = sweep_args.pop("thresholds")
+    shared_val = parallel.SharedArray.from_array(resmaps_val)
+    shared_ft = parallel.SharedArray.from_array(resmaps_ft)
+    try:
+        shards = [
+            np.arange(k, len(min_areas), workers)
+            for k in range(min(workers, len(min_areas)))
+        ]
+        tasks = []
+        for shard in shards:
+            task = dict(sweep_args)
+            task["resmaps_val"] = shared_val
+            task["resmaps_ft"] = shared_ft
+            task["min_areas"] = min_areas[shard]
+            task["thresholds"] = (
+                None if thresholds is None else [thresholds[j] for j in shard]
+            )
+            task["steps"] = shard
+            task["nb_steps"] = len(min_areas)
+            tasks.append(task)
+        with parallel.get_pool(workers) as pool:
+            results = pool.map(finetune_min_areas_shard, tasks)
+    finally:
+        shared_val.close()
+        shared_ft.close()
+
+    # merge results in min_area order
+    dict_finetune = {key: [None] * len(min_areas) for key in results[0][0]}
+    stats = {key: 0 for key in results[0][1]}
+    for shard, (dict_shard, stats_shard) in zip(shards, results):
+        for key, values in dict_shard.items():
+            for j, value in zip(shard, values):
+                dict_finetune[key][j] = value
+        for key, value in stats_shard.items():
+            stats[key] += value
+    return dict_finetune, stats
+
+
+def finetune_min_areas_shard(task):
+    shared_val = task.pop("resmaps_val")
+    shared_ft = task.pop("resmaps_ft")
+    try:
+        return finetune_min_areas(
+            resmaps_val=shared_val.array, resmaps_ft=shared_ft.array, **task
+        )
+    finally:
+        shared_val.close()
+        shared_ft.close()
+
+
 def main(args):
     # Get validation arguments
     model_path = args.path
     method = args.method
     dtype = args.dtype
+    workers = args.workers
+    search = args.search
+    cache_mb = args.cache
+    backend = args.backend
+    input_dtype = args.input_dtype
+    tiled = args.tiled
+    overlap = args.overlap
+    timings = args.timings
+    memory_report = args.memory_report
+
+    if timings:
+        timing.enable()
+    if memory_report:
+        memory_usage.enable()
 
     # ============= LOAD MODEL AND PREPROCESSING CONFIGURATION ================
 
-    # load model and info
-    model, info, _ = utils.load_model_HDF5(model_path)
+    # load model (for inference only) and info
+    memory_usage.set_stage("load_model")
+    model, info = utils.load_model_inference(model_path)
     # set parameters
     input_directory = info["data"]["input_directory"]
     architecture = info["model"]["architecture"]
@@ -82,9 +388,16 @@ def main(args):
     vmax = info["preprocessing"]["vmax"]
     nb_validation_images = info["data"]["nb_validation_images"]
 
+    # uint8 images are rescaled by the model
+    if input_dtype == "uint8":
+        model = add_rescale_input(model, rescale)
+
     # get the correct preprocessing function
     preprocessing_function = get_preprocessing_function(architecture)
 
+    # store of reconstructions shared with train.py --inspect and test.py
+    store = None if args.no_store else ReconstructionStore(model_path)
+
     # ========= LOAD AND PREPROCESS VALIDATION & FINETUNING IMAGES =============
 
     # initialize preprocessor
@@ -94,61 +407,93 @@ def main(args):
         shape=shape,
         color_mode=color_mode,
         preprocessing_function=preprocessing_function,
+        backend=backend,
+        input_dtype=input_dtype,
     )
 
     # -------------------------------------------------------------------
 
     # get validation generator
+    memory_usage.set_stage("validation")
     validation_generator = preprocessor.get_val_generator(
         batch_size=nb_validation_images, shuffle=False
     )
 
-    # retrieve preprocessed validation images from generator
-    imgs_val_input = validation_generator.next()[0]
-
     # retrieve validation image_names
     filenames_val = validation_generator.filenames
 
-    # reconstruct (i.e predict) validation images
-    imgs_val_pred = model.predict(imgs_val_input)
-
-    # convert to grayscale if RGB
-    if color_mode == "rgb":
-        imgs_val_input = tf.image.rgb_to_grayscale(imgs_val_input).numpy()
-        imgs_val_pred = tf.image.rgb_to_grayscale(imgs_val_pred).numpy()
-
-    # remove last channel since images are grayscale
-    imgs_val_input = imgs_val_input[:, :, :, 0]
-    imgs_val_pred = imgs_val_pred[:, :, :, 0]
-
-    # instantiate TensorImages object to compute validation resmaps
-    tensor_val = resmaps.TensorImages(
-        imgs_input=imgs_val_input,
-        imgs_pred=imgs_val_pred,
-        vmin=vmin,
-        vmax=vmax,
-        method=method,
-        dtype=dtype,
-        filenames=filenames_val,
-    )
+    if tiled:
+        # compute full resolution resmaps of validation images, tile by tile
+        tiled_inference = TiledInference(
+            model=model,
+            color_mode=color_mode,
+            method=method,
+            dtype=dtype,
+            rescale=preprocessor.rescale,
+            preprocessing_function=preprocessor.preprocessing_function,
+            input_dtype=input_dtype,
+            overlap=overlap,
+        )
+        resmaps_val = tiled_inference.calculate_resmaps(
+            validation_generator.directory, filenames_val
+        )
+    else:
+        # retrieve preprocessed validation images from generator
+        with timing.timer("load_images"):
+            imgs_val_input = validation_generator.next()[0]
+        timing.count("images_loaded", len(imgs_val_input))
+
+        # reconstruct (i.e predict) validation images
+        imgs_val_pred = reconstructions.predict(
+            store,
+            model,
+            imgs_val_input,
+            group="validation",
+            directory=validation_generator.directory,
+            filenames=filenames_val,
+        )
+        memory_usage.record_arrays(
+            imgs_val_input=imgs_val_input, imgs_val_pred=imgs_val_pred
+        )
+
+        # convert to grayscale if RGB
+        if color_mode == "rgb":
+            imgs_val_input = resmaps.rgb_to_grayscale(imgs_val_input)
+            imgs_val_pred = resmaps.rgb_to_grayscale(imgs_val_pred)
+
+        # remove last channel since images are grayscale
+        imgs_val_input = imgs_val_input[:, :, :, 0]
+        imgs_val_pred = imgs_val_pred[:, :, :, 0]
+
+        # instantiate TensorImages object to compute validation resmaps
+        tensor_val = resmaps.TensorImages(
+            imgs_input=imgs_val_input,
+            imgs_pred=imgs_val_pred,
+            vmin=vmin,
+            vmax=vmax,
+            method=method,
+            dtype=dtype,
+            filenames=filenames_val,
+            workers=workers,
+        )
+        resmaps_val = tensor_val.resmaps
+    memory_usage.record_array("resmaps_val", resmaps_val)
 
     # -------------------------------------------------------------------
 
     # get finetuning generator
+    memory_usage.set_stage("finetuning")
     nb_test_images = preprocessor.get_total_number_test_images()
 
     finetuning_generator = preprocessor.get_finetuning_generator(
         batch_size=nb_test_images, shuffle=False
     )
-
-    # retrieve preprocessed test images from generator
-    imgs_test_input = finetuning_generator.next()[0]
     filenames_test = finetuning_generator.filenames
 
     # select a representative subset of test images for finetuning
-    #  using stratified sampling
+    #  using stratified sampling (images are in the order of the generator)
     assert "good" in finetuning_generator.class_indices
-    index_array = finetuning_generator.index_array
+    index_array = np.arange(len(filenames_test))
     classes = finetuning_generator.classes
     _, index_array_ft, _, classes_ft = train_test_split(
         index_array,
@@ -165,78 +510,138 @@ def main(args):
     )
 
     # select test images for finetuninig
-    imgs_ft_input = imgs_test_input[index_array_ft]
     filenames_ft = list(np.array(filenames_test)[index_array_ft])
 
-    # reconstruct (i.e predict) finetuning images
-    imgs_ft_pred = model.predict(imgs_ft_input)
-
-    # convert to grayscale if RGB
-    if color_mode == "rgb":
-        imgs_ft_input = tf.image.rgb_to_grayscale(imgs_ft_input).numpy()
-        imgs_ft_pred = tf.image.rgb_to_grayscale(imgs_ft_pred).numpy()
-
-    # remove last channel since images are grayscale
-    imgs_ft_input = imgs_ft_input[:, :, :, 0]
-    imgs_ft_pred = imgs_ft_pred[:, :, :, 0]
-
-    # instantiate TensorImages object to compute finetuning resmaps
-    tensor_ft = resmaps.TensorImages(
-        imgs_input=imgs_ft_input,
-        imgs_pred=imgs_ft_pred,
-        vmin=vmin,
-        vmax=vmax,
-        method=method,
-        dtype=dtype,
-        filenames=filenames_ft,
-    )
+    if tiled:
+        # compute full resolution resmaps of finetuning images, tile by tile
+        resmaps_ft = tiled_inference.calculate_resmaps(
+            finetuning_generator.directory, filenames_ft
+        )
+    else:
+        # retrieve preprocessed test images from generator
+        with timing.timer("load_images"):
+            imgs_test_input = finetuning_generator.next()[0]
+        timing.count("images_loaded", len(imgs_test_input))
+        imgs_ft_input = imgs_test_input[index_array_ft]
+
+        # select stored reconstructions of the test set (e.g. of test.py)
+        # if any, else reconstruct (i.e predict) finetuning images only
+        imgs_test_stored = None
+        if store is not None:
+            imgs_test_stored = store.load(
+                "test", finetuning_generator.directory, filenames_test
+            )
+        if imgs_test_stored is not None:
+            imgs_ft_pred = imgs_test_stored[index_array_ft]
+            timing.count("reconstructions_reused", len(imgs_ft_pred))
+        else:
+            imgs_ft_pred = reconstructions.predict(
+                store,
+                model,
+                imgs_ft_input,
+                group="finetuning",
+                directory=finetuning_generator.directory,
+                filenames=filenames_ft,
+            )
+        memory_usage.record_arrays(
+            imgs_test_input=imgs_test_input,
+            imgs_ft_input=imgs_ft_input,
+            imgs_ft_pred=imgs_ft_pred,
+        )
+
+        # convert to grayscale if RGB
+        if color_mode == "rgb":
+            imgs_ft_input = resmaps.rgb_to_grayscale(imgs_ft_input)
+            imgs_ft_pred = resmaps.rgb_to_grayscale(imgs_ft_pred)
+
+        # remove last channel since images are grayscale
+        imgs_ft_input = imgs_ft_input[:, :, :, 0]
+        imgs_ft_pred = imgs_ft_pred[:, :, :, 0]
+
+        # instantiate TensorImages object to compute finetuning resmaps
+        tensor_ft = resmaps.TensorImages(
+            imgs_input=imgs_ft_input,
+            imgs_pred=imgs_ft_pred,
+            vmin=vmin,
+            vmax=vmax,
+            method=method,
+            dtype=dtype,
+            filenames=filenames_ft,
+            workers=workers,
+        )
+        resmaps_ft = tensor_ft.resmaps
+    memory_usage.record_array("resmaps_ft", resmaps_ft)
 
     # ======================== COMPUTE THRESHOLDS ===========================
 
-    # initialize finetuning dictionary
-    dict_finetune = {
-        "min_area": [],
-        "threshold": [],
-        "TPR": [],
-        "TNR": [],
-        "FPR": [],
-        "FNR": [],
-        "score": [],
-    }
+    # threshold grid of validation resmaps
+    memory_usage.set_stage("thresholds")
+    thresh_min, thresh_step = resmaps.get_thresh_parameters(method, dtype)
+    thresh_max = np.amax(resmaps_val).item()
 
     # create discrete min_area values
     min_areas = np.arange(start=5, stop=505, step=STEP_MIN_AREA)
-    length = len(min_areas)
-
-    for i, min_area in enumerate(min_areas):
-        print("step {}/{} | current min_area = {}".format(i + 1, length, min_area))
-        # compute threshold corresponding to current min_area
-        threshold = determine_threshold(
-            resmaps=tensor_val.resmaps,
-            min_area=min_area,
-            thresh_min=tensor_val.thresh_min,
-            thresh_max=tensor_val.thresh_max,
-            thresh_step=tensor_val.thresh_step,
+    if tiled:
+        # scale min_area values to the full resolution of the images
+        area_scale = tiled_inference.get_area_scale(
+            validation_generator.directory, filenames_val[0]
         )
+        min_areas = np.round(min_areas * area_scale).astype(int)
 
-        # apply the min_area, threshold pair to finetuning images
-        y_ft_pred = predict_classes(
-            resmaps=tensor_ft.resmaps, min_area=min_area, threshold=threshold
-        )
+    # thresholds of all min_area values computed at once (tree and
+    # incremental searches), so that the sweep gives the same results
+    # whatever the number of workers
+    thresholds, search_stats = determine_thresholds(
+        search, resmaps_val, min_areas, thresh_min, thresh_max, thresh_step
+    )
 
-        # confusion matrix
-        tnr, fpr, fnr, tpr = confusion_matrix(
-            y_ft_true, y_ft_pred, normalize="true"
-        ).ravel()
+    memory_usage.set_stage("min_area_sweep")
+    sweep_args = {
+        "resmaps_val": resmaps_val,
+        "resmaps_ft": resmaps_ft,
+        "y_ft_true": y_ft_true,
+        "min_areas": min_areas,
+        "thresh_min": thresh_min,
+        "thresh_max": thresh_max,
+        "thresh_step": thresh_step,
+        "thresholds": thresholds,
+        "cache_mb": cache_mb,
+    }
+    with timing.timer("finetune_min_areas"):
+        if parallel.get_workers(workers) > 1:
+            dict_finetune, stats = finetune_min_areas_parallel(
+                workers=workers, **sweep_args
+            )
+        else:
+            dict_finetune, stats = finetune_min_areas(**sweep_args)
 
-        # record current results
-        dict_finetune["min_area"].append(min_area)
-        dict_finetune["threshold"].append(threshold)
-        dict_finetune["TPR"].append(tpr)
-        dict_finetune["TNR"].append(tnr)
-        dict_finetune["FPR"].append(fpr)
-        dict_finetune["FNR"].append(fnr)
-        dict_finetune["score"].append((tpr + tnr) / 2)
+    if cache_mb > 0:
+        logger.info(
+            "areas cache: {} hits, {} misses, {} evictions.".format(
+                stats["cache_hits"], stats["cache_misses"], stats["cache_evictions"]
+            )
+        )
+
+    # label_areas calls saved by the search over a linear search per min_area
+    if search_stats is None:
+        n_calls_linear = get_n_calls_linear(
+            dict_finetune["threshold"], thresh_min, thresh_step
+        )
+        search_stats = {
+            "n_calls_linear": n_calls_linear,
+            "n_calls_search": n_calls_linear,
+        }
+    search_stats["n_calls_saved"] = (
+        search_stats["n_calls_linear"] - search_stats["n_calls_search"]
+    )
+    logger.info(
+        "{} search: {} label_areas calls instead of {} ({} saved).".format(
+            search,
+            search_stats["n_calls_search"],
+            search_stats["n_calls_linear"],
+            search_stats["n_calls_saved"],
+        )
+    )
 
     # get min_area, threshold pair corresponding to best score
     max_score_i = np.argmax(dict_finetune["score"])
@@ -245,6 +650,7 @@ def main(args):
     best_threshold = float(dict_finetune["threshold"][max_score_i])
 
     # ===================== SAVE VALIDATION RESULTS ========================
+    memory_usage.set_stage("save")
 
     # create a results directory if not existent
     model_dir_name = os.path.basename(str(Path(model_path).parent))
@@ -257,7 +663,7 @@ def main(args):
         loss,
         model_dir_name,
         "finetuning",
-        "{}_{}".format(method, dtype),
+        "{}_{}".format(method, dtype) + ("_tiled" if tiled else ""),
     )
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
@@ -270,6 +676,12 @@ def main(args):
         "method": method,
         "dtype": dtype,
         "split": FINETUNE_SPLIT,
+        "tiled": tiled,
+        "overlap": overlap,
+        "search": search,
+        "n_calls_linear": search_stats["n_calls_linear"],
+        "n_calls_search": search_stats["n_calls_search"],
+        "n_calls_saved": search_stats["n_calls_saved"],
     }
     print("finetuning results: {}".format(finetuning_result))
 
@@ -282,9 +694,20 @@ def main(args):
     plot_min_area_threshold(dict_finetune, index_best=max_score_i, save_dir=save_dir)
     plot_scores(dict_finetune, index_best=max_score_i, save_dir=save_dir)
 
+    # save timings of the stages of the run
+    if timings:
+        report = timing.save_report(os.path.join(save_dir, "timings.json"))
+        logger.info("timings:\n{}".format(timing.format_report(report)))
+
+    # save memory usage of the stages of the run
+    if memory_report:
+        report = memory_usage.save_report(os.path.join(save_dir, "memory_report.json"))
+        logger.info("memory usage:\n{}".format(memory_usage.format_report(report)))
+
     return
 
 
+@timing.timed("plot_min_area_threshold")
 def plot_min_area_threshold(dict_finetune, index_best=None, save_dir=None):
     df_finetune = pd.DataFrame.from_dict(dict_finetune)
     min_areas = dict_finetune["min_area"]
@@ -310,6 +733,7 @@ def plot_min_area_threshold(dict_finetune, index_best=None, save_dir=None):
     return
 
 
+@timing.timed("plot_scores")
 def plot_scores(dict_finetune, index_best=None, save_dir=None):
     df_finetune = pd.DataFrame.from_dict(dict_finetune)
     with plt.style.context("seaborn-darkgrid"):
@@ -353,9 +777,92 @@ if __name__ == "__main__":
         "--dtype",
         required=False,
         metavar="",
-        choices=["float64", "uint8"],
+        choices=["float64", "float32", "float16", "uint8"],
         default="float64",
-        help="datatype for processing resmaps: 'float64' or 'uint8'",
+        help="datatype for processing resmaps: 'float64', 'float32', 'float16' or 'uint8'",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        required=False,
+        metavar="",
+        default=1,
+        help="number of worker processes for computing resmaps and the min_area sweep",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--search",
+        required=False,
+        metavar="",
+        choices=["linear", "incremental", "tree"],
+        default="tree",
+        help="threshold search: 'linear' per min_area, 'incremental' (linear scan shared by all min_area values) or precomputed component 'tree' index",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--cache",
+        type=int,
+        required=False,
+        metavar="",
+        default=256,
+        help="memory cap in MB of the cache of labelled region areas (0 disables it)",
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["keras", "tfdata", "memmap"],
+        default="keras",
+        help="backend for loading images: 'keras' (ImageDataGenerator), 'tfdata' or 'memmap' (cache of decoded images)",
+    )
+
+    parser.add_argument(
+        "--input-dtype",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["float32", "uint8"],
+        default="float32",
+        help="datatype of the loaded images: 'float32' or 'uint8' (rescaled by the model, 4x less memory)",
+    )
+
+    parser.add_argument(
+        "--tiled",
+        action="store_true",
+        help="compute resmaps at full resolution from overlapping tiles of the model input shape",
+    )
+
+    parser.add_argument(
+        "--overlap",
+        type=int,
+        required=False,
+        metavar="",
+        default=TILE_OVERLAP,
+        help="minimal overlap in pixels between neighbouring tiles (tiled mode)",
+    )
+
+    parser.add_argument(
+        "--no-store",
+        action="store_true",
+        help="do not reuse nor save reconstructions in the reconstructions directory of the model",
+    )
+
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="record timings and counters of the stages of the run in timings.json",
+    )
+
+    parser.add_argument(
+        "--memory-report",
+        action="store_true",
+        help="record peak RSS and array sizes of the stages of the run in memory_report.json",
     )
 
     args = parser.parse_args()
@@ -365,6 +872,7 @@ if __name__ == "__main__":
 # Example of command to initiate finetuning with different resmap processing arguments (best combination: -m ssim -t float64)
 
 # python3 finetune.py -p saved_models/mvtec/capsule/mvtec2/ssim/13-06-2020_15-35-10/CAE_mvtec2_b8_e39.hdf5 -m ssim -t float64
+# python3 finetune.py -p saved_models/mvtec/capsule/mvtec2/ssim/13-06-2020_15-35-10/CAE_mvtec2_b8_e39.hdf5 -m ssim -t float32
 # python3 finetune.py -p saved_models/mvtec/capsule/mvtec2/ssim/13-06-2020_15-35-10/CAE_mvtec2_b8_e39.hdf5 -m ssim -t uint8
 # python3 finetune.py -p saved_models/mvtec/capsule/mvtec2/ssim/13-06-2020_15-35-10/CAE_mvtec2_b8_e39.hdf5 -m l2 -t float64
 # python3 finetune.py -p saved_models/mvtec/capsule/mvtec2/ssim/13-06-2020_15-35-10/CAE_mvtec2_b8_e39.hdf5 -m l2 -t uint8
@@ -0,0 +1,602 @@
+"""
+Runs train.py, finetune.py and test.py on several categories (dataset
+directories) and architectures as a graph of jobs executed by a local pool
+of worker processes, and prints a summary table of the results.
+
+Each (category, architecture) pair is a chain of jobs train -> finetune ->
+test; independent chains run concurrently. Every job is a subprocess limited
+to a number of CPU threads (through the thread pool variables of
+TensorFlow, OpenMP, BLAS and OpenCV) and to a memory budget (the resident
+memory of its process group is polled and the job is killed beyond its
+budget). Jobs are started only while their threads fit the available cores
+and their memory budgets fit the available memory, so that concurrent jobs
+never oversubscribe the machine. Failed jobs are retried, and jobs depending
+on a job that failed for good are skipped.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import signal
+import datetime
+import argparse
+import subprocess
+import pandas as pd
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGES = ["train", "finetune", "test"]
+
+# environment variables limiting the thread pools of the libraries of a job
+THREAD_VARIABLES = [
+    "TF_NUM_INTRAOP_THREADS",
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "OPENCV_FOR_THREADS_NUM",
+]
+
+# seconds between two polls of the running jobs
+POLL_INTERVAL = 1.0
+
+
+class Job:
+    """
+    A stage of the pipeline of a category and an architecture, run as a
+    subprocess. The model path is resolved by the train job (or found among
+    the saved models) and shared with the finetune and test jobs of the
+    same chain.
+    """
+
+    def __init__(self, stage, chain, depends_on=None):
+        self.stage = stage
+        self.chain = chain
+        self.depends_on = depends_on
+        self.status = "pending"
+        self.attempts = 0
+        self.returncode = None
+        self.duration = 0.0
+        self.peak_rss = 0
+        self.log_path = None
+        self.process = None
+        self.start_time = None
+        self.log_file = None
+
+    @property
+    def name(self):
+        return "{}/{}/{}".format(
+            self.chain["category"], self.chain["architecture"], self.stage
+        )
+
+
+def get_command(job, args):
+    """Returns the command line of job."""
+    chain = job.chain
+    if job.stage == "train":
+        command = [
+            "train.py",
+            "-d",
+            chain["category"],
+            "-a",
+            chain["architecture"],
+            "-c",
+            args.color,
+            "-l",
+            args.loss,
+            "-b",
+            str(args.batch),
+            "--backend",
+            args.backend,
+        ]
+        if args.inspect:
+            command.append("--inspect")
+    elif job.stage == "finetune":
+        command = [
+            "finetune.py",
+            "-p",
+            chain["model_path"],
+            "-m",
+            get_method(args.loss),
+            "-t",
+            args.dtype,
+            "--backend",
+            args.backend,
+            "--input-dtype",
+            args.input_dtype,
+        ]
+    else:
+        command = [
+            "test.py",
+            "-p",
+            chain["model_path"],
+            "--backend",
+            args.backend,
+            "--input-dtype",
+            args.input_dtype,
+        ]
+    if args.no_store:
+        command.append("--no-store")
+    return [sys.executable] + command
+
+
+def get_method(loss):
+    """Returns the method for generating resmaps matching the training loss."""
+    if loss == "l2":
+        return "l2"
+    return "ssim"
+
+
+def get_environment(threads):
+    """Returns the environment of a job limited to threads CPU threads."""
+    env = dict(os.environ)
+    for variable in THREAD_VARIABLES:
+        env[variable] = str(threads)
+    env["TF_NUM_INTEROP_THREADS"] = "1"
+    # plots are saved to disk, never shown
+    env["MPLBACKEND"] = "Agg"
+    return env
+
+
+def find_model_path(category, architecture, loss, since=0):
+    """
+    Returns the path of the most recent model saved by train.py for
+    category and architecture (modified after since), or None.
+    """
+    pattern = os.path.join(
+        os.getcwd(), "saved_models", category, architecture, loss, "*", "CAE_*.hdf5"
+    )
+    paths = [path for path in glob.glob(pattern) if os.path.getmtime(path) >= since]
+    if not paths:
+        return None
+    return max(paths, key=os.path.getmtime)
+
+
+def get_total_memory():
+    """Returns the physical memory of the machine in MB."""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2 ** 20
+
+
+def get_group_rss(pgid):
+    """
+    Returns the resident memory in MB of the processes of the process group
+    pgid (a job and the worker processes it spawned), read from /proc.
+    """
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    rss = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", pid, "stat"), "r") as f:
+                # fields following the command name, which may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[2]) == pgid:
+            rss += int(fields[21]) * page_size
+    return rss / 2 ** 20
+
+
+class Scheduler:
+    """
+    Runs jobs as subprocesses, at most as many at once as fit in cores CPU
+    threads and memory MB, each job taking threads threads and
+    job_memory MB. Jobs whose dependency has not succeeded yet wait, and
+    are skipped if it failed for good.
+    """
+
+    def __init__(
+        self, jobs, args, cores, memory, threads, job_memory, retries, log_dir
+    ):
+        if threads > cores:
+            raise ValueError("threads per job must not exceed the number of cores")
+        if job_memory > memory:
+            raise ValueError("memory per job must not exceed the memory budget")
+        self.jobs = jobs
+        self.args = args
+        self.cores = cores
+        self.memory = memory
+        self.threads = threads
+        self.job_memory = job_memory
+        self.retries = retries
+        self.log_dir = log_dir
+        self.watch_memory = os.path.isdir("/proc")
+        if not self.watch_memory:
+            logger.warning("/proc is not available, job memory is not enforced.")
+
+    def run(self):
+        running = []
+        while True:
+            for job in self.jobs:
+                if job.status == "pending" and job.depends_on is not None:
+                    if job.depends_on.status in ["failed", "skipped"]:
+                        job.status = "skipped"
+                        logger.info("{} skipped.".format(job.name))
+
+            # start ready jobs while they fit the cores and the memory,
+            # finishing the chains already started first
+            ready = [
+                job
+                for job in self.jobs
+                if job.status == "pending"
+                and (job.depends_on is None or job.depends_on.status == "succeeded")
+            ]
+            ready.sort(key=lambda job: -STAGES.index(job.stage))
+            for job in ready:
+                if (len(running) + 1) * self.threads > self.cores:
+                    break
+                if (len(running) + 1) * self.job_memory > self.memory:
+                    break
+                self.start(job)
+                running.append(job)
+
+            if not running:
+                break
+            time.sleep(POLL_INTERVAL)
+            for job in list(running):
+                if self.poll(job):
+                    running.remove(job)
+        return self.jobs
+
+    def start(self, job):
+        if job.stage == "train":
+            job.chain["train_start"] = time.time()
+        elif job.chain["model_path"] is None:
+            job.chain["model_path"] = find_model_path(
+                job.chain["category"], job.chain["architecture"], self.args.loss
+            )
+            if job.chain["model_path"] is None:
+                logger.warning("{}: no saved model found.".format(job.name))
+                job.status = "failed"
+                return
+        job.attempts += 1
+        job.status = "running"
+        job.log_path = os.path.join(
+            self.log_dir, "{}_{}.log".format(job.name.replace("/", "_"), job.attempts),
+        )
+        job.log_file = open(job.log_path, "w")
+        job.start_time = time.time()
+        job.process = subprocess.Popen(
+            get_command(job, self.args),
+            stdout=job.log_file,
+            stderr=subprocess.STDOUT,
+            env=get_environment(self.threads),
+            start_new_session=True,
+        )
+        logger.info(
+            "{} started (attempt {}), logging to {}".format(
+                job.name, job.attempts, job.log_path
+            )
+        )
+
+    def poll(self, job):
+        """Updates job and returns True once it has finished."""
+        if job.status != "running":
+            return True
+        killed = False
+        if self.watch_memory:
+            rss = get_group_rss(job.process.pid)
+            job.peak_rss = max(job.peak_rss, rss)
+            if rss > self.job_memory and job.process.poll() is None:
+                logger.warning(
+                    "{} exceeded its memory budget ({:.0f} MB), killing it.".format(
+                        job.name, rss
+                    )
+                )
+                os.killpg(job.process.pid, signal.SIGKILL)
+                killed = True
+        returncode = job.process.wait() if killed else job.process.poll()
+        if returncode is None:
+            return False
+        job.returncode = returncode
+        job.duration += time.time() - job.start_time
+        job.log_file.close()
+
+        if returncode == 0 and job.stage == "train":
+            job.chain["model_path"] = find_model_path(
+                job.chain["category"],
+                job.chain["architecture"],
+                self.args.loss,
+                since=job.chain["train_start"],
+            )
+            if job.chain["model_path"] is None:
+                logger.warning("{}: no model was saved.".format(job.name))
+                returncode = 1
+
+        if returncode == 0:
+            job.status = "succeeded"
+            logger.info("{} succeeded in {:.0f}s.".format(job.name, job.duration))
+        elif job.attempts <= self.retries:
+            job.status = "pending"
+            logger.warning(
+                "{} failed ({}), retrying.".format(
+                    job.name, "memory" if killed else "exit code {}".format(returncode)
+                )
+            )
+        else:
+            job.status = "failed"
+            logger.warning("{} failed, see {}".format(job.name, job.log_path))
+        return True
+
+
+def read_results(chain, args):
+    """Returns the finetuning and test results of a chain, if available."""
+    results = {}
+    if chain["model_path"] is None:
+        return results
+    model_dir = os.path.dirname(chain["model_path"])
+    info_path = os.path.join(model_dir, "info.json")
+    if not os.path.isfile(info_path):
+        return results
+    with open(info_path, "r") as read_file:
+        input_directory = json.load(read_file)["data"]["input_directory"]
+    result_dir = os.path.join(
+        os.getcwd(),
+        "results",
+        input_directory,
+        chain["architecture"],
+        args.loss,
+        os.path.basename(model_dir),
+    )
+    subdir = "{}_{}".format(get_method(args.loss), args.dtype)
+    for stage, filename in [
+        ("finetuning", "finetuning_result.json"),
+        ("test", "test_result.json"),
+    ]:
+        path = os.path.join(result_dir, stage, subdir, filename)
+        if os.path.isfile(path):
+            with open(path, "r") as read_file:
+                results.update(json.load(read_file))
+    return results
+
+
+def get_summary(jobs, chains, args):
+    """Returns the summary table of the chains and the table of the jobs."""
+    rows = []
+    for chain in chains:
+        chain_jobs = {job.stage: job for job in jobs if job.chain is chain}
+        results = read_results(chain, args)
+        row = {"category": chain["category"], "architecture": chain["architecture"]}
+        for stage, job in chain_jobs.items():
+            row[stage] = job.status
+        row.update(
+            {
+                "time (s)": round(sum(job.duration for job in chain_jobs.values())),
+                "min_area": results.get("min_area"),
+                "threshold": results.get("threshold"),
+                "TPR": results.get("TPR"),
+                "TNR": results.get("TNR"),
+                "score": results.get("score"),
+            }
+        )
+        rows.append(row)
+    df_summary = pd.DataFrame(rows)
+    df_jobs = pd.DataFrame(
+        [
+            {
+                "job": job.name,
+                "status": job.status,
+                "attempts": job.attempts,
+                "returncode": job.returncode,
+                "time (s)": round(job.duration, 1),
+                "peak RSS (MB)": round(job.peak_rss),
+                "log": job.log_path,
+            }
+            for job in jobs
+        ]
+    )
+    return df_summary, df_jobs
+
+
+def main(args):
+    stages = [stage for stage in STAGES if stage in args.stages]
+
+    # build the job graph: one chain of stages per category and architecture
+    chains = []
+    jobs = []
+    for category in args.categories:
+        for architecture in args.architectures:
+            chain = {
+                "category": category.rstrip("/"),
+                "architecture": architecture,
+                "model_path": None,
+            }
+            chains.append(chain)
+            previous = None
+            for stage in stages:
+                job = Job(stage, chain, depends_on=previous)
+                jobs.append(job)
+                previous = job
+
+    # create a directory for the logs and the summary of this run
+    now = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+    log_dir = os.path.join(os.getcwd(), "results", "pipeline", now)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    cores = args.cores or os.cpu_count()
+    memory = args.total_memory or get_total_memory()
+    logger.info(
+        "running {} jobs, {} at once ({} cores, {} MB).".format(
+            len(jobs), min(cores // args.threads, memory // args.memory), cores, memory,
+        )
+    )
+    scheduler = Scheduler(
+        jobs,
+        args,
+        cores=cores,
+        memory=memory,
+        threads=args.threads,
+        job_memory=args.memory,
+        retries=args.retries,
+        log_dir=log_dir,
+    )
+    scheduler.run()
+
+    # print and save the summary
+    df_summary, df_jobs = get_summary(jobs, chains, args)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None):
+        print(df_summary.to_string(index=False))
+        print(df_jobs.to_string(index=False))
+    df_summary.to_csv(os.path.join(log_dir, "summary.csv"), index=False)
+    df_jobs.to_csv(os.path.join(log_dir, "jobs.csv"), index=False)
+    logger.info("summary saved at {}".format(log_dir))
+
+    if any(job.status != "succeeded" for job in jobs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Train, finetune and test AutoEncoders on several categories concurrently.",
+        epilog="Example usage: python3 pipeline.py -d mvtec/capsule mvtec/screw -a mvtec2 baselineCAE -t 2 -m 4000",
+    )
+    parser.add_argument(
+        "-d",
+        "--categories",
+        type=str,
+        nargs="+",
+        required=True,
+        metavar="",
+        help="directories of the categories (relative to the working directory)",
+    )
+    parser.add_argument(
+        "-a",
+        "--architectures",
+        type=str,
+        nargs="+",
+        required=False,
+        metavar="",
+        choices=["mvtec", "mvtec2", "baselineCAE", "inceptionCAE", "resnetCAE"],
+        default=["mvtec2"],
+        help="architectures of the models to train",
+    )
+    parser.add_argument(
+        "-s",
+        "--stages",
+        type=str,
+        nargs="+",
+        required=False,
+        metavar="",
+        choices=STAGES,
+        default=STAGES,
+        help="stages to run: 'train', 'finetune', 'test' (without train, the latest saved models are used)",
+    )
+    parser.add_argument(
+        "-c",
+        "--color",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["rgb", "grayscale"],
+        default="grayscale",
+        help="color mode for preprocessing images: 'rgb' or 'grayscale'",
+    )
+    parser.add_argument(
+        "-l",
+        "--loss",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["mssim", "ssim", "l2"],
+        default="ssim",
+        help="loss function to use for training: 'mssim', 'ssim' or 'l2'",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=int,
+        required=False,
+        metavar="",
+        default=8,
+        help="batch size to use for training",
+    )
+    parser.add_argument(
+        "--dtype",
+        required=False,
+        metavar="",
+        choices=["float64", "float32", "float16", "uint8"],
+        default="float64",
+        help="datatype for processing resmaps: 'float64', 'float32', 'float16' or 'uint8'",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["keras", "tfdata", "memmap"],
+        default="keras",
+        help="backend for loading images: 'keras' (ImageDataGenerator), 'tfdata' or 'memmap' (cache of decoded images)",
+    )
+    parser.add_argument(
+        "--input-dtype",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["float32", "uint8"],
+        default="float32",
+        help="datatype of the loaded images for finetuning and testing: 'float32' or 'uint8'",
+    )
+    parser.add_argument(
+        "-i",
+        "--inspect",
+        action="store_true",
+        help="generate inspection plots after training",
+    )
+    parser.add_argument(
+        "--no-store",
+        action="store_true",
+        help="do not store reconstructions next to the models",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        required=False,
+        metavar="",
+        default=1,
+        help="number of CPU threads of each job",
+    )
+    parser.add_argument(
+        "-m",
+        "--memory",
+        type=int,
+        required=False,
+        metavar="",
+        default=4000,
+        help="memory budget in MB of each job, which is killed beyond it",
+    )
+    parser.add_argument(
+        "--cores",
+        type=int,
+        required=False,
+        metavar="",
+        default=None,
+        help="number of cores to use (default: all the cores of the machine)",
+    )
+    parser.add_argument(
+        "--total-memory",
+        type=int,
+        required=False,
+        metavar="",
+        default=None,
+        help="memory in MB to use (default: the physical memory of the machine)",
+    )
+    parser.add_argument(
+        "-r",
+        "--retries",
+        type=int,
+        required=False,
+        metavar="",
+        default=1,
+        help="number of retries of a failed job",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,75 @@
+import weakref
+from collections import OrderedDict
+from processing.resmaps import label_areas
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# default memory cap of the cache (in bytes)
+AREAS_CACHE_MAX_BYTES = 256 * 2 ** 20
+
+
+class AreasCache:
+    """
+    LRU cache of the region areas obtained by thresholding and labelling a
+    set of resmaps, keyed by (resmaps id, threshold). Entries are stored as
+    compact RegionAreas and evicted, least recently used first, once their
+    total size exceeds max_bytes.
+
+    A resmap set is identified by the array object passed to get_areas,
+    its entries are dropped when the array is garbage collected.
+    """
+
+    def __init__(self, max_bytes=AREAS_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.tracked_ids = set()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_areas(self, resmaps, threshold):
+        key = (self.get_resmaps_id(resmaps), float(threshold))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        region_areas = label_areas(resmaps, threshold)
+        self.put(key, region_areas)
+        return region_areas
+
+    def put(self, key, region_areas):
+        if region_areas.nbytes > self.max_bytes:
+            return
+        self.entries[key] = region_areas
+        self.nbytes += region_areas.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def get_resmaps_id(self, resmaps):
+        resmaps_id = id(resmaps)
+        if resmaps_id not in self.tracked_ids:
+            # the id may be reused once resmaps is freed, drop its entries
+            self.tracked_ids.add(resmaps_id)
+            weakref.finalize(resmaps, self.drop, resmaps_id)
+        return resmaps_id
+
+    def drop(self, resmaps_id):
+        for key in [key for key in self.entries if key[0] == resmaps_id]:
+            self.nbytes -= self.entries.pop(key).nbytes
+        self.tracked_ids.discard(resmaps_id)
+
+    def log_stats(self):
+        logger.info(
+            "areas cache: {} hits, {} misses, {} evictions, {:.1f} MB in use.".format(
+                self.hits, self.misses, self.evictions, self.nbytes / 2 ** 20
+            )
+        )
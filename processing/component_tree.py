@@ -0,0 +1,118 @@
+import numpy as np
+from skimage.morphology import closing, square, max_tree
+from processing.resmaps import cast_threshold
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ComponentTreeIndex:
+    """
+    Precomputed index over a stack of residual maps that answers, for any
+    min_area, the smallest threshold at which the largest anomalous region
+    is smaller than min_area, without labelling the resmaps again.
+
+    label_images closes, clears and labels the thresholded resmaps. Since
+    closing with a flat structuring element commutes with thresholding, the
+    regions obtained for every threshold of the grid are the connected
+    components of the upper level sets of the closed, grid-quantized resmaps.
+    These components are the nodes of a max-tree, built once per image. Each
+    node not touching the image border is recorded with its area and the
+    range of threshold indices for which it is a region of label_images.
+
+    Parameters
+    ----------
+    resmaps : array
+        Residual maps of shape (N, H, W).
+    thresh_min, thresh_max, thresh_step : float
+        Threshold grid, same semantics as in finetune.determine_threshold.
+
+    """
+
+    def __init__(self, resmaps, thresh_min, thresh_max, thresh_step):
+        self.thresholds = np.arange(
+            start=thresh_min, stop=thresh_max + thresh_step, step=thresh_step
+        )
+
+        # per component: index of image, area and [start, stop) range of
+        # threshold indices for which the component is a labelled region
+        image_indices, areas, starts, stops = [], [], [], []
+        for i, resmap in enumerate(resmaps):
+            areas_i, starts_i, stops_i = self.build_image_components(resmap)
+            image_indices.append(np.full(len(areas_i), i, dtype="int64"))
+            areas.append(areas_i)
+            starts.append(starts_i)
+            stops.append(stops_i)
+        self.image_indices = np.concatenate(image_indices)
+        self.areas = np.concatenate(areas)
+        self.starts = np.concatenate(starts)
+        self.stops = np.concatenate(stops)
+
+        # area of the largest region over all resmaps for each threshold
+        self.largest_areas = np.zeros(len(self.thresholds), dtype="int64")
+        for index in range(len(self.thresholds)):
+            active = (self.starts <= index) & (index < self.stops)
+            if np.any(active):
+                self.largest_areas[index] = np.amax(self.areas[active])
+
+        # running minimum, allows answering every min_area by bisection
+        self.largest_areas_min = np.minimum.accumulate(self.largest_areas)
+        logger.info(
+            "component tree index built over {} resmaps: {} components, {} thresholds.".format(
+                len(resmaps), len(self.areas), len(self.thresholds)
+            )
+        )
+
+    def build_image_components(self, resmap):
+        # quantize: a pixel is above threshold k if and only if level > k
+        # (thresholds compared in the precision of the resmap, as label_areas)
+        thresholds = cast_threshold(resmap, self.thresholds)
+        levels = np.searchsorted(thresholds, resmap.ravel(), side="left")
+        levels = levels.reshape(resmap.shape).astype("uint16")
+
+        # close small holes, equivalent to closing every thresholded resmap
+        levels = closing(levels, square(3))
+
+        # max-tree over 8-connected upper level sets (as label does)
+        parent, traverser = max_tree(levels, connectivity=2)
+        parent = parent.ravel()
+        levels = levels.ravel()
+
+        # canonical pixels are the nodes of the tree, every other pixel
+        # belongs to the node of its parent
+        pixels = np.arange(len(levels))
+        is_node = (parent == pixels) | (levels[parent] != levels)
+        node_of = np.where(is_node, pixels, parent)
+
+        # direct pixel counts and border contacts per node
+        border = np.zeros(resmap.shape, dtype=bool)
+        border[0, :] = border[-1, :] = border[:, 0] = border[:, -1] = True
+        area = np.bincount(node_of, minlength=len(levels))
+        touches_border = np.bincount(
+            node_of, weights=border.ravel(), minlength=len(levels)
+        ).astype(bool)
+
+        # accumulate over subtrees, from highest to lowest level since
+        # a parent always has a strictly lower level than its children
+        nodes = pixels[is_node & (parent != pixels)]
+        node_levels = levels[nodes]
+        for level in np.unique(node_levels)[::-1]:
+            children = nodes[node_levels == level]
+            np.add.at(area, parent[children], area[children])
+            np.logical_or.at(touches_border, parent[children], touches_border[children])
+
+        # a node at level l whose parent is at level p is a region of the
+        # thresholded resmap for threshold indices p, ..., l - 1
+        nodes = nodes[~touches_border[nodes]]
+        return area[nodes], levels[parent[nodes]], levels[nodes]
+
+    def determine_threshold(self, min_area):
+        """
+        Returns the smallest threshold at which the largest region is
+        smaller than min_area, or the last threshold of the grid if none is.
+        """
+        index = np.searchsorted(-self.largest_areas_min, -min_area, side="right")
+        if index == len(self.thresholds):
+            index = len(self.thresholds) - 1
+        return self.thresholds[index]
@@ -0,0 +1,202 @@
+"""
+Contact sheets of inspection panels, an alternative to the per-image
+matplotlib figures of TensorImages for reviewing thousands of images: the
+input, reconstruction and resmap of each image are composed side by side
+with NumPy into a uint8 tile captioned with its filename, and tiles are
+laid out in a grid on a few large PNG sheets. A JSON index maps the tiles
+of each sheet (row, column and pixel box) to filenames.
+"""
+
+import os
+import json
+import numpy as np
+import cv2
+from matplotlib import cm
+from processing.resmaps import as_float_images
+from processing.image_writer import to_uint8
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# RGB colour lookup table of the inferno colormap, indexed by uint8 values
+INFERNO_LUT = (cm.inferno(np.arange(256))[:, :3] * 255).round().astype("uint8")
+
+# layout of the tiles (in pixels) and of the sheets (in tiles)
+SHEET_COLS = 8
+SHEET_ROWS = 8
+PANEL_GAP = 4
+TILE_MARGIN = 8
+CAPTION_HEIGHT = 18
+BACKGROUND = 32
+
+# caption font
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.4
+
+# PNG compression level, from 0 (fastest) to 9 (smallest)
+PNG_COMPRESSION = 1
+
+
+def compose_tiles(
+    imgs_input,
+    imgs_pred,
+    resmaps,
+    filenames,
+    vmin,
+    vmax,
+    vmin_resmap=None,
+    vmax_resmap=None,
+    scale=1.0,
+):
+    """
+    Returns RGB uint8 tiles (N, tile_height, tile_width, 3) showing the
+    input, reconstruction (grayscale) and resmap (inferno colours) of each
+    image side by side, above their filename, with the same value ranges as
+    TensorImages.plot_input_pred_resmap.
+    """
+    panels = [
+        to_uint8(as_float_images(imgs_input), vmin, vmax),
+        to_uint8(imgs_pred, vmin, vmax),
+        to_uint8(resmaps, vmin_resmap, vmax_resmap),
+    ]
+    if scale != 1.0:
+        panels = [
+            np.stack(
+                [
+                    cv2.resize(
+                        img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+                    )
+                    for img in imgs
+                ]
+            )
+            for imgs in panels
+        ]
+    nb_images, height, width = panels[0].shape
+    tile_height = height + CAPTION_HEIGHT + TILE_MARGIN
+    tile_width = 3 * width + 2 * PANEL_GAP + TILE_MARGIN
+
+    tiles = np.full((nb_images, tile_height, tile_width, 3), BACKGROUND, dtype="uint8")
+    for i, imgs in enumerate(panels):
+        x = i * (width + PANEL_GAP)
+        if i < 2:
+            tiles[:, :height, x : x + width] = imgs[..., np.newaxis]
+        else:
+            tiles[:, :height, x : x + width] = np.take(INFERNO_LUT, imgs, axis=0)
+
+    # captions, truncated from the left to fit the tile
+    max_width = tile_width - TILE_MARGIN
+    for tile, filename in zip(tiles, filenames):
+        caption = filename
+        while cv2.getTextSize(caption, FONT, FONT_SCALE, 1)[0][0] > max_width:
+            caption = caption[1:]
+        cv2.putText(
+            tile,
+            caption,
+            (0, height + CAPTION_HEIGHT - 5),
+            FONT,
+            FONT_SCALE,
+            (255, 255, 255),
+            1,
+            cv2.LINE_AA,
+        )
+    return tiles
+
+
+def compose_sheet(tiles, cols):
+    """Lays out tiles on a grid of cols columns, row by row."""
+    nb_tiles, tile_height, tile_width, channels = tiles.shape
+    rows = -(-nb_tiles // cols)
+    if rows * cols > nb_tiles:
+        padding = np.full(
+            (rows * cols - nb_tiles,) + tiles.shape[1:], BACKGROUND, dtype="uint8"
+        )
+        tiles = np.concatenate([tiles, padding])
+    return (
+        tiles.reshape(rows, cols, tile_height, tile_width, channels)
+        .transpose(0, 2, 1, 3, 4)
+        .reshape(rows * tile_height, cols * tile_width, channels)
+    )
+
+
+def save_contact_sheets(
+    imgs_input,
+    imgs_pred,
+    resmaps,
+    filenames,
+    save_dir,
+    vmin,
+    vmax,
+    vmin_resmap=None,
+    vmax_resmap=None,
+    prefix="sheet",
+    cols=SHEET_COLS,
+    rows=SHEET_ROWS,
+    scale=1.0,
+):
+    """
+    Saves the inspection panels of the images on sheets of rows x cols tiles
+    ({prefix}_sheet_000.png, ...) and the index of the tiles of each sheet
+    in {prefix}_sheets.json. Returns the index.
+    """
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    tiles_per_sheet = rows * cols
+    sheets = []
+    panel_width = None
+    for start in range(0, len(filenames), tiles_per_sheet):
+        stop = min(start + tiles_per_sheet, len(filenames))
+        tiles = compose_tiles(
+            imgs_input[start:stop],
+            imgs_pred[start:stop],
+            resmaps[start:stop],
+            filenames[start:stop],
+            vmin,
+            vmax,
+            vmin_resmap,
+            vmax_resmap,
+            scale,
+        )
+        sheet = compose_sheet(tiles, cols)
+        sheet_name = "{}_sheet_{:03d}.png".format(prefix, len(sheets))
+        cv2.imwrite(
+            os.path.join(save_dir, sheet_name),
+            cv2.cvtColor(sheet, cv2.COLOR_RGB2BGR),
+            [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION],
+        )
+
+        tile_height, tile_width = tiles.shape[1:3]
+        panel_width = (tile_width - TILE_MARGIN - 2 * PANEL_GAP) // 3
+        sheets.append(
+            {
+                "file": sheet_name,
+                "tiles": [
+                    {
+                        "index": start + i,
+                        "filename": filenames[start + i],
+                        "row": i // cols,
+                        "col": i % cols,
+                        "x": (i % cols) * tile_width,
+                        "y": (i // cols) * tile_height,
+                        "width": tile_width - TILE_MARGIN,
+                        "height": tile_height - TILE_MARGIN,
+                    }
+                    for i in range(stop - start)
+                ],
+            }
+        )
+
+    index = {
+        "panels": ["input", "pred", "resmap"],
+        "panel_width": panel_width,
+        "panel_gap": PANEL_GAP,
+        "sheets": sheets,
+    }
+    with open(os.path.join(save_dir, "{}_sheets.json".format(prefix)), "w") as f:
+        json.dump(index, f, indent=4, sort_keys=False)
+    logger.info(
+        "{} contact sheets of {} images saved at: \n{}".format(
+            len(sheets), len(filenames), save_dir
+        )
+    )
+    return index
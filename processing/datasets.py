@@ -0,0 +1,262 @@
+import os
+import numpy as np
+import tensorflow as tf
+from ktrain.data import Dataset
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# same white list as keras' DirectoryIterator, minus the formats that
+# tf.io.decode_image cannot decode
+WHITE_LIST_FORMATS = ("png", "jpg", "jpeg", "bmp")
+KERAS_ONLY_FORMATS = ("ppm", "tif", "tiff")
+
+
+class ImageDataset(Dataset):
+    """
+    tf.data counterpart of the DirectoryIterator returned by keras'
+    ImageDataGenerator.flow_from_directory with class_mode="input".
+
+    Images are decoded and resized in parallel inside the tf.data graph,
+    in the same way as keras' load_img (conversion to grayscale or RGB,
+    nearest neighbour resizing), then randomly brightened if
+    brightness_range is set, passed to the preprocessing function and rescaled.
+    With dtype "uint8", images are returned as uint8 (neither rescaled nor
+    preprocessed), for models rescaling their inputs.
+
+    As a ktrain Dataset, it can be passed to ktrain.get_learner, which
+    trains on the tf.data.Dataset returned by to_tfdataset. It also
+    exposes the attributes of DirectoryIterator used in this project
+    (samples, filenames, directory, classes, class_indices, index_array)
+    and supports indexing and next(), so it can replace a generator in
+    train.py, finetune.py and test.py.
+    """
+
+    def __init__(
+        self,
+        directory,
+        shape,
+        color_mode,
+        rescale,
+        preprocessing_function,
+        batch_size,
+        subset=None,
+        validation_split=0.0,
+        shuffle=False,
+        brightness_range=None,
+        cache=False,
+        seed=None,
+        dtype="float32",
+    ):
+        super().__init__(batch_size=batch_size)
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.color_mode = color_mode
+        self.channels = 3 if color_mode == "rgb" else 1
+        self.image_shape = self.shape + (self.channels,)
+        self.rescale = rescale
+        self.preprocessing_function = preprocessing_function
+        self.validation_split = validation_split
+        self.shuffle = shuffle
+        self.brightness_range = brightness_range
+        self.cache = cache
+        self.seed = seed
+        self.dtype = dtype
+
+        # list files in the same order as keras' DirectoryIterator
+        self.filenames, self.classes, self.class_indices = list_directory(
+            directory, subset, validation_split
+        )
+        self.samples = len(self.filenames)
+        self.filepaths = [
+            os.path.join(directory, filename) for filename in self.filenames
+        ]
+
+        # order of the images of the last call to next(), as in keras
+        self.index_array = None
+        self.batch_index = 0
+        logger.info(
+            "found {} images belonging to {} classes.".format(
+                self.samples, len(self.class_indices)
+            )
+        )
+
+    # methods required by ktrain's Dataset and keras' Sequence ==============
+
+    def __len__(self):
+        return int(np.ceil(self.samples / self.batch_size))
+
+    def __getitem__(self, index):
+        start = index * self.batch_size
+        stop = min(start + self.batch_size, self.samples)
+        if self.index_array is None:
+            indices = np.arange(start, stop)
+        else:
+            indices = self.index_array[start:stop]
+        filepaths = [self.filepaths[i] for i in indices]
+        ds = tf.data.Dataset.from_tensor_slices(filepaths)
+        ds = ds.map(self.load_image, num_parallel_calls=AUTOTUNE)
+        ds = ds.map(self.transform_image, num_parallel_calls=AUTOTUNE)
+        imgs = next(iter(ds.batch(len(filepaths)))).numpy()
+        return imgs, imgs
+
+    def nsamples(self):
+        return self.samples
+
+    def get_y(self):
+        # class_mode "input": targets are the images themselves
+        return None
+
+    def ondisk(self):
+        return True
+
+    def xshape(self):
+        return self.image_shape
+
+    def next(self):
+        """Returns the next batch, reshuffling at the start of each epoch."""
+        if self.batch_index == 0:
+            if self.shuffle:
+                self.index_array = np.random.permutation(self.samples)
+            else:
+                self.index_array = np.arange(self.samples)
+        batch = self[self.batch_index]
+        self.batch_index = (self.batch_index + 1) % len(self)
+        return batch
+
+    def to_tfdataset(self, shuffle=True, repeat=True):
+        """
+        Returns a tf.data.Dataset yielding (x, x) batches. Decoded images
+        are cached (in memory, or in a file if cache is a path) if cache is
+        set, random augmentation is applied after the cache.
+        """
+        shuffle = shuffle and self.shuffle
+        ds = tf.data.Dataset.from_tensor_slices(self.filepaths)
+        if shuffle and not self.cache:
+            ds = ds.shuffle(self.samples, seed=self.seed)
+        ds = ds.map(self.load_image, num_parallel_calls=AUTOTUNE)
+        if self.cache:
+            ds = ds.cache("" if self.cache is True else self.cache)
+            if shuffle:
+                ds = ds.shuffle(self.samples, seed=self.seed)
+        ds = ds.map(self.transform_image, num_parallel_calls=AUTOTUNE)
+        ds = ds.batch(self.batch_size)
+        ds = ds.map(lambda imgs: (imgs, imgs), num_parallel_calls=AUTOTUNE)
+        if repeat:
+            ds = ds.repeat()
+        return ds.prefetch(AUTOTUNE)
+
+    # image loading and transformation ======================================
+
+    def load_image(self, filepath):
+        """
+        Decodes and resizes an image as keras' load_img, returns a float32
+        tensor with values in [0, 255].
+        """
+        if self.color_mode == "rgb":
+            img = tf.io.decode_image(
+                tf.io.read_file(filepath), channels=3, expand_animations=False
+            )
+        else:
+            # grayscale images are decoded as is, color images are
+            # converted as PIL's convert("L") (alpha channel ignored)
+            img = tf.io.decode_image(
+                tf.io.read_file(filepath), channels=0, expand_animations=False
+            )
+            img = tf.cond(
+                tf.shape(img)[-1] >= 3,
+                lambda: rgb_to_grayscale(img[:, :, :3]),
+                lambda: img[:, :, :1],
+            )
+        img = tf.image.resize(img, self.shape, method="nearest")
+        img = tf.cast(img, tf.float32)
+        img.set_shape(self.image_shape)
+        return img
+
+    def transform_image(self, img):
+        if self.brightness_range is not None:
+            img = apply_random_brightness(img, self.brightness_range)
+        if self.preprocessing_function:
+            img = self.preprocessing_function(img)
+        if self.rescale:
+            img = img * self.rescale
+        if self.dtype == "uint8":
+            img = tf.cast(img, tf.uint8)
+        return img
+
+
+def rgb_to_grayscale(img):
+    """Fixed point ITU-R 601-2 luma transform of PIL's convert("L")."""
+    img = tf.cast(img, tf.int32)
+    img = (
+        img[:, :, 0:1] * 19595 + img[:, :, 1:2] * 38470 + img[:, :, 2:3] * 7471 + 0x8000
+    ) // 2 ** 16
+    return tf.cast(img, tf.uint8)
+
+
+def apply_random_brightness(img, brightness_range):
+    """
+    Random brightness shift as ImageDataGenerator's brightness_range
+    (Keras-Preprocessing 1.1.0): the image is scaled to a maximum of 255
+    and converted to uint8 (array_to_img), then multiplied by a factor
+    drawn uniformly from brightness_range and clipped (PIL's
+    ImageEnhance.Brightness).
+    """
+    img = img + tf.maximum(-tf.reduce_min(img), 0)
+    img_max = tf.reduce_max(img)
+    img = tf.where(img_max != 0, img / img_max, img) * 255
+    img = tf.floor(img)
+    brightness = tf.random.uniform(
+        [], minval=brightness_range[0], maxval=brightness_range[1]
+    )
+    return tf.floor(tf.clip_by_value(img * brightness, 0, 255))
+
+
+def list_directory(directory, subset=None, validation_split=0.0):
+    """
+    Lists the images of each class subdirectory of directory, with the
+    same ordering and the same training/validation split as keras'
+    DirectoryIterator: for each class, the first validation_split fraction
+    of its sorted images forms the validation subset.
+    Returns the filenames relative to directory, their classes and the
+    class indices.
+    """
+    class_names = sorted(
+        name
+        for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name))
+    )
+    class_indices = dict(zip(class_names, range(len(class_names))))
+
+    if subset == "validation":
+        split = (0, validation_split)
+    elif subset == "training":
+        split = (validation_split, 1)
+    else:
+        split = None
+
+    filenames, classes = [], []
+    for class_name in class_names:
+        class_dir = os.path.join(directory, class_name)
+        class_files = []
+        for root, _, files in sorted(os.walk(class_dir), key=lambda x: x[0]):
+            for fname in sorted(files):
+                extension = fname.lower().rsplit(".", 1)[-1]
+                if extension in KERAS_ONLY_FORMATS:
+                    raise ValueError(
+                        "{} cannot be decoded by the tf.data backend, use the keras backend".format(
+                            os.path.join(root, fname)
+                        )
+                    )
+                if extension in WHITE_LIST_FORMATS:
+                    class_files.append(os.path.join(root, fname))
+        if split:
+            start = int(split[0] * len(class_files))
+            stop = int(split[1] * len(class_files))
+            class_files = class_files[start:stop]
+        filenames.extend(os.path.relpath(path, directory) for path in class_files)
+        classes.extend([class_indices[class_name]] * len(class_files))
+    return filenames, np.array(classes, dtype="int32"), class_indices
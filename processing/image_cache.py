@@ -0,0 +1,273 @@
+import os
+import json
+import numpy as np
+from ktrain.data import Dataset
+from processing.datasets import ImageDataset, list_directory
+from processing.utils import get_tmp_path
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_NAME = "cache"
+MANIFEST_NAME = "manifest.json"
+
+
+class ImageCache:
+    """
+    Decoded images of a split directory (e.g. mvtec/capsule/train or
+    mvtec/capsule/test), resized to shape and stored once as an uint8 .npy
+    file in a "cache" directory of the input directory, loaded as a memory
+    map. A manifest records the filenames, classes, class indices, paths to
+    the ground truth masks and the size and modification time of each
+    image; the cache is rebuilt if any of them changed.
+    """
+
+    def __init__(self, input_directory, split, shape, color_mode):
+        self.directory = os.path.join(input_directory, split)
+        self.cache_dir = os.path.join(
+            input_directory,
+            CACHE_DIR_NAME,
+            "{}_{}x{}".format(color_mode, shape[0], shape[1]),
+        )
+        self.images_path = os.path.join(self.cache_dir, split + ".npy")
+        self.manifest_path = os.path.join(self.cache_dir, split + "_" + MANIFEST_NAME)
+        self.shape = tuple(shape)
+        self.color_mode = color_mode
+
+        filenames, classes, class_indices = list_directory(self.directory)
+        manifest = {
+            "filenames": filenames,
+            "classes": classes.tolist(),
+            "class_indices": class_indices,
+            "masks": get_mask_paths(input_directory, filenames),
+            "stats": get_stats(self.directory, filenames),
+        }
+        if not self.is_valid(manifest):
+            self.build(manifest)
+        self.manifest = manifest
+        self.filenames = manifest["filenames"]
+        self.classes = classes
+        self.class_indices = class_indices
+        self.masks = manifest["masks"]
+        self.images = np.load(self.images_path, mmap_mode="r")
+
+    def is_valid(self, manifest):
+        if not (
+            os.path.isfile(self.manifest_path) and os.path.isfile(self.images_path)
+        ):
+            return False
+        with open(self.manifest_path, "r") as read_file:
+            return json.load(read_file) == manifest
+
+    def build(self, manifest):
+        """
+        Decodes the images with the tf.data pipeline, chunk by chunk, into a
+        temporary file of its own, moved to images_path once complete, so
+        that concurrent builds of the same cache (e.g. runs of pipeline.py)
+        never write to the same file.
+        """
+        logger.info(
+            "decoding {} images of {} into {}...".format(
+                len(manifest["filenames"]), self.directory, self.images_path
+            )
+        )
+        os.makedirs(self.cache_dir, exist_ok=True)
+        dataset = ImageDataset(
+            directory=self.directory,
+            shape=self.shape,
+            color_mode=self.color_mode,
+            rescale=None,
+            preprocessing_function=None,
+            batch_size=64,
+        )
+        tmp_path = get_tmp_path(self.images_path)
+        try:
+            images = np.lib.format.open_memmap(
+                tmp_path,
+                mode="w+",
+                dtype="uint8",
+                shape=(dataset.samples,) + dataset.image_shape,
+            )
+            start = 0
+            for imgs, _ in dataset.to_tfdataset(shuffle=False, repeat=False):
+                images[start : start + len(imgs)] = imgs.numpy().astype("uint8")
+                start += len(imgs)
+            images.flush()
+            del images
+            os.replace(tmp_path, self.images_path)
+
+            # the manifest is moved last, it validates the images
+            tmp_path = get_tmp_path(self.manifest_path)
+            with open(tmp_path, "w") as json_file:
+                json.dump(manifest, json_file)
+            os.replace(tmp_path, self.manifest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class CachedImageIterator(Dataset):
+    """
+    Iterator over (a subset of) an ImageCache, with the attributes of the
+    DirectoryIterator returned by flow_from_directory with class_mode
+    "input". Batches are slices of the uint8 memory map, without copy when
+    the images of a batch are contiguous, converted to float32 and
+    rescaled (after a random brightness shift if brightness_range is set
+    and the preprocessing function) only when the batch is served. With
+    dtype "uint8", batches are served as uint8 slices of the memory map.
+    As a ktrain Dataset (keras Sequence), it can be passed to
+    ktrain.get_learner.
+    """
+
+    def __init__(
+        self,
+        cache,
+        rescale,
+        preprocessing_function,
+        batch_size,
+        subset=None,
+        validation_split=0.0,
+        shuffle=False,
+        brightness_range=None,
+        seed=None,
+        dtype="float32",
+    ):
+        super().__init__(batch_size=batch_size)
+        self.cache = cache
+        self.rescale = rescale
+        self.preprocessing_function = preprocessing_function
+        self.validation_split = validation_split
+        self.shuffle = shuffle
+        self.brightness_range = brightness_range
+        self.dtype = dtype
+        self.rng = np.random.default_rng(seed)
+
+        # indices of the subset in the cache, as split by keras
+        self.cache_indices = get_subset_indices(
+            cache.classes, subset, validation_split
+        )
+        self.directory = cache.directory
+        self.filenames = [cache.filenames[i] for i in self.cache_indices]
+        self.masks = [cache.masks[i] for i in self.cache_indices]
+        self.classes = cache.classes[self.cache_indices]
+        self.class_indices = cache.class_indices
+        self.samples = len(self.cache_indices)
+        self.image_shape = cache.images.shape[1:]
+
+        self.index_array = None
+        self.batch_index = 0
+        self.on_epoch_end()
+        logger.info(
+            "found {} cached images belonging to {} classes.".format(
+                self.samples, len(self.class_indices)
+            )
+        )
+
+    def __len__(self):
+        return int(np.ceil(self.samples / self.batch_size))
+
+    def __getitem__(self, index):
+        start = index * self.batch_size
+        indices = self.index_array[start : start + self.batch_size]
+        imgs = self.get_images(self.cache_indices[indices])
+        if self.dtype == "uint8" and self.brightness_range is None:
+            return imgs, imgs
+        imgs = imgs.astype("float32")
+        if self.brightness_range is not None:
+            imgs = apply_random_brightness(imgs, self.brightness_range, self.rng)
+        if self.preprocessing_function:
+            imgs = self.preprocessing_function(imgs)
+        if self.rescale:
+            imgs *= self.rescale
+        if self.dtype == "uint8":
+            imgs = imgs.astype("uint8")
+        return imgs, imgs
+
+    def get_images(self, cache_indices):
+        """Returns the uint8 images, as a view of the cache if contiguous."""
+        if np.all(np.diff(cache_indices) == 1):
+            return self.cache.images[cache_indices[0] : cache_indices[-1] + 1]
+        return self.cache.images[cache_indices]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.index_array = self.rng.permutation(self.samples)
+        else:
+            self.index_array = np.arange(self.samples)
+
+    def nsamples(self):
+        return self.samples
+
+    def get_y(self):
+        # class_mode "input": targets are the images themselves
+        return None
+
+    def ondisk(self):
+        return True
+
+    def xshape(self):
+        return self.image_shape
+
+    def next(self):
+        """Returns the next batch, reshuffling at the start of each epoch."""
+        if self.batch_index == 0 and self.shuffle:
+            self.on_epoch_end()
+        batch = self[self.batch_index]
+        self.batch_index = (self.batch_index + 1) % len(self)
+        return batch
+
+
+def get_subset_indices(classes, subset=None, validation_split=0.0):
+    """
+    Returns the indices of the training or validation subset of images
+    listed class by class, split as keras' DirectoryIterator: for each
+    class, the first validation_split fraction of its images forms the
+    validation subset.
+    """
+    if subset is None:
+        return np.arange(len(classes))
+    indices = []
+    for class_i in np.unique(classes):
+        class_indices = np.flatnonzero(classes == class_i)
+        stop = int(validation_split * len(class_indices))
+        if subset == "validation":
+            indices.append(class_indices[:stop])
+        else:
+            indices.append(class_indices[stop:])
+    return np.concatenate(indices)
+
+
+def apply_random_brightness(imgs, brightness_range, rng):
+    """
+    Numpy counterpart of datasets.apply_random_brightness for a batch of
+    float32 images in [0, 255] (hence no shift of negative values), with
+    one brightness factor per image.
+    """
+    imgs_max = imgs.reshape(len(imgs), -1).max(axis=1).reshape(-1, 1, 1, 1)
+    imgs = np.floor(imgs / np.where(imgs_max != 0, imgs_max, 1) * 255)
+    brightness = rng.uniform(
+        brightness_range[0], brightness_range[1], size=(len(imgs), 1, 1, 1)
+    )
+    return np.floor(np.clip(imgs * brightness.astype("float32"), 0, 255))
+
+
+def get_mask_paths(input_directory, filenames):
+    """
+    Returns the path of the ground truth mask of each image (e.g.
+    ground_truth/crack/000_mask.png for crack/000.png), None if absent.
+    """
+    masks = []
+    for filename in filenames:
+        root, _ = os.path.splitext(filename)
+        path = os.path.join(input_directory, "ground_truth", root + "_mask.png")
+        masks.append(path if os.path.isfile(path) else None)
+    return masks
+
+
+def get_stats(directory, filenames):
+    stats = []
+    for filename in filenames:
+        stat = os.stat(os.path.join(directory, filename))
+        stats.append([stat.st_size, stat.st_mtime_ns])
+    return stats
@@ -0,0 +1,160 @@
+"""
+Bulk writing of images and segmentation masks in the background: images are
+queued to a pool of threads that encode them with OpenCV (lossless PNG) and
+write them to disk, while the caller keeps computing. OpenCV releases the
+GIL while encoding, so writes overlap with the computations of the caller
+and with each other.
+
+The queue is bounded, so that a caller producing images faster than they
+are written blocks instead of holding every pending image in memory.
+flush() waits until every queued image is written and close() also stops
+the threads; both raise the first error of a write, if any.
+
+Queued arrays are written as they are when their turn comes: callers must
+not modify them after queuing them (fresh arrays or views of fresh arrays,
+e.g. thresholded resmaps, are fine).
+"""
+
+import queue
+import threading
+import numpy as np
+import cv2
+from processing import timing
+
+# number of writer threads and of images queued before write() blocks
+WRITER_THREADS = 2
+MAX_PENDING = 64
+
+# PNG compression level, from 0 (fastest) to 9 (smallest)
+PNG_COMPRESSION = 1
+
+# formats of masks: 8-bit grayscale PNG (0 or 255) or 1-bit PNG (bits packed
+# 8 pixels per byte, smaller and as readable as grayscale PNG)
+MASK_FORMATS = ["png", "bitmask"]
+
+
+def to_uint8(imgs, vmin=None, vmax=None):
+    """
+    Maps images from [vmin, vmax] to the 256 entries of a colormap (values
+    outside are clipped), as imshow does with vmin and vmax. If vmin or vmax
+    is None, the minimum or maximum of each image (over all its channels) is
+    used.
+    """
+    imgs = imgs.astype("float32")
+    axes = tuple(range(1, imgs.ndim))
+    if vmin is None:
+        vmin = imgs.min(axis=axes, keepdims=True)
+    if vmax is None:
+        vmax = imgs.max(axis=axes, keepdims=True)
+    scale = 256 / np.maximum(np.asarray(vmax) - vmin, np.finfo("float32").eps)
+    imgs = (imgs - vmin) * scale
+    return np.clip(imgs, 0, 255, out=imgs).astype("uint8")
+
+
+class ImageWriter:
+    """
+    Writes images to disk from a pool of threads fed by a bounded queue.
+    Use as a context manager, or call close() once all images are queued.
+    """
+
+    def __init__(
+        self, threads=WRITER_THREADS, max_pending=MAX_PENDING, compression=None
+    ):
+        if compression is None:
+            compression = PNG_COMPRESSION
+        self.compression = compression
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.threads = [
+            threading.Thread(target=self._work, name="image-writer-{}".format(i))
+            for i in range(max(threads, 1))
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            # do not hide the original error behind a write error
+            if exc_type is None:
+                raise
+        return False
+
+    def write(self, path, img):
+        """
+        Queues the uint8 image img (H, W), (H, W, 1) or (H, W, 3) in RGB
+        order, to be saved at path (format given by the extension). Blocks
+        while the queue is full.
+        """
+        self._check_open()
+        kind = "rgb" if img.ndim == 3 and img.shape[-1] == 3 else "gray"
+        params = [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+        self._put((path, img, params, kind))
+
+    def write_mask(self, path, mask, mask_format="png"):
+        """
+        Queues the boolean mask to be saved at path as a grayscale PNG (0 or
+        255) or as a 1-bit PNG (mask_format "bitmask").
+        """
+        assert mask_format in MASK_FORMATS
+        self._check_open()
+        params = [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+        if mask_format == "bitmask":
+            params += [cv2.IMWRITE_PNG_BILEVEL, 1]
+        self._put((path, mask, params, "mask"))
+
+    def flush(self):
+        """Waits until every queued image is written."""
+        with timing.timer("flush_images"):
+            self.queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """Writes the queued images and stops the threads."""
+        if self.threads is None:
+            return
+        with timing.timer("flush_images"):
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+        self.threads = None
+        self._raise_errors()
+
+    def _check_open(self):
+        if self.threads is None:
+            raise ValueError("image writer is closed")
+
+    def _put(self, task):
+        self.queue.put(task)
+        timing.count("images_queued")
+
+    def _raise_errors(self):
+        if self.errors:
+            error = self.errors[0]
+            self.errors = []
+            raise error
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                path, img, params, kind = task
+                if kind == "mask":
+                    # black and white
+                    img = np.where(img, np.uint8(255), np.uint8(0))
+                elif kind == "rgb":
+                    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+                if not cv2.imwrite(path, img, params):
+                    raise OSError("could not write image at: {}".format(path))
+            except Exception as error:
+                self.errors.append(error)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,235 @@
+"""
+Optional memory accounting of the pipeline scripts: peak resident memory
+(RSS) of the process per stage, and size of the major arrays held by each
+stage, to size machines and check memory-saving modes (input_dtype,
+resmap dtypes, streamed test chunks, tiles). Accounting is disabled by
+default, in which case stages and records return immediately.
+
+The peak RSS of a stage is read from the high-water mark of the process
+(VmHWM of /proc/self/status), which is reset at the start of each stage
+(through /proc/self/clear_refs, Linux only). Elsewhere, or if the reset is
+not permitted, the peak RSS of a stage is the peak of the process so far.
+Child processes (e.g. workers > 1) are accounted for in children_peak_rss.
+"""
+
+import sys
+import json
+import resource
+import numpy as np
+
+MB = 2 ** 20
+
+_enabled = False
+_can_reset = False
+_peak_rss = 0.0
+_stages = {}
+_arrays = {}
+_current_stage = None
+_rss_start = None
+
+
+def enable():
+    """Enables memory accounting and resets previous records."""
+    global _enabled
+    _enabled = True
+    reset()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    global _peak_rss, _can_reset, _current_stage
+    _current_stage = None
+    _stages.clear()
+    _arrays.clear()
+    _peak_rss = get_peak_rss()
+    _can_reset = reset_peak_rss()
+
+
+def read_status(field):
+    """Returns a memory field (e.g. "VmRSS") of /proc/self/status in MB."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024 / MB
+    except OSError:
+        pass
+    return None
+
+
+def get_rss():
+    """Returns the current resident memory of the process in MB."""
+    rss = read_status("VmRSS")
+    if rss is None:
+        return get_peak_rss()
+    return rss
+
+
+def get_peak_rss():
+    """Returns the peak resident memory of the process in MB."""
+    peak_rss = read_status("VmHWM")
+    if peak_rss is None:
+        # ru_maxrss is in bytes on macOS and in KB elsewhere
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss = peak_rss / MB if sys.platform == "darwin" else peak_rss / 1024
+    return peak_rss
+
+
+def get_children_peak_rss():
+    """Returns the largest peak resident memory of terminated children in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak_rss / MB if sys.platform == "darwin" else peak_rss / 1024
+
+
+def reset_peak_rss():
+    """Resets the high-water mark of the RSS of the process (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def set_stage(name):
+    """
+    Ends the current stage, recording its RSS at its start and end and its
+    peak RSS, and starts the stage name (None only ends the current stage).
+    Arrays recorded until the next call are attributed to the stage.
+    """
+    global _peak_rss, _current_stage, _rss_start
+    if not _enabled:
+        return
+    peak_rss = get_peak_rss()
+    _peak_rss = max(_peak_rss, peak_rss)
+    if _current_stage is not None:
+        stats = _stages.get(_current_stage)
+        if stats is None:
+            _stages[_current_stage] = {
+                "calls": 1,
+                "rss_start": _rss_start,
+                "rss_end": get_rss(),
+                "peak_rss": peak_rss,
+            }
+        else:
+            stats["calls"] += 1
+            stats["rss_end"] = get_rss()
+            stats["peak_rss"] = max(stats["peak_rss"], peak_rss)
+    _current_stage = name
+    if name is not None:
+        if _can_reset:
+            reset_peak_rss()
+        _rss_start = get_rss()
+
+
+def record_array(name, array):
+    """
+    Records the size of array as name, in the current stage. Arrays recorded
+    several times under the same name in a stage (e.g. chunks) keep the
+    largest size. Memory-mapped arrays are flagged, their pages are only
+    resident once read.
+    """
+    if not _enabled or array is None:
+        return
+    key = (_current_stage, name)
+    record = _arrays.get(key)
+    if record is not None and record["mb"] >= array.nbytes / MB:
+        record["records"] += 1
+        return
+    _arrays[key] = {
+        "name": name,
+        "stage": _current_stage,
+        "shape": list(array.shape),
+        "dtype": str(array.dtype),
+        "mb": array.nbytes / MB,
+        "memmap": isinstance(array, np.memmap),
+        "records": 1 if record is None else record["records"] + 1,
+    }
+
+
+def record_arrays(**arrays):
+    """Records the size of each keyword array (see record_array)."""
+    for name, array in arrays.items():
+        record_array(name, array)
+
+
+def get_report():
+    """
+    Returns the peak RSS of the process and of its terminated children, the
+    RSS of each stage and the size of each recorded array, in MB (the
+    current stage is ended first).
+    """
+    set_stage(None)
+    peak_rss = max(_peak_rss, get_peak_rss())
+    arrays_mb = {}
+    for record in _arrays.values():
+        if not record["memmap"]:
+            arrays_mb[record["stage"]] = (
+                arrays_mb.get(record["stage"], 0) + record["mb"]
+            )
+    return {
+        "peak_rss": peak_rss,
+        "children_peak_rss": get_children_peak_rss(),
+        "rss": get_rss(),
+        "per_stage_peak": _can_reset,
+        "stages": {
+            name: dict(stats, arrays_mb=arrays_mb.get(name, 0.0))
+            for name, stats in _stages.items()
+        },
+        "arrays": list(_arrays.values()),
+    }
+
+
+def save_report(path):
+    """Saves the report (see get_report) as JSON at path."""
+    report = get_report()
+    with open(path, "w") as json_file:
+        json.dump(report, json_file, indent=4, sort_keys=False)
+    return report
+
+
+def format_report(report):
+    """Returns the report as a table of stages followed by a table of arrays."""
+    lines = [
+        "{:<28}{:>14}{:>14}{:>14}{:>14}".format(
+            "stage", "start (MB)", "end (MB)", "peak (MB)", "arrays (MB)"
+        )
+    ]
+    for name, stats in report["stages"].items():
+        lines.append(
+            "{:<28}{:>14.1f}{:>14.1f}{:>14.1f}{:>14.1f}".format(
+                name,
+                stats["rss_start"],
+                stats["rss_end"],
+                stats["peak_rss"],
+                stats["arrays_mb"],
+            )
+        )
+    lines.append(
+        "{:<28}{:<24}{:<28}{:>12}".format(
+            "array", "stage", "shape x dtype", "size (MB)"
+        )
+    )
+    for record in report["arrays"]:
+        lines.append(
+            "{:<28}{:<24}{:<28}{:>12.1f}".format(
+                record["name"] + (" (memmap)" if record["memmap"] else ""),
+                str(record["stage"]),
+                "{} x {}".format(tuple(record["shape"]), record["dtype"]),
+                record["mb"],
+            )
+        )
+    lines.append(
+        "peak RSS: {:.1f} MB (child processes: {:.1f} MB)".format(
+            report["peak_rss"], report["children_peak_rss"]
+        )
+    )
+    return "\n".join(lines)
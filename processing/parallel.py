@@ -0,0 +1,86 @@
+import multiprocessing
+import numpy as np
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def shared_memory_available():
+    """Returns whether multiprocessing.shared_memory (Python >= 3.8) exists."""
+    try:
+        from multiprocessing import shared_memory  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_workers(workers):
+    """
+    Returns the number of worker processes to use: workers, or 1 (serial
+    path) if shared memory is not available to share arrays with them.
+    """
+    if workers > 1 and not shared_memory_available():
+        logger.warning(
+            "multiprocessing.shared_memory requires Python 3.8, "
+            "running with 1 worker instead of {}.".format(workers)
+        )
+        return 1
+    return workers
+
+
+class SharedArray:
+    """
+    Numpy array backed by a multiprocessing.shared_memory block.
+    Pickling a SharedArray only transfers the name, shape and dtype of the
+    block, so it can be sent to worker processes without copying the data.
+    The process that created the block is responsible for unlinking it.
+    Requires Python >= 3.8 (see get_workers).
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        # imported here so that this module loads on Python < 3.8
+        from multiprocessing import shared_memory
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if name is None:
+            nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, arr):
+        shared = cls(arr.shape, arr.dtype)
+        shared.array[...] = arr
+        return shared
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "shape": self.shape, "dtype": self.dtype.str}
+
+    def __setstate__(self, state):
+        self.__init__(state["shape"], state["dtype"], name=state["name"])
+
+    def close(self):
+        # release the numpy view before closing the underlying buffer
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def get_pool(workers, initializer=None, initargs=()):
+    """Returns a process pool with the given number of worker processes."""
+    return multiprocessing.Pool(
+        processes=workers, initializer=initializer, initargs=initargs
+    )
+
+
+def split_indices(length, n_shards):
+    """Splits range(length) into at most n_shards contiguous (start, stop) pairs."""
+    bounds = np.linspace(0, length, num=min(n_shards, length) + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
@@ -2,6 +2,10 @@ import os
 import tensorflow as tf
 from tensorflow import keras
 from keras.preprocessing.image import ImageDataGenerator
+from processing.datasets import ImageDataset
+from processing.image_cache import ImageCache, CachedImageIterator
+from autoencoder.models.rescale import INPUT_DTYPES
+from processing import timing
 
 
 # Data augmentation parameters (only for training)
@@ -12,24 +16,74 @@ FILL_MODE = "nearest"
 BRIGHTNESS_RANGE = [0.95, 1.05]
 VAL_SPLIT = 0.1
 
+# Backends loading the images: keras' ImageDataGenerator, tf.data or
+# memory-mapped cache of decoded images
+BACKENDS = ["keras", "tfdata", "memmap"]
+
 
 class Preprocessor:
+    """
+    Loads the train, validation and test images of input_directory.
+    With the "keras" backend, the get_*_generator methods return keras'
+    DirectoryIterators. With the "tfdata" backend, they return ImageDatasets
+    that decode and augment the images in parallel in a tf.data pipeline,
+    optionally caching the decoded images (cache=True for an in-memory
+    cache, or the path of a cache file). With the "memmap" backend, images
+    are decoded once into an ImageCache (uint8 memory map in the "cache"
+    directory of input_directory) and served by CachedImageIterators.
+
+    With input_dtype "uint8", images are served as uint8, without rescaling,
+    to models rescaling their inputs (see autoencoder.models.rescale), which
+    divides the memory of the loaded images by 4.
+    """
+
     def __init__(
-        self, input_directory, rescale, shape, color_mode, preprocessing_function,
+        self,
+        input_directory,
+        rescale,
+        shape,
+        color_mode,
+        preprocessing_function,
+        backend="keras",
+        cache=False,
+        input_dtype="float32",
     ):
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of {}".format(BACKENDS))
+        if input_dtype not in INPUT_DTYPES:
+            raise ValueError("input_dtype must be one of {}".format(INPUT_DTYPES))
+        if input_dtype == "uint8" and preprocessing_function is not None:
+            raise ValueError(
+                "uint8 images cannot be passed to a preprocessing function"
+            )
         self.input_directory = input_directory
         self.train_data_dir = os.path.join(input_directory, "train")
         self.test_data_dir = os.path.join(input_directory, "test")
-        self.rescale = rescale
+        # uint8 images are rescaled by the model
+        self.rescale = rescale if input_dtype == "float32" else None
+        self.input_dtype = input_dtype
         self.shape = shape
         self.color_mode = color_mode
         self.preprocessing_function = preprocessing_function
         self.validation_split = VAL_SPLIT
+        self.backend = backend
+        self.cache = cache
+        self.image_caches = {}
 
         self.nb_val_images = None
         self.nb_test_images = None
 
+    @timing.timed("get_train_generator")
     def get_train_generator(self, batch_size, shuffle=True):
+        if self.backend != "keras":
+            return self.get_dataset(
+                split="train",
+                batch_size=batch_size,
+                subset="training",
+                shuffle=True,
+                brightness_range=BRIGHTNESS_RANGE,
+            )
+
         # This will do preprocessing and realtime data augmentation:
         train_datagen = ImageDataGenerator(
             # randomly rotate images in the range (degrees, 0 to 180)
@@ -50,6 +104,8 @@ class Preprocessor:
             preprocessing_function=self.preprocessing_function,
             # image data format, either "channels_first" or "channels_last"
             data_format="channels_last",
+            # datatype of the generated images
+            dtype=self.input_dtype,
             # fraction of images reserved for validation (strictly between 0 and 1)
             validation_split=self.validation_split,
         )
@@ -66,16 +122,26 @@ class Preprocessor:
         )
         return train_generator
 
+    @timing.timed("get_val_generator")
     def get_val_generator(self, batch_size, shuffle=True):
         """
         For training, pass autoencoder.batch_size as batch size.
         For validation, pass nb_validation_images as batch size.
         For test, pass nb_test_images as batch size.
         """
+        if self.backend != "keras":
+            return self.get_dataset(
+                split="train",
+                batch_size=batch_size,
+                subset="validation",
+                shuffle=shuffle,
+            )
+
         # For validation dataset, only rescaling
         validation_datagen = ImageDataGenerator(
             rescale=self.rescale,
             data_format="channels_last",
+            dtype=self.input_dtype,
             validation_split=self.validation_split,
             preprocessing_function=self.preprocessing_function,
         )
@@ -91,16 +157,23 @@ class Preprocessor:
         )
         return validation_generator
 
+    @timing.timed("get_test_generator")
     def get_test_generator(self, batch_size, shuffle=False):
         """
         For training, pass autoencoder.batch_size as batch size.
         For validation, pass nb_validation_images as batch size.
         For test, pass nb_test_images as batch size.
         """
+        if self.backend != "keras":
+            return self.get_dataset(
+                split="test", batch_size=batch_size, shuffle=shuffle
+            )
+
         # For test dataset, only rescaling
         test_datagen = ImageDataGenerator(
             rescale=self.rescale,
             data_format="channels_last",
+            dtype=self.input_dtype,
             preprocessing_function=self.preprocessing_function,
         )
 
@@ -115,16 +188,23 @@ class Preprocessor:
         )
         return test_generator
 
+    @timing.timed("get_finetuning_generator")
     def get_finetuning_generator(self, batch_size, shuffle=False):
         """
         For training, pass autoencoder.batch_size as batch size.
         For validation, pass nb_validation_images as batch size.
         For test, pass nb_test_images as batch size.
         """
+        if self.backend != "keras":
+            return self.get_dataset(
+                split="test", batch_size=batch_size, shuffle=shuffle
+            )
+
         # For test dataset, only rescaling
         test_datagen = ImageDataGenerator(
             rescale=self.rescale,
             data_format="channels_last",
+            dtype=self.input_dtype,
             preprocessing_function=self.preprocessing_function,
         )
 
@@ -139,6 +219,49 @@ class Preprocessor:
         )
         return finetuning_generator
 
+    def get_dataset(
+        self, split, batch_size, subset=None, shuffle=False, brightness_range=None
+    ):
+        if self.backend == "memmap":
+            return CachedImageIterator(
+                cache=self.get_image_cache(split),
+                rescale=self.rescale,
+                preprocessing_function=self.preprocessing_function,
+                batch_size=batch_size,
+                subset=subset,
+                validation_split=self.validation_split,
+                shuffle=shuffle,
+                brightness_range=brightness_range,
+                dtype=self.input_dtype,
+            )
+
+        # cache file per subset, so that subsets do not overwrite each other
+        cache = self.cache
+        if cache and cache is not True:
+            cache = "{}_{}_{}".format(cache, split, subset or "all")
+        return ImageDataset(
+            directory=os.path.join(self.input_directory, split),
+            shape=self.shape,
+            color_mode=self.color_mode,
+            rescale=self.rescale,
+            preprocessing_function=self.preprocessing_function,
+            batch_size=batch_size,
+            subset=subset,
+            validation_split=self.validation_split,
+            shuffle=shuffle,
+            brightness_range=brightness_range,
+            cache=cache,
+            dtype=self.input_dtype,
+        )
+
+    def get_image_cache(self, split):
+        # decoded once per split, shared by all its subsets
+        if split not in self.image_caches:
+            self.image_caches[split] = ImageCache(
+                self.input_directory, split, self.shape, self.color_mode
+            )
+        return self.image_caches[split]
+
     def get_total_number_test_images(self):
         total_number = 0
         sub_dir_names = os.listdir(self.test_data_dir)
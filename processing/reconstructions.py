@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+import numpy as np
+from processing import utils
+from processing import timing
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STORE_DIR_NAME = "reconstructions"
+
+
+class ReconstructionStore:
+    """
+    On-disk store of model reconstructions (predictions), saved as .npy files
+    in a "reconstructions" directory next to the saved model and loaded as
+    memory maps. Each file is keyed by a hash of the model file, the
+    preprocessing settings from info.json and the manifest of the
+    reconstructed images (filenames, sizes and modification times), so a
+    stored reconstruction is only reused if neither the model nor the data
+    changed. Files are grouped by name (e.g. "validation" or "test"); files
+    of the same group with other keys (e.g. another --input-dtype) are kept,
+    delete the "reconstructions" directory to free their space.
+
+    Scripts disable the store with --no-store, in which case they pass None
+    instead of a store (see predict).
+    """
+
+    def __init__(self, model_path):
+        self.store_dir = os.path.join(os.path.dirname(model_path), STORE_DIR_NAME)
+        self.model_hash = hash_file(model_path)
+        self.preprocessing = utils.get_model_info(model_path)["preprocessing"]
+
+    def get_path(self, group, directory, filenames):
+        manifest = []
+        for filename in filenames:
+            stat = os.stat(os.path.join(directory, filename))
+            manifest.append([filename, stat.st_size, stat.st_mtime_ns])
+        key = json.dumps(
+            {
+                "model": self.model_hash,
+                "preprocessing": self.preprocessing,
+                "directory": os.path.abspath(directory),
+                "manifest": manifest,
+            },
+            sort_keys=True,
+        )
+        key_hash = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.store_dir, "{}_{}.npy".format(group, key_hash))
+
+    def load(self, group, directory, filenames):
+        """Returns the stored reconstructions as a memory map, None if absent."""
+        path = self.get_path(group, directory, filenames)
+        if not os.path.isfile(path):
+            return None
+        logger.info("loading stored reconstructions from {}".format(path))
+        return np.load(path, mmap_mode="r")
+
+    def open_writer(self, group, directory, filenames, shape, dtype):
+        """
+        Returns a ReconstructionWriter, a memory map of the given shape to
+        fill with reconstructions, e.g. chunk by chunk.
+        """
+        path = self.get_path(group, directory, filenames)
+        os.makedirs(self.store_dir, exist_ok=True)
+        return ReconstructionWriter(path, shape, dtype)
+
+    def predict(self, model, imgs_input, group, directory, filenames):
+        """
+        Returns the reconstructions of imgs_input, loaded from the store if
+        available, else predicted with the model and stored.
+        """
+        imgs_pred = self.load(group, directory, filenames)
+        if imgs_pred is not None:
+            timing.count("reconstructions_reused", len(imgs_pred))
+            return imgs_pred
+        with timing.timer("predict"):
+            imgs_pred = model.predict(imgs_input)
+        timing.count("images_predicted", len(imgs_input))
+        writer = self.open_writer(
+            group, directory, filenames, imgs_pred.shape, imgs_pred.dtype
+        )
+        writer.array[...] = imgs_pred
+        writer.commit()
+        return imgs_pred
+
+
+class ReconstructionWriter:
+    """
+    Memory map to a temporary .npy file of its own, moved to its final path
+    on commit, so that an interrupted run never leaves an incomplete
+    reconstruction file and concurrent runs on the same model (e.g.
+    finetune.py with several dtypes) never write to the same file.
+    """
+
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.tmp_path = utils.get_tmp_path(path)
+        try:
+            self.array = np.lib.format.open_memmap(
+                self.tmp_path, mode="w+", dtype=dtype, shape=tuple(shape)
+            )
+        except BaseException:
+            os.remove(self.tmp_path)
+            raise
+
+    def commit(self):
+        self.array.flush()
+        self.array = None
+        os.replace(self.tmp_path, self.path)
+        logger.info("reconstructions stored at {}".format(self.path))
+
+
+def predict(store, model, imgs_input, group, directory, filenames):
+    """
+    Returns the reconstructions of imgs_input, through the store (see
+    ReconstructionStore.predict) unless store is None.
+    """
+    if store is not None:
+        return store.predict(model, imgs_input, group, directory, filenames)
+    with timing.timer("predict"):
+        imgs_pred = model.predict(imgs_input)
+    timing.count("images_predicted", len(imgs_input))
+    return imgs_pred
+
+
+def hash_file(path, chunk_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
@@ -1,10 +1,15 @@
 import os
-import time
 import numpy as np
+import tensorflow as tf
 from skimage.metrics import structural_similarity as ssim
+from skimage.util.dtype import dtype_range
 from processing import utils
+from processing import parallel
+from processing import timing
 from processing.utils import printProgressBar as printProgressBar
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from skimage.util import img_as_ubyte
 from skimage.segmentation import clear_border
 from skimage.measure import label, regionprops
@@ -16,9 +21,14 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Datatypes of resmaps: float resmaps share the same threshold grids,
+# float32 and float16 halve and quarter the memory of float64 resmaps
+RESMAP_DTYPES = ["float64", "float32", "float16", "uint8"]
+FLOAT_DTYPES = ["float64", "float32", "float16"]
+
 # Segmentation Parameters
 
-# float + SSIM
+# float + SSIM (steps must exceed the float16 spacing, 2 ** -11 below 1)
 THRESH_MIN_FLOAT_SSIM = 0.35
 THRESH_STEP_FLOAT_SSIM = 0.002
 
@@ -34,6 +44,38 @@ THRESH_STEP_UINT8_SSIM = 1
 THRESH_MIN_UINT8_L2 = 5
 THRESH_STEP_UINT8_L2 = 1
 
+# Labelling backends of label_images, the fastest available one by default
+LABEL_BACKENDS = ["skimage", "opencv"]
+if hasattr(cv2, "connectedComponentsWithStatsWithAlgorithm"):
+    LABEL_BACKEND = "opencv"
+else:
+    LABEL_BACKEND = "skimage"
+
+# number of pixels closed and labeled at once by label_areas, e.g. 16
+# images of 256 x 256 (larger batches no longer fit in the CPU cache)
+LABEL_BATCH_PIXELS = 2 ** 20
+
+# SSIM Parameters (same semantics as skimage's structural_similarity)
+SSIM_WIN_SIZE = 11
+SSIM_SIGMA = 1.5
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+# engines of SSIM resmaps: one filtering pass over a stack of images, or
+# skimage's structural_similarity once per image (see calculate_resmaps)
+SSIM_ENGINES = ["batch", "skimage"]
+
+# number of images processed at once by the batch SSIM engine
+# (small batches keep the intermediate float64 arrays in CPU cache)
+SSIM_BATCH_SIZE = 2
+
+# number of images converted at once by rgb_to_grayscale
+GRAYSCALE_BATCH_SIZE = 64
+
+# number of shards of inspection plots per worker process (smaller shards
+# balance the load and update the progress bar more often)
+PLOT_SHARDS_PER_WORKER = 4
+
 
 class TensorImages:
     def __init__(
@@ -45,12 +87,15 @@ class TensorImages:
         method,
         dtype="float64",
         filenames=None,
+        ssim_engine="batch",
+        workers=1,
     ):
         assert imgs_input.ndim == 3
         assert imgs_pred.ndim == 3
         self.imgs_input = imgs_input
         self.imgs_pred = imgs_pred
         self.dtype = dtype
+        self.workers = workers
 
         # pixel min and max values of input and reconstruction (pred)
         # depend on preprocessing function, which in turn depends on
@@ -59,97 +104,140 @@ class TensorImages:
         self.vmax = vmax
 
         # compute resmaps
-        assert dtype in ["float64", "uint8"]
+        assert dtype in RESMAP_DTYPES
         assert method in ["l2", "ssim", "mssim"]
-        self.resmaps = calculate_resmaps(self.imgs_input, self.imgs_pred, method, dtype)
-        if dtype == "float64":
+        self.resmaps = calculate_resmaps(
+            self.imgs_input,
+            self.imgs_pred,
+            method,
+            dtype,
+            ssim_engine=ssim_engine,
+            workers=workers,
+        )
+        self.thresh_min, self.thresh_step = get_thresh_parameters(method, dtype)
+        if dtype in FLOAT_DTYPES:
             if method in ["ssim", "mssim"]:
-                self.thresh_min = THRESH_MIN_FLOAT_SSIM
-                self.thresh_step = THRESH_STEP_FLOAT_SSIM
                 self.vmin_resmap = 0.0
                 self.vmax_resmap = 1.0
             elif method == "l2":
-                self.thresh_min = THRESH_MIN_FLOAT_L2
-                self.thresh_step = THRESH_STEP_FLOAT_L2
                 self.vmin_resmap = None
                 self.vmax_resmap = None
         elif dtype == "uint8":
-            if method in ["ssim", "mssim"]:
-                self.thresh_min = THRESH_MIN_UINT8_SSIM
-                self.thresh_step = THRESH_STEP_UINT8_SSIM
-                self.vmin_resmap = 0
-                self.vmax_resmap = 255
-            elif method == "l2":
-                self.thresh_min = THRESH_MIN_UINT8_L2
-                self.thresh_step = THRESH_STEP_UINT8_L2
-                self.vmin_resmap = 0
-                self.vmax_resmap = 255
-            # Convert to 8-bit unsigned int
-            self.resmaps = img_as_ubyte(self.resmaps)
-
-        # compute maximal threshold based on resmaps
-        self.thresh_max = np.amax(self.resmaps)
+            self.vmin_resmap = 0
+            self.vmax_resmap = 255
+
+        # compute maximal threshold based on resmaps (as a python scalar,
+        # so that threshold grids are float64 whatever the resmaps dtype)
+        self.thresh_max = np.amax(self.resmaps).item()
         self.method = method
         self.filenames = filenames
 
-    def generate_inspection_plots(self, group, save_dir=None):
+    @timing.timed("generate_inspection_plots")
+    def generate_inspection_plots(self, group, save_dir=None, workers=None):
+        """
+        Plots the input, reconstruction and resmap of each image. If save_dir
+        is passed, plots are rendered off-screen with the Agg backend and
+        saved as *_inspection.png files, by a pool of worker processes if
+        workers > 1 (the default is the number of workers of the instance).
+        """
         assert group in ["validation", "test"]
+        if workers is None:
+            workers = self.workers
+        workers = parallel.get_workers(workers)
         logger.info("generating inspection plots on " + group + " images...")
         l = len(self.filenames)
         printProgressBar(0, l, prefix="Progress:", suffix="Complete", length=50)
-        for i in range(len(self.imgs_input)):
-            self.plot_input_pred_resmap(index=i, group=group, save_dir=save_dir)
-            # print progress bar
-            time.sleep(0.1)
-            printProgressBar(i + 1, l, prefix="Progress:", suffix="Complete", length=50)
+        if save_dir is not None and workers > 1 and l > 1:
+            shards = parallel.split_indices(l, workers * PLOT_SHARDS_PER_WORKER)
+            for stop in save_inspection_plots_parallel(
+                self, group, save_dir, shards, workers
+            ):
+                printProgressBar(
+                    stop, l, prefix="Progress:", suffix="Complete", length=50
+                )
+        else:
+            for i in range(len(self.imgs_input)):
+                self.plot_input_pred_resmap(index=i, group=group, save_dir=save_dir)
+                # print progress bar
+                printProgressBar(
+                    i + 1, l, prefix="Progress:", suffix="Complete", length=50
+                )
         if save_dir is not None:
+            timing.count("plots_saved", l)
             logger.info("all generated files are saved at: \n{}".format(save_dir))
         return
 
-    ### plottings methods for inspection
+    @timing.timed("generate_contact_sheets")
+    def generate_contact_sheets(self, group, save_dir, cols=None, rows=None, scale=1.0):
+        """
+        Composes the input, reconstruction and resmap of each image into
+        tiles with NumPy and saves them on a few large PNG sheets, with a
+        JSON index of the filenames of the tiles (see contact_sheets). Much
+        faster than generate_inspection_plots for reviewing many images.
+        """
+        # imported here since contact_sheets depends on this module
+        from processing import contact_sheets
 
-    def plot_input_pred_resmap(self, index, group, save_dir=None):
         assert group in ["validation", "test"]
-        fig, axarr = plt.subplots(3, 1)
-        fig.set_size_inches((4, 9))
-
-        im00 = axarr[0].imshow(
-            self.imgs_input[index], cmap="gray", vmin=self.vmin, vmax=self.vmax,
+        logger.info("generating contact sheets of " + group + " images...")
+        index = contact_sheets.save_contact_sheets(
+            self.imgs_input,
+            self.imgs_pred,
+            self.resmaps,
+            self.filenames,
+            save_dir,
+            vmin=self.vmin,
+            vmax=self.vmax,
+            vmin_resmap=self.vmin_resmap,
+            vmax_resmap=self.vmax_resmap,
+            prefix=group,
+            cols=cols or contact_sheets.SHEET_COLS,
+            rows=rows or contact_sheets.SHEET_ROWS,
+            scale=scale,
         )
-        axarr[0].set_title("input")
-        axarr[0].set_axis_off()
-        fig.colorbar(im00, ax=axarr[0])
+        timing.count("contact_sheet_tiles", len(self.filenames))
+        return index
 
-        im10 = axarr[1].imshow(
-            self.imgs_pred[index], cmap="gray", vmin=self.vmin, vmax=self.vmax
-        )
-        axarr[1].set_title("pred")
-        axarr[1].set_axis_off()
-        fig.colorbar(im10, ax=axarr[1])
+    ### plottings methods for inspection
+
+    def get_plot_parameters(self, group):
+        """Returns the parameters of draw_inspection_plot common to all images."""
+        return {
+            "group": group,
+            "vmin": self.vmin,
+            "vmax": self.vmax,
+            "vmin_resmap": self.vmin_resmap,
+            "vmax_resmap": self.vmax_resmap,
+            "resmap_title": "resmap_" + self.method + "_" + self.dtype,
+        }
 
-        im20 = axarr[2].imshow(
+    def plot_input_pred_resmap(self, index, group, save_dir=None):
+        assert group in ["validation", "test"]
+        if save_dir is None:
+            # interactive figure, managed by pyplot
+            fig = plt.figure()
+        else:
+            # off-screen figure, freed as soon as it is saved
+            fig = Figure()
+            FigureCanvasAgg(fig)
+        draw_inspection_plot(
+            fig,
+            self.imgs_input[index],
+            self.imgs_pred[index],
             self.resmaps[index],
-            cmap="inferno",
-            vmin=self.vmin_resmap,
-            vmax=self.vmax_resmap,
+            self.filenames[index],
+            **self.get_plot_parameters(group)
         )
-        axarr[2].set_title("resmap_" + self.method + "_" + self.dtype)
-        axarr[2].set_axis_off()
-        fig.colorbar(im20, ax=axarr[2])
-
-        plt.suptitle(group.upper() + "\n" + self.filenames[index])
-
         if save_dir is not None:
             plot_name = get_plot_name(self.filenames[index], suffix="inspection")
             fig.savefig(os.path.join(save_dir, plot_name))
-            plt.close(fig=fig)
         return
 
     def plot_image(self, plot_type, index):
         assert plot_type in ["input", "pred", "resmap"]
         # select image to plot
         if plot_type == "input":
-            image = self.imgs_input[index]
+            image = as_float_images(self.imgs_input[index])
             cmap = "gray"
             vmin = self.vmin
             vmax = self.vmax
@@ -174,6 +262,124 @@ class TensorImages:
         return
 
 
+def get_thresh_parameters(method, dtype):
+    """Returns the minimal threshold and the threshold step of resmaps."""
+    if dtype in FLOAT_DTYPES:
+        if method in ["ssim", "mssim"]:
+            return THRESH_MIN_FLOAT_SSIM, THRESH_STEP_FLOAT_SSIM
+        return THRESH_MIN_FLOAT_L2, THRESH_STEP_FLOAT_L2
+    if method in ["ssim", "mssim"]:
+        return THRESH_MIN_UINT8_SSIM, THRESH_STEP_UINT8_SSIM
+    return THRESH_MIN_UINT8_L2, THRESH_STEP_UINT8_L2
+
+
+def draw_inspection_plot(
+    fig,
+    img_input,
+    img_pred,
+    resmap,
+    filename,
+    group,
+    vmin,
+    vmax,
+    vmin_resmap,
+    vmax_resmap,
+    resmap_title,
+):
+    """Draws the input, reconstruction and resmap of an image on fig."""
+    axarr = fig.subplots(3, 1)
+    fig.set_size_inches((4, 9))
+
+    im00 = axarr[0].imshow(
+        as_float_images(img_input), cmap="gray", vmin=vmin, vmax=vmax,
+    )
+    axarr[0].set_title("input")
+    axarr[0].set_axis_off()
+    fig.colorbar(im00, ax=axarr[0])
+
+    im10 = axarr[1].imshow(img_pred, cmap="gray", vmin=vmin, vmax=vmax)
+    axarr[1].set_title("pred")
+    axarr[1].set_axis_off()
+    fig.colorbar(im10, ax=axarr[1])
+
+    im20 = axarr[2].imshow(resmap, cmap="inferno", vmin=vmin_resmap, vmax=vmax_resmap)
+    axarr[2].set_title(resmap_title)
+    axarr[2].set_axis_off()
+    fig.colorbar(im20, ax=axarr[2])
+
+    fig.suptitle(group.upper() + "\n" + filename)
+    return
+
+
+def save_inspection_plots_parallel(tensor_images, group, save_dir, shards, workers):
+    """
+    Renders and saves the inspection plots of tensor_images (see
+    TensorImages.generate_inspection_plots) over a pool of worker processes.
+    Images, reconstructions and resmaps are placed in shared memory, workers
+    receive the bounds of their shard of images. Yields the number of plots
+    saved as shards complete.
+    """
+    shared_input = parallel.SharedArray.from_array(tensor_images.imgs_input)
+    shared_pred = parallel.SharedArray.from_array(tensor_images.imgs_pred)
+    shared_resmaps = parallel.SharedArray.from_array(tensor_images.resmaps)
+    try:
+        tasks = [
+            (
+                shared_input,
+                shared_pred,
+                shared_resmaps,
+                start,
+                stop,
+                tensor_images.filenames[start:stop],
+                tensor_images.get_plot_parameters(group),
+                save_dir,
+            )
+            for start, stop in shards
+        ]
+        nb_saved = 0
+        with parallel.get_pool(workers, initializer=init_resmaps_worker) as pool:
+            for nb_plots in pool.imap_unordered(save_inspection_plots_shard, tasks):
+                nb_saved += nb_plots
+                yield nb_saved
+    finally:
+        shared_input.close()
+        shared_pred.close()
+        shared_resmaps.close()
+
+
+def save_inspection_plots_shard(task):
+    (
+        shared_input,
+        shared_pred,
+        shared_resmaps,
+        start,
+        stop,
+        filenames,
+        plot_parameters,
+        save_dir,
+    ) = task
+    try:
+        for index, filename in zip(range(start, stop), filenames):
+            # copies, so that no view of the shared blocks outlives the figure
+            fig = Figure()
+            FigureCanvasAgg(fig)
+            draw_inspection_plot(
+                fig,
+                np.array(shared_input.array[index]),
+                np.array(shared_pred.array[index]),
+                np.array(shared_resmaps.array[index]),
+                filename,
+                **plot_parameters
+            )
+            plot_name = get_plot_name(filename, suffix="inspection")
+            fig.savefig(os.path.join(save_dir, plot_name))
+    finally:
+        shared_input.close()
+        shared_pred.close()
+        shared_resmaps.close()
+    return stop - start
+
+
 def get_plot_name(filename, suffix):
     filename_new, ext = os.path.splitext(filename)
     filename_new = "_".join(filename_new.split("/")) + "_" + suffix + ext
@@ -185,27 +391,184 @@ def get_plot_name(filename, suffix):
 ## Functions for generating Resmaps
 
 
-def calculate_resmaps(imgs_input, imgs_pred, method, dtype="float64"):
-    if method == "l2":
+@timing.timed("calculate_resmaps")
+def calculate_resmaps(
+    imgs_input, imgs_pred, method, dtype="float64", ssim_engine="batch", workers=1
+):
+    """
+    Computes residual maps between input and reconstructed images.
+
+    dtype is the datatype of the returned resmaps (see RESMAP_DTYPES).
+    uint8 input images (see Preprocessor's input_dtype) are rescaled to
+    [0, 1] batch by batch, as the model rescales them.
+    float32 and float16 SSIM resmaps are computed in float32, float64 and
+    uint8 ones in float64 (uint8 resmaps are converted with img_as_ubyte).
+
+    ssim_engine selects how SSIM resmaps are computed: "batch" filters the
+    whole (N, H, W) stack at once (see resmaps_ssim_batch), "skimage" calls
+    skimage's structural_similarity once per image. Both engines yield the
+    same resmaps up to floating point rounding.
+
+    With workers > 1, the images are split into contiguous shards that are
+    processed by a pool of worker processes (see calculate_resmaps_parallel).
+    """
+    assert ssim_engine in SSIM_ENGINES
+    assert dtype in RESMAP_DTYPES
+    timing.count("resmaps_computed", len(imgs_input))
+    if parallel.get_workers(workers) > 1:
+        resmaps = calculate_resmaps_parallel(
+            imgs_input, imgs_pred, method, dtype, ssim_engine, workers
+        )
+    elif method == "l2":
         resmaps = resmaps_l2(imgs_input, imgs_pred)
     elif method in ["ssim", "mssim"]:
-        resmaps = resmaps_ssim(imgs_input, imgs_pred)
+        if ssim_engine == "batch":
+            resmaps = resmaps_ssim_batch(
+                imgs_input, imgs_pred, dtype=get_compute_dtype(dtype)
+            )
+        else:
+            resmaps = resmaps_ssim(imgs_input, imgs_pred)
     if dtype == "uint8":
         resmaps = img_as_ubyte(resmaps)
+    elif dtype in ["float32", "float16"]:
+        resmaps = resmaps.astype(dtype, copy=False)
+    return resmaps
+
+
+def as_float_images(imgs, dtype=None):
+    """
+    Returns images as floats, of dtype if passed. uint8 images are
+    multiplied by 1/255 in float32, which yields the same values as the
+    rescaling of the Preprocessor or of the Rescale layer of the model.
+    """
+    if imgs.dtype == np.uint8:
+        imgs = np.multiply(imgs, np.float32(1 / 255), dtype="float32")
+    if dtype is None:
+        return imgs
+    return imgs.astype(dtype, copy=False)
+
+
+def rgb_to_grayscale(imgs, batch_size=GRAYSCALE_BATCH_SIZE):
+    """
+    Converts RGB images of shape (N, H, W, 3) to float grayscale images of
+    shape (N, H, W, 1) with tf.image.rgb_to_grayscale, batch by batch, so
+    that uint8 images are never rescaled (see as_float_images) all at once.
+    """
+    imgs_gray = np.empty(imgs.shape[:-1] + (1,), dtype="float32")
+    for start in range(0, len(imgs), batch_size):
+        batch = as_float_images(imgs[start : start + batch_size])
+        imgs_gray[start : start + len(batch)] = tf.image.rgb_to_grayscale(batch)
+    return imgs_gray
+
+
+def get_compute_dtype(dtype):
+    """Returns the float datatype in which resmaps of dtype are computed."""
+    return "float32" if dtype in ["float32", "float16"] else "float64"
+
+
+def cast_threshold(resmaps, threshold):
+    """
+    Returns threshold as a scalar of the datatype of resmaps, so that
+    thresholding a float32 or float16 resmap compares values in its own
+    precision, whatever numpy's casting rules for mixed-precision operands.
+    Thresholds (a scalar or an array of thresholds) above the range of
+    integer resmaps, e.g. the last threshold 256 of a uint8 grid, are
+    clipped to its maximum instead of wrapping around, so that no pixel
+    exceeds them.
+    """
+    if np.issubdtype(resmaps.dtype, np.integer):
+        threshold = np.minimum(threshold, np.iinfo(resmaps.dtype).max)
+    return resmaps.dtype.type(threshold)
+
+
+def calculate_resmaps_parallel(
+    imgs_input, imgs_pred, method, dtype, ssim_engine, workers
+):
+    """
+    Computes resmaps over a pool of worker processes. Input, reconstruction
+    and output stacks are placed in shared memory, workers only receive the
+    names of the shared blocks and the bounds of their shard and write their
+    resmaps directly into the shared output buffer.
+    """
+    # shards return float resmaps, converted to uint8 by calculate_resmaps
+    if dtype == "uint8":
+        dtype = "float64"
+    if method == "l2" and dtype == "float64":
+        out_dtype = np.result_type(imgs_input, imgs_pred)
+    else:
+        out_dtype = dtype
+    shared_input = parallel.SharedArray.from_array(imgs_input)
+    shared_pred = parallel.SharedArray.from_array(imgs_pred)
+    shared_resmaps = parallel.SharedArray(imgs_input.shape, out_dtype)
+    try:
+        tasks = [
+            (
+                shared_input,
+                shared_pred,
+                shared_resmaps,
+                start,
+                stop,
+                method,
+                dtype,
+                ssim_engine,
+            )
+            for start, stop in parallel.split_indices(len(imgs_input), workers)
+        ]
+        with parallel.get_pool(workers, initializer=init_resmaps_worker) as pool:
+            pool.map(calculate_resmaps_shard, tasks)
+        resmaps = np.array(shared_resmaps.array)
+    finally:
+        shared_input.close()
+        shared_pred.close()
+        shared_resmaps.close()
     return resmaps
 
 
+def init_resmaps_worker():
+    # one process per core, so keep OpenCV from spawning its own threads
+    cv2.setNumThreads(1)
+
+
+def calculate_resmaps_shard(task):
+    (
+        shared_input,
+        shared_pred,
+        shared_resmaps,
+        start,
+        stop,
+        method,
+        dtype,
+        ssim_engine,
+    ) = task
+    try:
+        shared_resmaps.array[start:stop] = calculate_resmaps(
+            shared_input.array[start:stop],
+            shared_pred.array[start:stop],
+            method,
+            dtype=dtype,
+            ssim_engine=ssim_engine,
+        )
+    finally:
+        shared_input.close()
+        shared_pred.close()
+        shared_resmaps.close()
+    return
+
+
 def resmaps_ssim(imgs_input, imgs_pred):
     resmaps = np.zeros(shape=imgs_input.shape, dtype="float64")
     for index in range(len(imgs_input)):
-        img_input = imgs_input[index]
-        img_pred = imgs_pred[index]
+        img_input = as_float_images(imgs_input[index])
+        img_pred = as_float_images(imgs_pred[index])
+        # default of skimage < 0.19 (float images), mandatory since then
+        dmin, dmax = dtype_range[img_input.dtype.type]
         _, resmap = ssim(
             img_input,
             img_pred,
-            win_size=11,
+            data_range=dmax - dmin,
+            win_size=SSIM_WIN_SIZE,
             gaussian_weights=True,
-            sigma=1.5,
+            sigma=SSIM_SIGMA,
             full=True,
         )
         # resmap = np.expand_dims(resmap, axis=-1)
@@ -214,15 +577,121 @@ def resmaps_ssim(imgs_input, imgs_pred):
     return resmaps
 
 
+def resmaps_ssim_batch(
+    imgs_input, imgs_pred, data_range=None, batch_size=SSIM_BATCH_SIZE, dtype="float64"
+):
+    """
+    Computes SSIM residual maps for a whole stack of images at once.
+    Equivalent to resmaps_ssim, but the gaussian weighting (win_size=11,
+    sigma=1.5) is applied with one separable filtering pass over each
+    (N, H, W) batch instead of calling skimage once per image.
+
+    Parameters
+    ----------
+    imgs_input : array
+        Input images of shape (N, H, W).
+    imgs_pred : array
+        Reconstructed images of shape (N, H, W).
+    data_range : float, optional
+        Dynamic range of the images. The default is derived from the dtype
+        of the computation, as skimage does (2.0 for float images); uint8
+        images are rescaled to [0, 1] first (see as_float_images).
+    batch_size : int, optional
+        Number of images filtered at once. Bounds the memory used by the
+        intermediate float arrays; small batches stay in CPU cache.
+        The default is SSIM_BATCH_SIZE.
+    dtype : str, optional
+        Float datatype of the computation and of the resmaps, "float64"
+        or "float32". The default is "float64".
+
+    Returns
+    -------
+    resmaps : array of dtype
+        SSIM residual maps (1 - SSIM), clipped to [-1, 1].
+
+    """
+    assert imgs_input.shape == imgs_pred.shape
+    if data_range is None:
+        dmin, dmax = dtype_range[np.dtype(dtype).type]
+        data_range = dmax - dmin
+
+    # sample covariance normalization, filter has already normalized by NP
+    NP = SSIM_WIN_SIZE ** 2
+    cov_norm = NP / (NP - 1)
+    C1 = (SSIM_K1 * data_range) ** 2
+    C2 = (SSIM_K2 * data_range) ** 2
+
+    resmaps = np.zeros(shape=imgs_input.shape, dtype=dtype)
+    for start in range(0, len(imgs_input), batch_size):
+        stop = start + batch_size
+        X = as_float_images(imgs_input[start:stop], dtype)
+        Y = as_float_images(imgs_pred[start:stop], dtype)
+        n = len(X)
+
+        # filter all five moments in one pass: x, y, x^2, y^2, xy
+        moments = gaussian_filter_batch(
+            [X, Y, X * X, Y * Y, X * Y], SSIM_WIN_SIZE, SSIM_SIGMA
+        )
+        ux, uy, uxx, uyy, uxy = np.split(moments, 5)
+
+        # compute (weighted) variances and covariances
+        vx = cov_norm * (uxx - ux * ux)
+        vy = cov_norm * (uyy - uy * uy)
+        vxy = cov_norm * (uxy - ux * uy)
+
+        A1 = 2 * ux * uy + C1
+        A2 = 2 * vxy + C2
+        B1 = ux ** 2 + uy ** 2 + C1
+        B2 = vx + vy + C2
+        resmaps[start : start + n] = 1 - (A1 * A2) / (B1 * B2)
+    resmaps = np.clip(resmaps, a_min=-1, a_max=1)
+    return resmaps
+
+
+def gaussian_filter_batch(stacks, win_size, sigma):
+    """
+    Applies a gaussian filter to every image of one or more (N, H, W) stacks
+    with a single separable cv2 call. The stacks are copied into one buffer
+    in which each image is padded by reflection along its height, so the
+    vertical pass never mixes neighbouring images. Borders are reflected as
+    in scipy.ndimage.gaussian_filter(mode="reflect").
+    Returns the filtered images as one (len(stacks) * N, H, W) array, of
+    the datatype of the stacks.
+    """
+    n, h, w = stacks[0].shape
+    radius = (win_size - 1) // 2
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    kernel = kernel / kernel.sum()
+
+    # copy images into padded buffer and reflect their top and bottom rows
+    padded = np.empty((len(stacks) * n, h + 2 * radius, w), dtype=stacks[0].dtype)
+    for i, stack in enumerate(stacks):
+        padded[i * n : (i + 1) * n, radius:-radius] = stack
+    padded[:, :radius] = padded[:, radius : 2 * radius][:, ::-1]
+    padded[:, -radius:] = padded[:, -2 * radius : -radius][:, ::-1]
+
+    filtered = cv2.sepFilter2D(
+        padded.reshape(-1, w),
+        ddepth=-1,
+        kernelX=kernel,
+        kernelY=kernel,
+        borderType=cv2.BORDER_REFLECT,
+    )
+    filtered = filtered.reshape(padded.shape)[:, radius:-radius]
+    return filtered
+
+
 def resmaps_l2(imgs_input, imgs_pred):
-    resmaps = (imgs_input - imgs_pred) ** 2
+    resmaps = (as_float_images(imgs_input) - as_float_images(imgs_pred)) ** 2
     return resmaps
 
 
 ## functions for processing resmaps
 
 
-def label_images(images_th):
+@timing.timed("label_images")
+def label_images(images_th, backend=None):
     """
     Segments images into images of connected components (regions).
     Returns segmented images and a list of lists, whereby each list 
@@ -232,8 +701,9 @@ def label_images(images_th):
     ----------
     images_th : array of uint8
         Thresholded residual maps.
-    kernel_size : int, optional
-        Size of the kernel window. The default is 3.
+    backend : str, optional
+        "skimage" or "opencv", both return the same labeled images and
+        areas. The default is LABEL_BACKEND, the fastest available one.
 
     Returns
     -------
@@ -243,6 +713,14 @@ def label_images(images_th):
         List of lists, whereby each list contains the areas of the regions of the corresponding image.
 
     """
+    timing.count("images_labeled", len(images_th))
+    if backend is None:
+        backend = LABEL_BACKEND
+    if backend == "opencv":
+        return label_images_opencv(images_th)
+    if backend != "skimage":
+        raise ValueError("backend must be one of {}".format(LABEL_BACKENDS))
+
     images_labeled = np.zeros(shape=images_th.shape)
     areas_all = []
     for i, image_th in enumerate(images_th):
@@ -272,6 +750,250 @@ def label_images(images_th):
     return images_labeled, areas_all
 
 
+def label_images_opencv(images_th):
+    """
+    OpenCV implementation of label_images. Closing with a 3x3 square
+    ignores pixels outside the image, as skimage's closing does with its
+    reflected borders. Components are labeled with 8-connectivity by the
+    SAUF algorithm, which numbers them in raster order of their first pixel
+    like skimage's label; components touching the border are then dropped
+    and the others renumbered, as clear_border followed by label.
+    """
+    images_labeled = np.zeros(shape=images_th.shape)
+    areas_all = []
+    for i, image_th in enumerate(images_th):
+        image_labeled, stats, inner = label_components_opencv(image_th)
+
+        # remove regions connected to image border, keep label order
+        relabel = np.zeros(len(stats), dtype="int32")
+        relabel[1:][inner] = np.arange(1, np.count_nonzero(inner) + 1)
+        images_labeled[i] = relabel[image_labeled]
+
+        # compute areas of anomalous regions in the current image
+        areas = stats[1:, cv2.CC_STAT_AREA][inner]
+        if len(areas):
+            areas_all.append(areas.tolist())
+        else:
+            areas_all.append([0])
+
+    return images_labeled, areas_all
+
+
+def label_components_opencv(image_th):
+    """
+    Closes and labels a thresholded image, returns the labeled image, the
+    statistics of its components (background first) and a mask of the
+    components not touching the image border.
+    """
+    # close small holes with binary closing
+    bw = cv2.morphologyEx(
+        np.asarray(image_th, dtype=bool).view("uint8"),
+        cv2.MORPH_CLOSE,
+        np.ones((3, 3), dtype="uint8"),
+    )
+
+    # label image regions
+    _, image_labeled, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(
+        bw, connectivity=8, ltype=cv2.CV_32S, ccltype=cv2.CCL_WU
+    )
+
+    # regions connected to image border
+    height, width = image_th.shape
+    left, top = stats[1:, cv2.CC_STAT_LEFT], stats[1:, cv2.CC_STAT_TOP]
+    right = left + stats[1:, cv2.CC_STAT_WIDTH]
+    bottom = top + stats[1:, cv2.CC_STAT_HEIGHT]
+    inner = (left > 0) & (top > 0) & (right < width) & (bottom < height)
+    return image_labeled, stats, inner
+
+
+@timing.timed("label_areas")
+def label_areas(images, threshold=None, backend=None, batch_size=None):
+    """
+    Areas-only variant of label_images: returns the areas of the regions of
+    each image as RegionAreas, without allocating labeled images. If a
+    threshold is passed, images are residual maps thresholded one batch at
+    a time, so that no thresholded copy of the whole stack is allocated.
+
+    Parameters
+    ----------
+    images : array
+        Thresholded residual maps, or residual maps if threshold is passed.
+    threshold : float, optional
+        Threshold applied to each residual map. The default is None.
+    backend : str, optional
+        "skimage" or "opencv". The default is LABEL_BACKEND.
+    batch_size : int, optional
+        Number of images closed and labeled at once by the opencv backend
+        (see label_stack_opencv), 1 processes images one by one. The
+        default is the number of images holding LABEL_BATCH_PIXELS pixels.
+
+    Returns
+    -------
+    region_areas : RegionAreas
+        Areas of the regions of each image, same values as label_images.
+
+    """
+    timing.count("images_labeled", len(images))
+    if backend is None:
+        backend = LABEL_BACKEND
+    if backend not in LABEL_BACKENDS:
+        raise ValueError("backend must be one of {}".format(LABEL_BACKENDS))
+    if batch_size is None:
+        batch_size = max(LABEL_BATCH_PIXELS // (images.shape[1] * images.shape[2]), 1)
+    if threshold is not None:
+        threshold = cast_threshold(images, threshold)
+
+    if backend == "opencv" and batch_size > 1:
+        areas_all = [
+            label_stack_opencv(images[start : start + batch_size], threshold)
+            for start in range(0, len(images), batch_size)
+        ]
+        return RegionAreas.concatenate(areas_all)
+
+    areas_all = []
+    for image in images:
+        image_th = image if threshold is None else image > threshold
+        if backend == "opencv":
+            _, stats, inner = label_components_opencv(image_th)
+            areas = stats[1:, cv2.CC_STAT_AREA][inner]
+        else:
+            image_labeled = label(clear_border(closing(image_th, square(3))))
+            areas = np.bincount(image_labeled.ravel())[1:]
+        areas_all.append(areas if len(areas) else np.zeros(1, dtype="int32"))
+    return RegionAreas.from_arrays(areas_all)
+
+
+def label_stack_opencv(images, threshold=None):
+    """
+    Closes and labels a stack of (thresholded) images of shape (N, H, W)
+    with single OpenCV calls, returns the areas of their regions as
+    RegionAreas.
+
+    Images are stacked vertically into one tall image, each one framed by
+    an extra row above and below that keeps images apart. While closing,
+    these rows hold copies of the first and last rows of the image (of the
+    dilated image before eroding), so that every pixel sees the same
+    neighbourhood as when closing the image alone. While labelling, they
+    are zero, so that no region connects two images. The image and the
+    bounding box of each region within its image follow from the bounding
+    box of the region in the tall image.
+    """
+    n, height, width = images.shape
+    kernel = np.ones((3, 3), dtype="uint8")
+
+    # stack (thresholded) images with framing rows
+    tall = np.empty((n, height + 2, width), dtype="uint8")
+    if threshold is None:
+        tall[:, 1:-1] = images
+    else:
+        np.greater(images, threshold, out=tall[:, 1:-1].view(bool))
+    tall[:, 0], tall[:, -1] = tall[:, 1], tall[:, -2]
+    tall_2d = tall.reshape(-1, width)
+
+    # close small holes with binary closing
+    cv2.dilate(tall_2d, kernel, dst=tall_2d)
+    tall[:, 0], tall[:, -1] = tall[:, 1], tall[:, -2]
+    cv2.erode(tall_2d, kernel, dst=tall_2d)
+    tall[:, 0], tall[:, -1] = 0, 0
+
+    # label image regions, in raster order of the tall image
+    _, _, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(
+        tall_2d, connectivity=8, ltype=cv2.CV_32S, ccltype=cv2.CCL_WU
+    )
+    stats = stats[1:]
+
+    # remove regions connected to the border of their image
+    image_indices, top = np.divmod(stats[:, cv2.CC_STAT_TOP], height + 2)
+    left = stats[:, cv2.CC_STAT_LEFT]
+    right = left + stats[:, cv2.CC_STAT_WIDTH]
+    bottom = top + stats[:, cv2.CC_STAT_HEIGHT]
+    inner = (left > 0) & (top > 1) & (right < width) & (bottom < height + 1)
+
+    # split areas per image
+    counts = np.bincount(image_indices[inner], minlength=n)
+    return RegionAreas.from_counts(stats[inner, cv2.CC_STAT_AREA], counts)
+
+
+class RegionAreas:
+    """
+    Compact storage of the region areas returned by label_areas: the areas
+    of all images in one flat buffer, image i owning the slice
+    areas[offsets[i]:offsets[i + 1]]. Images without regions hold the
+    area 0, as in label_images.
+    """
+
+    def __init__(self, areas, offsets):
+        self.areas = areas
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, areas_all):
+        lengths = [len(areas) for areas in areas_all]
+        offsets = np.zeros(len(areas_all) + 1, dtype="int64")
+        offsets[1:] = np.cumsum(lengths)
+        areas = np.fromiter(
+            (area for areas in areas_all for area in areas),
+            dtype="int32",
+            count=offsets[-1],
+        )
+        return cls(areas, offsets)
+
+    @classmethod
+    def from_arrays(cls, areas_all):
+        offsets = np.zeros(len(areas_all) + 1, dtype="int64")
+        offsets[1:] = np.cumsum([len(areas) for areas in areas_all])
+        areas = np.concatenate(areas_all).astype("int32", copy=False)
+        return cls(areas, offsets)
+
+    @classmethod
+    def from_counts(cls, areas, counts):
+        """
+        Builds RegionAreas from the areas of all regions, listed image by
+        image, and the number of regions of each image; images without
+        regions get the area 0.
+        """
+        lengths = np.maximum(counts, 1)
+        offsets = np.zeros(len(counts) + 1, dtype="int64")
+        offsets[1:] = np.cumsum(lengths)
+        areas_all = np.zeros(offsets[-1], dtype="int32")
+        starts = np.cumsum(counts) - counts
+        image_indices = np.repeat(np.arange(len(counts)), counts)
+        ranks = np.arange(len(areas)) - starts[image_indices]
+        positions = offsets[image_indices] + ranks
+        areas_all[positions] = areas
+        return cls(areas_all, offsets)
+
+    @classmethod
+    def concatenate(cls, region_areas_all):
+        offsets = [np.zeros(1, dtype="int64")]
+        for region_areas in region_areas_all:
+            offsets.append(region_areas.offsets[1:] + offsets[-1][-1])
+        areas = np.concatenate(
+            [region_areas.areas for region_areas in region_areas_all]
+        )
+        return cls(areas, np.concatenate(offsets))
+
+    @property
+    def nbytes(self):
+        return self.areas.nbytes + self.offsets.nbytes
+
+    def largest_area(self):
+        return np.amax(self.areas)
+
+    def max_areas(self):
+        # every image owns at least one area
+        return np.maximum.reduceat(self.areas, self.offsets[:-1])
+
+    def region_counts(self):
+        # regions have positive areas, images without regions hold [0]
+        counts = np.diff(self.offsets)
+        counts[self.areas[self.offsets[:-1]] == 0] = 0
+        return counts
+
+    def to_lists(self):
+        return np.split(self.areas, self.offsets[1:-1])
+
+
 # currently unused -----------------------------------------------
 
 
@@ -333,4 +1055,3 @@ def filter_median_images(images, kernel_size=3):
         image_filtered = np.expand_dims(image_filtered, axis=-1)
         images_filtered[i] = image_filtered
     return images_filtered
-
@@ -0,0 +1,251 @@
+"""
+Compact archive of the outputs of a test run, in a single HDF5 file:
+segmentation masks (thresholded resmaps) bit-packed 8 pixels per byte,
+resmaps quantized to uint8 with the offset and scale of each image, and the
+filenames of the images. Datasets are chunked image by image and
+compressed, so that any image is read on its own, and masks for another
+threshold can be computed from the quantized resmaps without running the
+model again. Archives written without compression are stored contiguously
+instead, and their datasets can be memory-mapped.
+
+Quantization is exact for uint8 resmaps. Float resmaps are mapped from
+their [min, max] range per image to [0, 255], so a dequantized value is
+within half a step ((max - min) / 510) of the original one.
+"""
+
+import os
+import numpy as np
+import h5py
+from processing import timing
+from processing.resmaps import cast_threshold
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ARCHIVE_NAME = "run_archive.h5"
+
+# compression of the datasets ("gzip", "lzf" or None) and level of gzip
+COMPRESSIONS = ["gzip", "lzf", None]
+COMPRESSION = "gzip"
+COMPRESSION_LEVEL = 4
+
+
+def pack_masks(masks):
+    """Packs boolean masks (N, H, W) into uint8 arrays (N, H, ceil(W / 8))."""
+    return np.packbits(masks, axis=-1)
+
+
+def unpack_masks(packed, width):
+    """Unpacks masks packed with pack_masks, of the given width."""
+    return np.unpackbits(packed, axis=-1, count=width).view(bool)
+
+
+def quantize_resmaps(resmaps):
+    """
+    Quantizes resmaps (N, H, W) to uint8. Returns the quantized resmaps and
+    the offset and scale of each image, such that
+    resmaps ~ quantized * scale + offset.
+    """
+    if resmaps.dtype == np.uint8:
+        offsets = np.zeros(len(resmaps), dtype="float64")
+        return resmaps, offsets, np.ones(len(resmaps), dtype="float64")
+    offsets = resmaps.min(axis=(1, 2)).astype("float64")
+    scales = (resmaps.max(axis=(1, 2)) - offsets) / 255
+    scales[scales == 0] = 1.0
+    quantized = (resmaps - offsets[:, np.newaxis, np.newaxis]) / scales[
+        :, np.newaxis, np.newaxis
+    ]
+    return np.rint(quantized).astype("uint8"), offsets, scales
+
+
+def dequantize_resmaps(quantized, offsets, scales, dtype="float32"):
+    """Returns the resmaps approximated by quantized resmaps (N, H, W)."""
+    resmaps = quantized.astype(dtype)
+    resmaps *= np.asarray(scales, dtype=dtype)[:, np.newaxis, np.newaxis]
+    resmaps += np.asarray(offsets, dtype=dtype)[:, np.newaxis, np.newaxis]
+    return resmaps
+
+
+class ArchiveWriter:
+    """
+    Writes the resmaps of a run to a temporary archive, chunk by chunk, with
+    their masks at the given threshold. The archive is moved to its final
+    path on commit, once all nb_images images are written, so an
+    interrupted run never leaves an incomplete archive. Keyword attributes
+    (e.g. min_area, method, dtype) are saved with the archive.
+    """
+
+    def __init__(self, path, nb_images, threshold, compression=COMPRESSION, **attrs):
+        assert compression in COMPRESSIONS
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.nb_images = nb_images
+        self.threshold = threshold
+        self.compression = compression
+        self.file = h5py.File(self.tmp_path, "w")
+        self.file.attrs["threshold"] = threshold
+        for name, value in attrs.items():
+            self.file.attrs[name] = value
+        self.filenames = self.file.create_dataset(
+            "filenames", (nb_images,), dtype=h5py.string_dtype()
+        )
+        self.offsets = self.file.create_dataset(
+            "resmap_offsets", (nb_images,), dtype="float64"
+        )
+        self.scales = self.file.create_dataset(
+            "resmap_scales", (nb_images,), dtype="float64"
+        )
+        # created on the first write, once the shape of resmaps is known
+        self.masks = None
+        self.resmaps = None
+        self.index = 0
+
+    def create_datasets(self, shape, dtype):
+        height, width = shape
+        self.file.attrs["shape"] = [height, width]
+        self.file.attrs["resmaps_dtype"] = str(dtype)
+        options = {}
+        if self.compression is not None:
+            options["compression"] = self.compression
+            if self.compression == "gzip":
+                options["compression_opts"] = COMPRESSION_LEVEL
+        packed_shape = (height, (width + 7) // 8)
+        self.masks = self.file.create_dataset(
+            "masks",
+            (self.nb_images,) + packed_shape,
+            dtype="uint8",
+            chunks=(1,) + packed_shape if self.compression else None,
+            **options
+        )
+        self.resmaps = self.file.create_dataset(
+            "resmaps",
+            (self.nb_images, height, width),
+            dtype="uint8",
+            chunks=(1, height, width) if self.compression else None,
+            **options
+        )
+
+    @timing.timed("archive_resmaps")
+    def write(self, filenames, resmaps):
+        """Appends resmaps (N, H, W) of the images filenames to the archive."""
+        if self.resmaps is None:
+            self.create_datasets(resmaps.shape[1:], resmaps.dtype)
+        elif resmaps.shape[1:] != self.resmaps.shape[1:]:
+            raise ValueError(
+                "resmaps of shape {} cannot be archived with resmaps of shape {}".format(
+                    resmaps.shape[1:], self.resmaps.shape[1:]
+                )
+            )
+        start, stop = self.index, self.index + len(resmaps)
+        if stop > self.nb_images:
+            raise ValueError(
+                "archive of {} images is already full".format(self.nb_images)
+            )
+        masks = resmaps > cast_threshold(resmaps, self.threshold)
+        quantized, offsets, scales = quantize_resmaps(resmaps)
+        self.masks[start:stop] = pack_masks(masks)
+        self.resmaps[start:stop] = quantized
+        self.offsets[start:stop] = offsets
+        self.scales[start:stop] = scales
+        self.filenames[start:stop] = list(filenames)
+        self.index = stop
+        timing.count("images_archived", len(resmaps))
+
+    def commit(self):
+        if self.index != self.nb_images:
+            raise ValueError(
+                "archive of {} images committed with {} images".format(
+                    self.nb_images, self.index
+                )
+            )
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp_path, self.path)
+        logger.info("run archive saved at {}".format(self.path))
+
+
+class RunArchive:
+    """
+    Reads an archive written by ArchiveWriter, with random access by image
+    index or filename. Masks are returned as boolean arrays, resmaps are
+    dequantized (float32, or uint8 for uint8 resmaps).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = h5py.File(path, "r")
+        self.filenames = [
+            filename.decode("utf-8") if isinstance(filename, bytes) else filename
+            for filename in self.file["filenames"][:]
+        ]
+        self.indices = {filename: i for i, filename in enumerate(self.filenames)}
+        self.attrs = dict(self.file.attrs)
+        self.threshold = self.attrs["threshold"]
+        self.shape = tuple(self.attrs["shape"])
+        self.offsets = self.file["resmap_offsets"][:]
+        self.scales = self.file["resmap_scales"][:]
+        # uint8 resmaps are archived as they are
+        self.exact = self.attrs["resmaps_dtype"] == "uint8"
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        self.file.close()
+
+    def get_index(self, key):
+        """Returns the index of an image given by its index or filename."""
+        if isinstance(key, str):
+            return self.indices[key]
+        return key
+
+    def get_masks(self, start=0, stop=None):
+        """Returns the masks of images start to stop, at the archived threshold."""
+        return unpack_masks(self.file["masks"][start:stop], self.shape[1])
+
+    def get_mask(self, key):
+        index = self.get_index(key)
+        return self.get_masks(index, index + 1)[0]
+
+    def get_resmaps(self, start=0, stop=None):
+        """Returns the (dequantized) resmaps of images start to stop."""
+        quantized = self.file["resmaps"][start:stop]
+        if self.exact:
+            return quantized
+        return dequantize_resmaps(
+            quantized, self.offsets[start:stop], self.scales[start:stop]
+        )
+
+    def get_resmap(self, key):
+        index = self.get_index(key)
+        return self.get_resmaps(index, index + 1)[0]
+
+    def threshold_masks(self, threshold, start=0, stop=None):
+        """Returns the masks of images start to stop at another threshold."""
+        resmaps = self.get_resmaps(start, stop)
+        return resmaps > cast_threshold(resmaps, threshold)
+
+    def memmap(self, name):
+        """
+        Returns the dataset name ("masks" or "resmaps") as a read-only memory
+        map, for archives written without compression.
+        """
+        dataset = self.file[name]
+        offset = dataset.id.get_offset()
+        if dataset.chunks is not None or offset is None:
+            raise ValueError(
+                "dataset {} is chunked or compressed, it cannot be memory-mapped".format(
+                    name
+                )
+            )
+        return np.memmap(
+            self.path, mode="r", dtype=dataset.dtype, shape=dataset.shape, offset=offset
+        )
@@ -0,0 +1,222 @@
+import os
+import numpy as np
+from keras.preprocessing.image import load_img, img_to_array
+from skimage.util import img_as_ubyte
+from processing import resmaps
+from processing import timing
+from processing import memory_usage
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# minimal overlap (in pixels) between neighbouring tiles
+TILE_OVERLAP = 64
+
+# number of tiles predicted at once
+TILE_BATCH_SIZE = 16
+
+
+class TiledInference:
+    """
+    Computes residual maps of images larger than the input of the model at
+    their full resolution. Each image is covered by overlapping tiles of the
+    input shape of the model, which are predicted batch by batch; the
+    resmaps of the tiles are blended into the resmap of the whole image
+    with a window decreasing linearly towards the borders of the tiles
+    (where SSIM resmaps suffer from border effects).
+
+    Only one batch of tiles and their resmaps are held in memory at once,
+    besides the image and its stitched resmap.
+
+    Parameters
+    ----------
+    model : keras model
+        Trained model, whose input shape gives the tile shape.
+    color_mode : str
+        "grayscale" or "rgb".
+    method : str
+        Method for computing resmaps: "ssim", "mssim" or "l2".
+    dtype : str, optional
+        Datatype of the resmaps (see resmaps.RESMAP_DTYPES).
+        The default is "float64".
+    rescale : float, optional
+        Rescaling factor of the loaded images, None for uint8 images fed to
+        a model rescaling its inputs. The default is None.
+    preprocessing_function : function, optional
+        Function applied to the loaded images before rescaling, as the
+        Preprocessor does (see get_preprocessing_function). The default is
+        None.
+    input_dtype : str, optional
+        Datatype of the loaded images, "float32" or "uint8".
+        The default is "float32".
+    overlap : int, optional
+        Minimal overlap between neighbouring tiles. The default is
+        TILE_OVERLAP.
+    batch_size : int, optional
+        Number of tiles predicted at once. The default is TILE_BATCH_SIZE.
+
+    """
+
+    def __init__(
+        self,
+        model,
+        color_mode,
+        method,
+        dtype="float64",
+        rescale=None,
+        preprocessing_function=None,
+        input_dtype="float32",
+        overlap=TILE_OVERLAP,
+        batch_size=TILE_BATCH_SIZE,
+    ):
+        assert dtype in resmaps.RESMAP_DTYPES
+        self.model = model
+        self.color_mode = color_mode
+        self.method = method
+        self.dtype = dtype
+        self.rescale = rescale
+        self.preprocessing_function = preprocessing_function
+        self.input_dtype = input_dtype
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.tile_shape = tuple(model.input_shape[1:3])
+        if overlap >= min(self.tile_shape):
+            raise ValueError("overlap must be smaller than the tile shape")
+        self.window = get_blending_window(self.tile_shape, overlap)
+
+    def load_image(self, path):
+        """Loads an image at full resolution, as the Preprocessor would."""
+        with timing.timer("load_images"):
+            img = img_to_array(
+                load_img(path, color_mode=self.color_mode), dtype=self.input_dtype
+            )
+        timing.count("images_loaded")
+        # same order as keras' ImageDataGenerator
+        if self.preprocessing_function:
+            img = self.preprocessing_function(img)
+        if self.rescale:
+            img *= self.rescale
+        return img
+
+    def generate_tiles(self, img):
+        """Yields the origins and the tiles of img, batch by batch."""
+        height, width = self.tile_shape
+        origins = [
+            (y, x)
+            for y in get_tile_origins(img.shape[0], height, self.overlap)
+            for x in get_tile_origins(img.shape[1], width, self.overlap)
+        ]
+        for start in range(0, len(origins), self.batch_size):
+            origins_batch = origins[start : start + self.batch_size]
+            tiles = np.stack(
+                [img[y : y + height, x : x + width] for y, x in origins_batch]
+            )
+            yield origins_batch, tiles
+
+    def calculate_resmap(self, img):
+        """Returns the stitched resmap of img, of shape (H, W)."""
+        height, width = self.tile_shape
+        resmap_sum = np.zeros(img.shape[:2], dtype="float64")
+        weight_sum = np.zeros(img.shape[:2], dtype="float64")
+        for origins_batch, tiles in self.generate_tiles(img):
+            with timing.timer("predict"):
+                tiles_pred = self.model.predict(tiles)
+            timing.count("tiles_predicted", len(tiles))
+            memory_usage.record_arrays(tiles=tiles, tiles_pred=tiles_pred)
+
+            # convert to grayscale if RGB
+            if self.color_mode == "rgb":
+                tiles = resmaps.rgb_to_grayscale(tiles)
+                tiles_pred = resmaps.rgb_to_grayscale(tiles_pred)
+
+            tiles_resmaps = resmaps.calculate_resmaps(
+                tiles[:, :, :, 0],
+                tiles_pred[:, :, :, 0],
+                self.method,
+                dtype=resmaps.get_compute_dtype(self.dtype),
+            )
+            for (y, x), tile_resmap in zip(origins_batch, tiles_resmaps):
+                resmap_sum[y : y + height, x : x + width] += self.window * tile_resmap
+                weight_sum[y : y + height, x : x + width] += self.window
+
+        resmap = resmap_sum / weight_sum
+        memory_usage.record_arrays(
+            img=img, resmap_sum=resmap_sum, weight_sum=weight_sum
+        )
+        if self.dtype == "uint8":
+            return img_as_ubyte(resmap)
+        return resmap.astype(self.dtype)
+
+    def generate_resmaps(self, directory, filenames, chunk_size=1):
+        """
+        Yields the filenames and the stitched resmaps of chunks of
+        chunk_size images of directory (images of a chunk must have the
+        same size).
+        """
+        for start in range(0, len(filenames), chunk_size):
+            filenames_chunk = filenames[start : start + chunk_size]
+            resmaps_chunk = np.stack(
+                [
+                    self.calculate_resmap(
+                        self.load_image(os.path.join(directory, filename))
+                    )
+                    for filename in filenames_chunk
+                ]
+            )
+            yield filenames_chunk, resmaps_chunk
+
+    def calculate_resmaps(self, directory, filenames):
+        """Returns the stitched resmaps of images of the same size."""
+        logger.info(
+            "computing tiled resmaps of {} images of {}...".format(
+                len(filenames), directory
+            )
+        )
+        resmaps_all = None
+        for index, (_, resmap) in enumerate(
+            self.generate_resmaps(directory, filenames)
+        ):
+            if resmaps_all is None:
+                resmaps_all = np.empty(
+                    (len(filenames),) + resmap.shape[1:], dtype=resmap.dtype
+                )
+            resmaps_all[index] = resmap[0]
+        return resmaps_all
+
+    def get_area_scale(self, directory, filename):
+        """
+        Returns the ratio between the number of pixels of an image and of a
+        tile, by which min_area values defined at the input resolution of
+        the model scale to full resolution.
+        """
+        width, height = load_img(os.path.join(directory, filename)).size
+        return (height * width) / (self.tile_shape[0] * self.tile_shape[1])
+
+
+def get_tile_origins(length, tile_length, overlap):
+    """
+    Returns the start indices of the tiles of tile_length covering length,
+    spread evenly so that neighbouring tiles overlap by at least overlap
+    pixels, the first tile starting at 0 and the last one ending at length.
+    """
+    if length < tile_length:
+        raise ValueError(
+            "images must be at least as large as the tiles ({})".format(tile_length)
+        )
+    stride = tile_length - overlap
+    nb_tiles = int(np.ceil((length - tile_length) / stride)) + 1
+    return np.linspace(0, length - tile_length, nb_tiles).round().astype(int)
+
+
+def get_blending_window(tile_shape, overlap):
+    """
+    Returns the blending weights of the pixels of a tile: 1 inside the tile,
+    decreasing linearly over the overlap towards the borders of the tile,
+    where the weight is 1 / (overlap + 1).
+    """
+    windows = []
+    for length in tile_shape:
+        distance = np.minimum(np.arange(1, length + 1), np.arange(length, 0, -1))
+        windows.append(np.minimum(distance / (overlap + 1), 1))
+    return np.outer(windows[0], windows[1])
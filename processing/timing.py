@@ -0,0 +1,160 @@
+"""
+Lightweight instrumentation of the pipeline scripts: timers (context
+managers or decorators) accumulating the durations of stages, and counters
+of processed items. Instrumentation is disabled by default, in which case
+timers and counters return immediately, so that they can stay in hot paths.
+
+Timings are recorded per process: stages run in worker processes (workers
+> 1) are covered by the timers of the enclosing calls of the main process.
+Timers may be nested (e.g. predict within load-and-predict stages), so
+their totals do not add up to the wall time.
+"""
+
+import time
+import json
+import functools
+
+_enabled = False
+_start = time.perf_counter()
+_timers = {}
+_counters = {}
+
+
+def enable():
+    """Enables instrumentation and resets timers and counters."""
+    global _enabled
+    _enabled = True
+    reset()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    global _start
+    _start = time.perf_counter()
+    _timers.clear()
+    _counters.clear()
+
+
+class timer:
+    """
+    Context manager adding the duration of its block to the timer name.
+    """
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is None:
+            return False
+        duration = time.perf_counter() - self.start
+        stats = _timers.get(self.name)
+        if stats is None:
+            _timers[self.name] = [1, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+        return False
+
+
+def timed(name):
+    """Decorator adding the duration of each call to the timer name."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1):
+    """Adds value to the counter name."""
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_report(base=None):
+    """
+    Returns the timers (number of calls, total, mean and max duration in
+    seconds, sorted by total duration) and counters recorded since
+    instrumentation was enabled or reset, added to those of a previous
+    report base if passed.
+    """
+    timers = {name: list(stats) for name, stats in _timers.items()}
+    counters = dict(_counters)
+    wall_time = time.perf_counter() - _start
+    if base is not None:
+        wall_time += base["wall_time"]
+        for name, stats in base["timers"].items():
+            calls, total, longest = timers.get(name, [0, 0.0, 0.0])
+            timers[name] = [
+                calls + stats["calls"],
+                total + stats["total"],
+                max(longest, stats["max"]),
+            ]
+        for name, value in base["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    return {
+        "wall_time": wall_time,
+        "timers": {
+            name: {
+                "calls": calls,
+                "total": total,
+                "mean": total / calls,
+                "max": longest,
+            }
+            for name, (calls, total, longest) in sorted(
+                timers.items(), key=lambda item: -item[1][1]
+            )
+        },
+        "counters": counters,
+    }
+
+
+def save_report(path, base=None):
+    """Saves the report (see get_report) as JSON at path."""
+    report = get_report(base)
+    with open(path, "w") as json_file:
+        json.dump(report, json_file, indent=4, sort_keys=False)
+    return report
+
+
+def format_report(report):
+    """Returns the report as a table of timers followed by the counters."""
+    lines = [
+        "{:<32}{:>8}{:>12}{:>12}{:>12}".format(
+            "timer", "calls", "total (s)", "mean (s)", "max (s)"
+        )
+    ]
+    for name, stats in report["timers"].items():
+        lines.append(
+            "{:<32}{:>8}{:>12.3f}{:>12.4f}{:>12.4f}".format(
+                name, stats["calls"], stats["total"], stats["mean"], stats["max"]
+            )
+        )
+    lines.append("wall time: {:.3f}s".format(report["wall_time"]))
+    for name, value in report["counters"].items():
+        lines.append("{}: {}".format(name, value))
+    return "\n".join(lines)
@@ -1,5 +1,7 @@
 import os
 import json
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -9,6 +11,9 @@ from tensorflow import keras
 
 from autoencoder import metrics
 from autoencoder import losses
+from autoencoder.models.rescale import Rescale
+from processing import timing
+from processing import image_writer
 
 
 def get_model_info(model_path):
@@ -18,6 +23,7 @@ def get_model_info(model_path):
     return info
 
 
+@timing.timed("load_model")
 def load_model_HDF5(model_path):
     """Loads model (HDF5 format), training setup and training history.
     This format makes it difficult to load a trained model for further training,
@@ -34,6 +40,7 @@ def load_model_HDF5(model_path):
             filepath=model_path,
             custom_objects={
                 "LeakyReLU": keras.layers.LeakyReLU,
+                "Rescale": Rescale,
                 "loss": losses.mssim_loss(dynamic_range),
                 "mssim": metrics.mssim_metric(dynamic_range),
             },
@@ -45,6 +52,7 @@ def load_model_HDF5(model_path):
             filepath=model_path,
             custom_objects={
                 "LeakyReLU": keras.layers.LeakyReLU,
+                "Rescale": Rescale,
                 "loss": losses.ssim_loss(dynamic_range),
                 "ssim": metrics.ssim_metric(dynamic_range),
             },
@@ -56,6 +64,7 @@ def load_model_HDF5(model_path):
             filepath=model_path,
             custom_objects={
                 "LeakyReLU": keras.layers.LeakyReLU,
+                "Rescale": Rescale,
                 "l2_loss": losses.l2_loss,
                 "ssim": losses.ssim_loss(dynamic_range),
                 "mssim": metrics.mssim_metric(dynamic_range),
@@ -70,6 +79,91 @@ def load_model_HDF5(model_path):
     return model, info, history
 
 
+# formats of the inference copies of models (see load_model_inference)
+INFERENCE_FORMATS = ["savedmodel", "weights"]
+
+
+def get_inference_paths(model_path, inference_format, tmp=False):
+    """
+    Returns the paths of the inference copy of a model next to it: a
+    SavedModel directory, or the architecture (JSON) and the weights only.
+    Temporary paths keep their extension, which sets the format of weights.
+    """
+    stem = os.path.splitext(model_path)[0] + ("_tmp" if tmp else "")
+    if inference_format == "savedmodel":
+        return [stem + "_savedmodel"]
+    return [stem + "_architecture.json", stem + ".weights.h5"]
+
+
+def save_inference_copy(model, model_path, inference_format):
+    """Saves the inference copy of model, loaded from model_path."""
+    paths = get_inference_paths(model_path, inference_format)
+    tmp_paths = get_inference_paths(model_path, inference_format, tmp=True)
+    if inference_format == "savedmodel":
+        model.save(tmp_paths[0], save_format="tf", include_optimizer=False)
+    else:
+        with open(tmp_paths[0], "w") as json_file:
+            json_file.write(model.to_json())
+        model.save_weights(tmp_paths[1])
+    for tmp_path, path in zip(tmp_paths, paths):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+
+@timing.timed("load_model")
+def load_model_inference(model_path, inference_format=None):
+    """
+    Loads a model (HDF5 format) for inference only: the model is not
+    compiled (no loss and metric closures, no optimizer state) and the
+    training history is not read. Returns the model and the training setup
+    (info.json), whose "preprocessing" entry holds the settings that images
+    must be preprocessed with.
+
+    With inference_format "savedmodel" or "weights", the model is loaded
+    from an inference copy next to it (see get_inference_paths), saved from
+    the HDF5 model on first use or whenever the HDF5 model is newer.
+    """
+    info = get_model_info(model_path)
+    custom_objects = {"LeakyReLU": keras.layers.LeakyReLU, "Rescale": Rescale}
+
+    if inference_format is not None:
+        assert inference_format in INFERENCE_FORMATS
+        paths = get_inference_paths(model_path, inference_format)
+        model_mtime = os.path.getmtime(model_path)
+        if all(
+            os.path.exists(path) and os.path.getmtime(path) >= model_mtime
+            for path in paths
+        ):
+            if inference_format == "savedmodel":
+                model = keras.models.load_model(
+                    paths[0], custom_objects=custom_objects, compile=False
+                )
+            else:
+                with open(paths[0], "r") as json_file:
+                    model = keras.models.model_from_json(
+                        json_file.read(), custom_objects=custom_objects
+                    )
+                model.load_weights(paths[1])
+            return model, info
+
+    model = keras.models.load_model(
+        filepath=model_path, custom_objects=custom_objects, compile=False
+    )
+    if inference_format is not None:
+        save_inference_copy(model, model_path, inference_format)
+    return model, info
+
+
+def get_tmp_path(path):
+    """Returns a new, unique temporary file in the directory of path."""
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path)
+    )
+    os.close(fd)
+    return tmp_path
+
+
 def save_np(arr, save_dir, filename):
     np.save(
         file=os.path.join(save_dir, filename), arr=arr, allow_pickle=True,
@@ -123,7 +217,12 @@ def generate_new_name(filename, suffix):
     return filename_new
 
 
-def save_images(save_dir, imgs, filenames, color_mode, suffix):
+def save_images(save_dir, imgs, filenames, color_mode, suffix, writer=None):
+    """
+    Saves images (N, H, W, C) as PNG files, each scaled to its own value
+    range, with the bulk image writer passed, or with a temporary one that
+    is closed before returning.
+    """
     filenames_new = []
     for filename in filenames:
         filename_new, ext = os.path.splitext(filename)
@@ -132,20 +231,22 @@ def save_images(save_dir, imgs, filenames, color_mode, suffix):
         filenames_new.append(filename_new)
 
     if color_mode == "grayscale":
-        for i in range(len(imgs)):
-            img = imgs[i, :, :, 0]
-            save_path = os.path.join(save_dir, filenames_new[i])
-            plt.imsave(save_path, img, cmap="gray")
-
-    if color_mode == "RGB":
-        for i in range(len(imgs)):
-            img = imgs[i, :, :, 0]
-            save_path = os.path.join(save_dir, filenames_new[i])
-            plt.imsave(save_path, img)
+        imgs = imgs[:, :, :, 0]
+    imgs = image_writer.to_uint8(imgs)
+
+    own_writer = writer is None
+    if own_writer:
+        writer = image_writer.ImageWriter()
+    for i in range(len(imgs)):
+        save_path = os.path.join(save_dir, filenames_new[i])
+        writer.write(save_path, imgs[i])
+    if own_writer:
+        writer.close()
 
     print("[INFO] validation images for inspection saved at /{}".format(save_dir))
 
 
+@timing.timed("plot_inspection_images")
 def plot_inspection_images(tensor_list, index):
     titles = ["input", "pred", "resmaps_diff", "resmap_ssim", "resmap_L2"]
     cmaps = ["gray", "gray", "inferno", "inferno", "inferno"]
@@ -4,16 +4,22 @@ import argparse
 from pathlib import Path
 import time
 import json
-import tensorflow as tf
 from processing import utils
 from processing import resmaps
+from processing import timing
+from processing import memory_usage
 from processing.preprocessing import Preprocessor
 from processing.preprocessing import get_preprocessing_function
-from processing.resmaps import label_images
+from processing.resmaps import label_areas
+from processing.resmaps import cast_threshold
 from processing.utils import printProgressBar
+from processing.reconstructions import ReconstructionStore
+from processing.tiling import TiledInference, TILE_OVERLAP
+from processing.image_writer import ImageWriter, MASK_FORMATS
+from processing.run_archive import ArchiveWriter, ARCHIVE_NAME
+from autoencoder.models.rescale import add_rescale_input
 from skimage.util import img_as_ubyte
 from sklearn.metrics import confusion_matrix
-from matplotlib import pyplot as plt
 import numpy as np
 import pandas as pd
 import logging
@@ -28,48 +34,170 @@ def get_true_classes(filenames):
     return y_true
 
 
-def is_defective(areas, min_area):
-    """Decides if image is defective given the areas of its connected components"""
-    areas = np.array(areas)
-    if areas[areas >= min_area].shape[0] > 0:
-        return 1
-    return 0
-
-
-def predict_classes(resmaps, min_area, threshold):
-    # threshold residual maps with the given threshold
-    resmaps_th = resmaps > threshold
-    # compute connected components
-    _, areas_all = label_images(resmaps_th)
-    # Decides if images are defective given the areas of their connected components
-    y_pred = [is_defective(areas, min_area) for areas in areas_all]
+def predict_classes(resmaps, min_area, threshold, cache=None):
+    # threshold residual maps with the given threshold and compute the
+    # areas of their connected components
+    if cache is not None:
+        region_areas = cache.get_areas(resmaps, threshold)
+    else:
+        region_areas = label_areas(resmaps, threshold)
+    # an image is defective if its largest region reaches min_area
+    y_pred = [int(max_area >= min_area) for max_area in region_areas.max_areas()]
     return y_pred
 
 
-def save_segmented_images(resmaps, threshold, filenames, save_dir):
+@timing.timed("save_segmented_images")
+def save_segmented_images(
+    resmaps, threshold, filenames, save_dir, writer=None, mask_format="png"
+):
+    """
+    Saves the thresholded resmaps as black and white PNG masks, queued to
+    the bulk image writer passed (written in the background until it is
+    flushed or closed), or to a temporary one closed before returning.
+    """
     # threshold residual maps with the given threshold
-    resmaps_th = resmaps > threshold
+    resmaps_th = resmaps > cast_threshold(resmaps, threshold)
     # create directory to save segmented resmaps
     seg_dir = os.path.join(save_dir, "segmentation")
     if not os.path.isdir(seg_dir):
         os.makedirs(seg_dir)
     # save segmented resmaps
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter()
     for i, resmap_th in enumerate(resmaps_th):
         fname = utils.generate_new_name(filenames[i], suffix="seg")
-        fpath = os.path.join(seg_dir, fname)
-        plt.imsave(fpath, resmap_th, cmap="gray")
+        fpath = os.path.join(seg_dir, os.path.splitext(fname)[0] + ".png")
+        writer.write_mask(fpath, resmap_th, mask_format)
+    if own_writer:
+        writer.close()
     return
 
 
+def get_chunk_size(memory, shape, color_mode, dtype="float64", input_dtype="float32"):
+    """
+    Estimates the number of test images that can be processed at once
+    within a memory budget (in MB): input (float32 or uint8) and
+    reconstruction (float32), their grayscale conversion, the resmaps with their intermediate copies
+    (float32 for float32 and float16 resmaps, float64 otherwise) and the
+    thresholded and labeled resmaps. Up to two chunks are alive at once,
+    while the next chunk is loaded.
+    """
+    channels = 3 if color_mode == "rgb" else 1
+    float_size = np.dtype(resmaps.get_compute_dtype(dtype)).itemsize
+    input_size = np.dtype(input_dtype).itemsize
+    bytes_per_pixel = (input_size + 4) * channels + 2 * 4 + 3 * float_size + 1
+    bytes_per_image = 2 * bytes_per_pixel * shape[0] * shape[1]
+    return max(int(memory * 2 ** 20 // bytes_per_image), 1)
+
+
+def generate_test_chunks(
+    model,
+    test_generator,
+    color_mode,
+    vmin,
+    vmax,
+    method,
+    dtype,
+    workers=1,
+    store=None,
+):
+    """
+    Yields the filenames and TensorImages of each batch of the test
+    generator, so that only one chunk of test images, reconstructions
+    and resmaps is held in memory at a time.
+    If a ReconstructionStore is passed, stored reconstructions of the test
+    set are read chunk by chunk from their memory map; if there are none,
+    the predicted chunks are written to the store.
+    """
+    batch_size = test_generator.batch_size
+    nb_test_images = len(test_generator.filenames)
+    imgs_stored, writer = None, None
+    if store is not None:
+        imgs_stored = store.load(
+            "test", test_generator.directory, test_generator.filenames
+        )
+
+    for index in range(len(test_generator)):
+        # retrieve test images from generator
+        with timing.timer("load_images"):
+            imgs_test_input = test_generator[index][0]
+        memory_usage.record_array("imgs_test_input_chunk", imgs_test_input)
+        timing.count("images_loaded", len(imgs_test_input))
+        start = index * batch_size
+        stop = start + len(imgs_test_input)
+        filenames_chunk = test_generator.filenames[start:stop]
+
+        # predict on test images
+        if imgs_stored is not None:
+            imgs_test_pred = np.array(imgs_stored[start:stop])
+            timing.count("reconstructions_reused", len(imgs_test_pred))
+        else:
+            with timing.timer("predict"):
+                imgs_test_pred = model.predict(imgs_test_input)
+            timing.count("images_predicted", len(imgs_test_input))
+            if store is not None:
+                if writer is None:
+                    writer = store.open_writer(
+                        "test",
+                        test_generator.directory,
+                        test_generator.filenames,
+                        shape=(nb_test_images,) + imgs_test_pred.shape[1:],
+                        dtype=imgs_test_pred.dtype,
+                    )
+                writer.array[start:stop] = imgs_test_pred
+        memory_usage.record_array("imgs_test_pred_chunk", imgs_test_pred)
+
+        # convert to grayscale if RGB
+        if color_mode == "rgb":
+            imgs_test_input = resmaps.rgb_to_grayscale(imgs_test_input)
+            imgs_test_pred = resmaps.rgb_to_grayscale(imgs_test_pred)
+
+        # remove last channel since images are grayscale
+        imgs_test_input = imgs_test_input[:, :, :, 0]
+        imgs_test_pred = imgs_test_pred[:, :, :, 0]
+
+        # instantiate TensorImages object
+        tensor_chunk = resmaps.TensorImages(
+            imgs_input=imgs_test_input,
+            imgs_pred=imgs_test_pred,
+            vmin=vmin,
+            vmax=vmax,
+            method=method,
+            dtype=dtype,
+            filenames=filenames_chunk,
+            workers=workers,
+        )
+        yield filenames_chunk, tensor_chunk
+
+    if writer is not None:
+        writer.commit()
+
+
 def main(args):
     # parse arguments
     model_path = args.path
     save = args.save
+    workers = args.workers
+    memory = args.memory
+    backend = args.backend
+    input_dtype = args.input_dtype
+    mask_format = args.mask_format
+    archive = args.archive
+    inference_format = None if args.model_format == "hdf5" else args.model_format
+    timings = args.timings
+    memory_report = args.memory_report
+
+    if timings:
+        timing.enable()
+    if memory_report:
+        memory_usage.enable()
 
     # ============= LOAD MODEL AND PREPROCESSING CONFIGURATION ================
 
-    # load model and info
-    model, info, _ = utils.load_model_HDF5(model_path)
+    # load model (for inference only) and info
+    memory_usage.set_stage("load_model")
+    model, info = utils.load_model_inference(model_path, inference_format)
     # set parameters
     input_directory = info["data"]["input_directory"]
     architecture = info["model"]["architecture"]
@@ -81,6 +209,13 @@ def main(args):
     vmax = info["preprocessing"]["vmax"]
     nb_validation_images = info["data"]["nb_validation_images"]
 
+    # uint8 images are rescaled by the model
+    if input_dtype == "uint8":
+        model = add_rescale_input(model, rescale)
+
+    # store of reconstructions shared with train.py --inspect and finetune.py
+    store = None if args.no_store else ReconstructionStore(model_path)
+
     # =================== LOAD VALIDATION PARAMETERS =========================
 
     model_dir_name = os.path.basename(str(Path(model_path).parent))
@@ -94,7 +229,13 @@ def main(args):
         "finetuning",
     )
     subdirs = os.listdir(finetune_dir)
+
+    # timings of loading the model, added to the timings of each test run
+    setup_report = timing.get_report()
+
     for subdir in subdirs:
+        timing.reset()
+        memory_usage.set_stage("test/{}".format(subdir))
         logger.info(
             "testing with finetuning parameters from \n{}...".format(
                 os.path.join(finetune_dir, subdir)
@@ -113,6 +254,8 @@ def main(args):
         threshold = validation_result["best_threshold"]
         method = validation_result["method"]
         dtype = validation_result["dtype"]
+        tiled = validation_result.get("tiled", False)
+        overlap = validation_result.get("overlap", TILE_OVERLAP)
 
         # ====================== PREPROCESS TEST IMAGES ==========================
 
@@ -126,52 +269,119 @@ def main(args):
             shape=shape,
             color_mode=color_mode,
             preprocessing_function=preprocessing_function,
+            backend=backend,
+            input_dtype=input_dtype,
         )
 
-        # get test generator
+        # get test generator, yielding the whole test set at once or
+        # chunks of images that fit the memory budget
         nb_test_images = preprocessor.get_total_number_test_images()
+        if memory is None:
+            batch_size = nb_test_images
+        else:
+            batch_size = get_chunk_size(memory, shape, color_mode, dtype, input_dtype)
+            logger.info(
+                "streaming test images in chunks of {} images.".format(batch_size)
+            )
         test_generator = preprocessor.get_test_generator(
-            batch_size=nb_test_images, shuffle=False
+            batch_size=batch_size, shuffle=False
         )
 
-        # retrieve test images from generator
-        imgs_test_input = test_generator.next()[0]
-
         # retrieve test image names
         filenames = test_generator.filenames
 
-        # predict on test images
-        imgs_test_pred = model.predict(imgs_test_input)
-
-        # convert to grayscale if RGB
-        if color_mode == "rgb":
-            imgs_test_input = tf.image.rgb_to_grayscale(imgs_val_input).numpy()
-            imgs_test_pred = tf.image.rgb_to_grayscale(imgs_val_pred).numpy()
-
-        # remove last channel since images are grayscale
-        imgs_test_input = imgs_test_input[:, :, :, 0]
-        imgs_test_pred = imgs_test_pred[:, :, :, 0]
-
-        # instantiate TensorImages object
-        tensor_test = resmaps.TensorImages(
-            imgs_input=imgs_test_input,
-            imgs_pred=imgs_test_pred,
-            vmin=vmin,
-            vmax=vmax,
-            method=method,
-            dtype=dtype,
-            filenames=filenames,
+        # create directory to save test results
+        save_dir = os.path.join(
+            os.getcwd(),
+            "results",
+            input_directory,
+            architecture,
+            loss,
+            model_dir_name,
+            "test",
+            subdir,
         )
 
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+
         # ====================== CLASSIFICATION ==========================
 
         # retrieve ground truth
         y_true = get_true_classes(filenames)
 
-        # predict classes on test images
-        y_pred = predict_classes(
-            resmaps=tensor_test.resmaps, min_area=min_area, threshold=threshold
-        )
+        if tiled:
+            # full resolution resmaps of test images, image by image
+            tiled_inference = TiledInference(
+                model=model,
+                color_mode=color_mode,
+                method=method,
+                dtype=dtype,
+                rescale=preprocessor.rescale,
+                preprocessing_function=preprocessor.preprocessing_function,
+                input_dtype=input_dtype,
+                overlap=overlap,
+            )
+            chunks = tiled_inference.generate_resmaps(
+                test_generator.directory, filenames
+            )
+        else:
+            chunks = (
+                (filenames_chunk, tensor_chunk.resmaps)
+                for filenames_chunk, tensor_chunk in generate_test_chunks(
+                    model=model,
+                    test_generator=test_generator,
+                    color_mode=color_mode,
+                    vmin=vmin,
+                    vmax=vmax,
+                    method=method,
+                    dtype=dtype,
+                    workers=workers,
+                    store=store,
+                )
+            )
+
+        # predict classes on test images, chunk by chunk, while segmented
+        # resmaps are written in the background
+        y_pred = []
+        writer = ImageWriter() if save else None
+        if archive:
+            archive_writer = ArchiveWriter(
+                os.path.join(save_dir, ARCHIVE_NAME),
+                nb_images=len(filenames),
+                threshold=threshold,
+                min_area=min_area,
+                method=method,
+                dtype=dtype,
+            )
+        for filenames_chunk, resmaps_chunk in chunks:
+            memory_usage.record_array("resmaps_chunk", resmaps_chunk)
+            y_pred.extend(
+                predict_classes(
+                    resmaps=resmaps_chunk, min_area=min_area, threshold=threshold
+                )
+            )
+
+            # save segmented resmaps
+            if save:
+                save_segmented_images(
+                    resmaps_chunk,
+                    threshold,
+                    filenames_chunk,
+                    save_dir,
+                    writer=writer,
+                    mask_format=mask_format,
+                )
+
+            # archive masks and quantized resmaps
+            if archive:
+                archive_writer.write(filenames_chunk, resmaps_chunk)
+
+        # wait until all segmented resmaps are written
+        if writer is not None:
+            writer.close()
+        if archive:
+            archive_writer.commit()
 
         # confusion matrix
         tnr, fp, fn, tpr = confusion_matrix(y_true, y_pred, normalize="true").ravel()
@@ -185,29 +395,29 @@ def main(args):
             "score": (tpr + tnr) / 2,
             "method": method,
             "dtype": dtype,
+            "tiled": tiled,
         }
 
         # ====================== SAVE TEST RESULTS =========================
 
-        # create directory to save test results
-        save_dir = os.path.join(
-            os.getcwd(),
-            "results",
-            input_directory,
-            architecture,
-            loss,
-            model_dir_name,
-            "test",
-            subdir,
-        )
-
-        if not os.path.isdir(save_dir):
-            os.makedirs(save_dir)
-
         # save test result
         with open(os.path.join(save_dir, "test_result.json"), "w") as json_file:
             json.dump(test_result, json_file, indent=4, sort_keys=False)
 
+        # save timings of the stages of the run
+        if timings:
+            report = timing.save_report(
+                os.path.join(save_dir, "timings.json"), base=setup_report
+            )
+            logger.info("timings:\n{}".format(timing.format_report(report)))
+
+        # save memory usage of the stages of the run so far
+        if memory_report:
+            report = memory_usage.save_report(
+                os.path.join(save_dir, "memory_report.json")
+            )
+            logger.info("memory usage:\n{}".format(memory_usage.format_report(report)))
+
         # save classification of image files in a .txt file
         classification = {
             "filenames": filenames,
@@ -228,10 +438,6 @@ def main(args):
         with pd.option_context("display.max_rows", None, "display.max_columns", None):
             print(df_clf)
 
-        # save segmented resmaps
-        if save:
-            save_segmented_images(tensor_test.resmaps, threshold, filenames, save_dir)
-
         # print test_results to console
         print("test results: {}".format(test_result))
 
@@ -245,6 +451,85 @@ if __name__ == "__main__":
     parser.add_argument(
         "-s", "--save", action="store_true", help="save segmented images",
     )
+    parser.add_argument(
+        "--mask-format",
+        type=str,
+        required=False,
+        metavar="",
+        choices=MASK_FORMATS,
+        default="png",
+        help="format of saved segmented images: 'png' (grayscale) or 'bitmask' (1-bit PNG, smaller)",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="save bit-packed segmented images and uint8-quantized resmaps in a single compressed file (run_archive.h5)",
+    )
+    parser.add_argument(
+        "--model-format",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["hdf5"] + utils.INFERENCE_FORMATS,
+        default="hdf5",
+        help="format to load the model from: 'hdf5', 'savedmodel' or 'weights' (copy saved next to the model on first use)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        required=False,
+        metavar="",
+        default=1,
+        help="number of worker processes for computing resmaps",
+    )
+    parser.add_argument(
+        "-m",
+        "--memory",
+        type=int,
+        required=False,
+        metavar="",
+        default=None,
+        help="memory budget in MB for streaming test images in chunks",
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["keras", "tfdata", "memmap"],
+        default="keras",
+        help="backend for loading images: 'keras' (ImageDataGenerator), 'tfdata' or 'memmap' (cache of decoded images)",
+    )
+
+    parser.add_argument(
+        "--input-dtype",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["float32", "uint8"],
+        default="float32",
+        help="datatype of the loaded images: 'float32' or 'uint8' (rescaled by the model, 4x less memory)",
+    )
+
+    parser.add_argument(
+        "--no-store",
+        action="store_true",
+        help="do not reuse nor save reconstructions in the reconstructions directory of the model",
+    )
+
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="record timings and counters of the stages of the run in timings.json",
+    )
+
+    parser.add_argument(
+        "--memory-report",
+        action="store_true",
+        help="record peak RSS and array sizes of the stages of the run in memory_report.json",
+    )
 
     args = parser.parse_args()
 
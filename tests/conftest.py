@@ -0,0 +1,6 @@
+import os
+import sys
+
+# scripts of the repository (e.g. test.py) are imported by finetune.py, the
+# repository root must come before the standard library test package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,28 @@
+"""Synthetic residual maps shared by the tests."""
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+
+def smooth_resmaps(nb_images=6, shape=(64, 64), sigma=3.0, seed=0):
+    """Smooth random float32 resmaps in [0, 1], with regions touching the border."""
+    rng = np.random.RandomState(seed)
+    resmaps = gaussian_filter(rng.rand(nb_images, *shape), sigma=(0, sigma, sigma))
+    resmaps -= resmaps.min(axis=(1, 2), keepdims=True)
+    resmaps /= resmaps.max(axis=(1, 2), keepdims=True)
+    return resmaps.astype("float32")
+
+
+def ring_resmaps(shape=(64, 64)):
+    """
+    Resmaps whose largest area is not monotone in the threshold: a ring
+    touching the border encloses a brighter blob, so the blob is dropped with
+    the ring at low thresholds and counted once the ring is thresholded away.
+    """
+    resmaps = np.full((2,) + shape, 0.05, dtype="float32")
+    # ring touching the border around a blob of 20 x 20 pixels
+    resmaps[0, :40, :40] = 0.5
+    resmaps[0, 10:30, 10:30] = 0.9
+    # small region away from the border, kept at every threshold below 0.3
+    resmaps[1, 45:50, 45:50] = 0.3
+    return resmaps
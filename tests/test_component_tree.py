@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import finetune
+from processing.component_tree import ComponentTreeIndex
+from synthetic import smooth_resmaps, ring_resmaps
+
+MIN_AREAS = [1, 5, 10, 20, 50, 100, 200, 400, 800]
+
+
+def get_cases():
+    resmaps_smooth = smooth_resmaps()
+    resmaps_uint8 = np.rint(resmaps_smooth * 255).astype("uint8")
+    return {
+        # float resmaps, with regions touching the border at low thresholds
+        "smooth": (resmaps_smooth, [0.0, 0.45, 0.6], 0.02),
+        # largest area not monotone in the threshold
+        "ring": (ring_resmaps(), [0.0, 0.3], 0.02),
+        # uint8 resmaps on an integer grid
+        "uint8": (resmaps_uint8, [0, 110, 150], 4),
+    }
+
+
+@pytest.mark.parametrize("case", ["smooth", "ring", "uint8"])
+def test_tree_matches_linear(case):
+    resmaps, thresh_mins, thresh_step = get_cases()[case]
+    thresh_max = np.amax(resmaps).item()
+    for thresh_min in thresh_mins:
+        tree_index = ComponentTreeIndex(resmaps, thresh_min, thresh_max, thresh_step)
+        # largest area of every threshold, as labelled by label_areas
+        expected_areas = [
+            finetune.get_largest_area(resmaps, threshold)
+            for threshold in tree_index.thresholds
+        ]
+        assert tree_index.largest_areas.tolist() == expected_areas
+        for min_area in MIN_AREAS:
+            expected = finetune.determine_threshold(
+                resmaps, min_area, thresh_min, thresh_max, thresh_step
+            )
+            assert tree_index.determine_threshold(min_area) == expected
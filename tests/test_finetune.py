@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+import finetune
+from synthetic import smooth_resmaps, ring_resmaps
+
+THRESH_MINS = [0.0, 0.45, 0.6]
+THRESH_STEP = 0.02
+MIN_AREAS = [1, 5, 10, 20, 50, 100, 200, 400, 800]
+
+
+def get_thresh_max(resmaps):
+    return float(resmaps.max())
+
+
+@pytest.fixture(params=["smooth", "ring"])
+def resmaps_val(request):
+    if request.param == "smooth":
+        return smooth_resmaps()
+    return ring_resmaps()
+
+
+def test_ring_largest_area_is_not_monotone():
+    resmaps = ring_resmaps()
+    areas = [
+        finetune.get_largest_area(resmaps, threshold)
+        for threshold in np.arange(0.0, 1.0, 0.1)
+    ]
+    assert np.any(np.diff(areas) > 0)
+
+
+@pytest.mark.parametrize("thresh_min", THRESH_MINS)
+def test_incremental_matches_linear(resmaps_val, thresh_min):
+    thresh_max = get_thresh_max(resmaps_val)
+    # warm start shared across min_areas, as in determine_thresholds_incremental
+    largest_areas = []
+    for min_area in MIN_AREAS:
+        expected = finetune.determine_threshold(
+            resmaps_val, min_area, thresh_min, thresh_max, THRESH_STEP
+        )
+        threshold, _, _ = finetune.determine_threshold_incremental(
+            resmaps_val, min_area, thresh_min, thresh_max, THRESH_STEP
+        )
+        assert threshold == expected
+        threshold, _, _ = finetune.determine_threshold_incremental(
+            resmaps_val,
+            min_area,
+            thresh_min,
+            thresh_max,
+            THRESH_STEP,
+            largest_areas=largest_areas,
+        )
+        assert threshold == expected
+
+
+@pytest.mark.parametrize("thresh_min", THRESH_MINS)
+def test_thresholds_incremental_match_linear(resmaps_val, thresh_min):
+    thresh_max = get_thresh_max(resmaps_val)
+    # min_areas in both orders, the warm start must not depend on it
+    for min_areas in [MIN_AREAS, MIN_AREAS[::-1]]:
+        thresholds, n_calls_search = finetune.determine_thresholds_incremental(
+            resmaps_val, min_areas, thresh_min, thresh_max, THRESH_STEP
+        )
+        expected = [
+            finetune.determine_threshold(
+                resmaps_val, min_area, thresh_min, thresh_max, THRESH_STEP
+            )
+            for min_area in min_areas
+        ]
+        assert thresholds == expected
+        n_calls_linear = finetune.get_n_calls_linear(expected, thresh_min, THRESH_STEP)
+        assert n_calls_search <= n_calls_linear
+
+
+def test_n_calls_linear(monkeypatch):
+    resmaps_val = smooth_resmaps()
+    thresh_min = 0.45
+    thresh_max = get_thresh_max(resmaps_val)
+    calls = []
+    get_largest_area = finetune.get_largest_area
+
+    def count_calls(resmaps, threshold, cache=None):
+        calls.append(threshold)
+        return get_largest_area(resmaps, threshold, cache)
+
+    monkeypatch.setattr(finetune, "get_largest_area", count_calls)
+    thresholds = [
+        finetune.determine_threshold(
+            resmaps_val, min_area, thresh_min, thresh_max, THRESH_STEP
+        )
+        for min_area in MIN_AREAS
+    ]
+    n_calls_linear = finetune.get_n_calls_linear(thresholds, thresh_min, THRESH_STEP)
+    assert n_calls_linear == len(calls)
+
+
+@pytest.mark.parametrize("search", ["linear", "incremental", "tree"])
+def test_parallel_matches_serial(search):
+    resmaps_val = smooth_resmaps(seed=0)
+    resmaps_ft = smooth_resmaps(seed=1)
+    y_ft_true = [0, 1, 0, 1, 1, 0]
+    thresh_min = 0.45
+    thresh_max = get_thresh_max(resmaps_val)
+    min_areas = np.array(MIN_AREAS)
+    thresholds, _ = finetune.determine_thresholds(
+        search, resmaps_val, min_areas, thresh_min, thresh_max, THRESH_STEP
+    )
+    sweep_args = {
+        "resmaps_val": resmaps_val,
+        "resmaps_ft": resmaps_ft,
+        "y_ft_true": y_ft_true,
+        "min_areas": min_areas,
+        "thresh_min": thresh_min,
+        "thresh_max": thresh_max,
+        "thresh_step": THRESH_STEP,
+        "thresholds": thresholds,
+    }
+    dict_serial, _ = finetune.finetune_min_areas(**sweep_args)
+    dict_parallel, _ = finetune.finetune_min_areas_parallel(workers=2, **sweep_args)
+    assert dict_parallel == dict_serial
+    # every search gives the thresholds of the linear search
+    expected = [
+        finetune.determine_threshold(
+            resmaps_val, min_area, thresh_min, thresh_max, THRESH_STEP
+        )
+        for min_area in min_areas
+    ]
+    assert dict_serial["threshold"] == expected
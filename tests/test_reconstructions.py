@@ -0,0 +1,23 @@
+import os
+import numpy as np
+from processing.reconstructions import ReconstructionWriter
+
+
+def test_concurrent_writers(tmp_path):
+    path = str(tmp_path / "test_abc.npy")
+    other_path = str(tmp_path / "test_def.npy")
+    np.save(other_path, np.zeros(3, dtype="float32"))
+
+    # writers of the same file (e.g. concurrent runs) never share a file
+    writer_1 = ReconstructionWriter(path, (2, 4), "float32")
+    writer_2 = ReconstructionWriter(path, (2, 4), "float32")
+    assert writer_1.tmp_path != writer_2.tmp_path
+    writer_1.array[...] = 1
+    writer_2.array[...] = 2
+    writer_1.commit()
+    np.testing.assert_array_equal(np.load(path), 1)
+    writer_2.commit()
+    np.testing.assert_array_equal(np.load(path), 2)
+
+    # files of other keys are kept, no temporary file is left
+    assert sorted(os.listdir(str(tmp_path))) == ["test_abc.npy", "test_def.npy"]
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from processing import resmaps
+from synthetic import smooth_resmaps
+
+
+def get_images(seed=0):
+    imgs_input = smooth_resmaps(nb_images=4, shape=(48, 64), sigma=2.0, seed=seed)
+    noise = np.random.RandomState(seed).normal(0, 0.05, imgs_input.shape)
+    imgs_pred = np.clip(imgs_input + noise, 0, 1).astype("float32")
+    return imgs_input, imgs_pred
+
+
+# float32 resmaps lose precision in the variances (E[x^2] - E[x]^2)
+@pytest.mark.parametrize("dtype, atol", [("float64", 2e-5), ("float32", 1e-4)])
+def test_ssim_batch_matches_skimage(dtype, atol):
+    imgs_input, imgs_pred = get_images()
+    resmaps_skimage = resmaps.calculate_resmaps(
+        imgs_input, imgs_pred, "ssim", dtype="float64", ssim_engine="skimage"
+    )
+    resmaps_batch = resmaps.calculate_resmaps(
+        imgs_input, imgs_pred, "ssim", dtype=dtype, ssim_engine="batch"
+    )
+    assert resmaps_batch.dtype == dtype
+    np.testing.assert_allclose(resmaps_batch, resmaps_skimage, rtol=0, atol=atol)
+
+
+def test_ssim_batch_matches_skimage_uint8():
+    imgs_input, imgs_pred = get_images(seed=1)
+    imgs_input = np.rint(imgs_input * 255).astype("uint8")
+    imgs_pred = np.rint(imgs_pred * 255).astype("uint8")
+    resmaps_skimage = resmaps.calculate_resmaps(
+        imgs_input, imgs_pred, "ssim", ssim_engine="skimage"
+    )
+    resmaps_batch = resmaps.calculate_resmaps(
+        imgs_input, imgs_pred, "ssim", ssim_engine="batch"
+    )
+    np.testing.assert_allclose(resmaps_batch, resmaps_skimage, rtol=0, atol=2e-5)
+
+
+def get_masks():
+    """Random masks and masks with regions touching or near the border."""
+    rng = np.random.RandomState(0)
+    masks = [rng.rand(6, 23, 31) < density for density in [0.05, 0.2, 0.5, 0.8]]
+    edge = np.zeros((8, 23, 31), dtype=bool)
+    # region touching the border, region one pixel away from it (closed
+    # into the border) and regions two pixels away from it (kept)
+    edge[0, 0:5, 3:9] = True
+    edge[0, 8:12, 2:6] = True
+    edge[1, 1:5, 1:9] = True
+    edge[1, 2:6, 12:20] = True
+    # regions near the bottom and top rows, i.e. the neighbouring images in
+    # a stack
+    edge[2, -3:, 10:15] = True
+    edge[2, -6:-2, 20:25] = True
+    edge[3, 2:5, 10:15] = True
+    edge[3, -5:-2, 10:15] = True
+    # single pixels on and near the border, full and empty images
+    edge[4, 0, 0] = edge[4, 2, 2] = edge[4, -3, -3] = edge[4, 11, 15] = True
+    edge[5] = True
+    # ring touching the border around an inner region
+    edge[7, :14, :14] = True
+    edge[7, 2:12, 2:12] = False
+    edge[7, 5:9, 5:9] = True
+    masks.append(edge)
+    return np.concatenate(masks)
+
+
+def sorted_areas(areas_all):
+    return [sorted(np.asarray(areas).tolist()) for areas in areas_all]
+
+
+def test_label_images_backends_match():
+    masks = get_masks()
+    images_skimage, areas_skimage = resmaps.label_images(masks, backend="skimage")
+    images_opencv, areas_opencv = resmaps.label_images(masks, backend="opencv")
+    np.testing.assert_array_equal(images_opencv, images_skimage)
+    assert areas_opencv == areas_skimage
+
+
+@pytest.mark.parametrize("backend", resmaps.LABEL_BACKENDS)
+@pytest.mark.parametrize("batch_size", [None, 1, 2, 5, 64])
+def test_label_areas_matches_label_images(backend, batch_size):
+    masks = get_masks()
+    _, areas_expected = resmaps.label_images(masks, backend="skimage")
+    region_areas = resmaps.label_areas(masks, backend=backend, batch_size=batch_size)
+    assert sorted_areas(region_areas.to_lists()) == sorted_areas(areas_expected)
+    np.testing.assert_array_equal(
+        region_areas.max_areas(), [max(areas) for areas in areas_expected]
+    )
+
+    # thresholded batch by batch from residual maps
+    resmaps_float = get_images()[0]
+    for threshold in [0.3, 0.5, 0.7]:
+        _, areas_expected = resmaps.label_images(
+            resmaps_float > threshold, backend="skimage"
+        )
+        region_areas = resmaps.label_areas(
+            resmaps_float, threshold, backend=backend, batch_size=batch_size
+        )
+        assert sorted_areas(region_areas.to_lists()) == sorted_areas(areas_expected)
+        np.testing.assert_array_equal(
+            region_areas.max_areas(), [max(areas) for areas in areas_expected]
+        )
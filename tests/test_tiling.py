@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+from tensorflow import keras
+from keras.preprocessing.image import array_to_img
+from processing.preprocessing import Preprocessor
+from processing.tiling import TiledInference
+
+SHAPE = (128, 160)
+RESCALE = 1.0 / 255
+
+
+def build_identity_model(channels):
+    input_img = keras.layers.Input(shape=SHAPE + (channels,))
+    return keras.models.Model(input_img, keras.layers.Activation("linear")(input_img))
+
+
+@pytest.fixture
+def input_directory(tmp_path):
+    class_dir = tmp_path / "test" / "good"
+    class_dir.mkdir(parents=True)
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, size=SHAPE + (3,)).astype("uint8")
+    array_to_img(img).save(str(class_dir / "000.png"))
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("color_mode", ["grayscale", "rgb"])
+@pytest.mark.parametrize(
+    "preprocessing_function",
+    [None, keras.applications.inception_resnet_v2.preprocess_input],
+)
+def test_full_size_tile_matches_preprocessor(
+    input_directory, color_mode, preprocessing_function
+):
+    preprocessor = Preprocessor(
+        input_directory=input_directory,
+        rescale=RESCALE,
+        shape=SHAPE,
+        color_mode=color_mode,
+        preprocessing_function=preprocessing_function,
+    )
+    test_generator = preprocessor.get_test_generator(batch_size=1, shuffle=False)
+    img_untiled = test_generator[0][0][0]
+
+    channels = 3 if color_mode == "rgb" else 1
+    tiled_inference = TiledInference(
+        model=build_identity_model(channels),
+        color_mode=color_mode,
+        method="l2",
+        rescale=preprocessor.rescale,
+        preprocessing_function=preprocessor.preprocessing_function,
+    )
+    img = tiled_inference.load_image(
+        os.path.join(test_generator.directory, test_generator.filenames[0])
+    )
+    # an image of the size of a tile is covered by a single tile
+    tiles = [tiles for _, tiles in tiled_inference.generate_tiles(img)]
+    assert len(tiles) == 1 and len(tiles[0]) == 1
+    np.testing.assert_array_equal(tiles[0][0], img_untiled)
@@ -13,6 +13,8 @@ from processing.preprocessing import Preprocessor
 from processing.utils import printProgressBar as printProgressBar
 from processing import utils
 from processing import resmaps
+from processing import reconstructions
+from processing.reconstructions import ReconstructionStore
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -58,6 +60,9 @@ def main(args):
     color_mode = args.color
     loss = args.loss
     batch_size = args.batch
+    backend = args.backend
+    cache = args.cache
+    workers = args.workers
 
     # get dir path containing training images
     train_data_dir = os.path.join(input_dir, "train")
@@ -75,6 +80,8 @@ def main(args):
         shape=autoencoder.shape,
         color_mode=autoencoder.color_mode,
         preprocessing_function=autoencoder.preprocessing_function,
+        backend=backend,
+        cache=cache,
     )
     train_generator = preprocessor.get_train_generator(
         batch_size=autoencoder.batch_size, shuffle=True
@@ -96,6 +103,10 @@ def main(args):
         # -------------- INSPECTING VALIDATION IMAGES --------------
         logger.info("generating inspection plots of validation images...")
 
+        # store reconstructions for reuse by finetune.py and test.py
+        model_path = os.path.join(autoencoder.save_dir, autoencoder.create_model_name())
+        store = None if args.no_store else ReconstructionStore(model_path)
+
         # create a directory to save inspection plots
         inspection_val_dir = os.path.join(autoencoder.save_dir, "inspection_val")
         if not os.path.isdir(inspection_val_dir):
@@ -110,7 +121,14 @@ def main(args):
 
         # get reconstructed images (i.e predictions) on validation dataset
         logger.info("reconstructing validation images...")
-        imgs_val_pred = autoencoder.model.predict(imgs_val_input)
+        imgs_val_pred = reconstructions.predict(
+            store,
+            autoencoder.model,
+            imgs_val_input,
+            group="validation",
+            directory=inspection_val_generator.directory,
+            filenames=filenames_val,
+        )
 
         # convert to grayscale if RGB
         if color_mode == "rgb":
@@ -130,12 +148,18 @@ def main(args):
             method=autoencoder.loss,
             dtype="float64",
             filenames=filenames_val,
+            workers=workers,
         )
 
-        # generate and save inspection validation plots
-        tensor_val.generate_inspection_plots(
-            group="validation", save_dir=inspection_val_dir
-        )
+        # generate and save inspection validation plots (or contact sheets)
+        if args.sheets:
+            tensor_val.generate_contact_sheets(
+                group="validation", save_dir=inspection_val_dir
+            )
+        else:
+            tensor_val.generate_inspection_plots(
+                group="validation", save_dir=inspection_val_dir
+            )
 
         # -------------- INSPECTING TEST IMAGES --------------
         logger.info("generating inspection plots of test images...")
@@ -156,7 +180,14 @@ def main(args):
 
         # get reconstructed images (i.e predictions) on validation dataset
         logger.info("reconstructing test images...")
-        imgs_test_pred = autoencoder.model.predict(imgs_test_input)
+        imgs_test_pred = reconstructions.predict(
+            store,
+            autoencoder.model,
+            imgs_test_input,
+            group="test",
+            directory=inspection_test_generator.directory,
+            filenames=filenames_test,
+        )
 
         # convert to grayscale if RGB
         if color_mode == "rgb":
@@ -176,12 +207,18 @@ def main(args):
             method=autoencoder.loss,
             dtype="float64",
             filenames=filenames_test,
+            workers=workers,
         )
 
-        # generate and save inspection test plots
-        tensor_test.generate_inspection_plots(
-            group="test", save_dir=inspection_test_dir
-        )
+        # generate and save inspection test plots (or contact sheets)
+        if args.sheets:
+            tensor_test.generate_contact_sheets(
+                group="test", save_dir=inspection_test_dir
+            )
+        else:
+            tensor_test.generate_inspection_plots(
+                group="test", save_dir=inspection_test_dir
+            )
 
     logger.info("done.")
     return
@@ -245,6 +282,22 @@ if __name__ == "__main__":
         help="batch size to use for training",
     )
 
+    parser.add_argument(
+        "--backend",
+        type=str,
+        required=False,
+        metavar="",
+        choices=["keras", "tfdata", "memmap"],
+        default="keras",
+        help="backend for loading and augmenting images: 'keras' (ImageDataGenerator), 'tfdata' or 'memmap' (cache of decoded images)",
+    )
+
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="cache decoded images in memory (tfdata backend only)",
+    )
+
     parser.add_argument(
         "-i",
         "--inspect",
@@ -252,6 +305,28 @@ if __name__ == "__main__":
         help="generate inspection plots after training",
     )
 
+    parser.add_argument(
+        "--sheets",
+        action="store_true",
+        help="save inspection panels on contact sheets instead of one plot per image (with --inspect)",
+    )
+
+    parser.add_argument(
+        "--no-store",
+        action="store_true",
+        help="do not save reconstructions of inspected images in the reconstructions directory of the model (with --inspect)",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        required=False,
+        metavar="",
+        default=1,
+        help="number of worker processes for computing resmaps and rendering inspection plots",
+    )
+
     args = parser.parse_args()
     if tf.test.is_gpu_available():
         logger.info("GPU was detected...")